@@ -0,0 +1,411 @@
+# answer_cache.py
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# 2024 Amar Abane
+
+# Description: This file is part of the AskBatfish project which interacts with
+# Batfish using LLMs.
+
+
+from collections import OrderedDict
+from functools import lru_cache
+import copy
+import hashlib
+import json
+import os
+import pickle
+import threading
+from dotenv import load_dotenv
+import numpy as np
+import pandas as pd
+
+from columnar import ColumnarFrame
+from metrics import span
+
+
+load_dotenv(".env")
+
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "256"))
+ANSWER_CACHE_DIR = os.getenv("ANSWER_CACHE_DIR")
+ANSWER_CACHE_MAX_BYTES = int(os.getenv("ANSWER_CACHE_MAX_BYTES", str(1 << 30)))
+
+
+def _normalize(value):
+    """Turn question parameters into JSON-compatible values with a stable order."""
+    if hasattr(value, "dict") and callable(value.dict):
+        # pybatfish datamodel objects (HeaderConstraints, Interface, ...)
+        return {"__type__": type(value).__name__, **_normalize(value.dict())}
+    if isinstance(value, dict):
+        return {str(k): _normalize(v) for k, v in sorted(value.items()) if v is not None}
+    if isinstance(value, (list, tuple, set, frozenset)):
+        items = [_normalize(v) for v in value]
+        return sorted(items, key=repr) if isinstance(value, (set, frozenset)) else items
+    if isinstance(value, str):
+        return value.strip()
+    return value
+
+
+def cache_key(snapshot_hash, question, params, reference_hash=None):
+    payload = json.dumps(
+        [snapshot_hash, reference_hash, question, _normalize(params)],
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class AnswerCache:
+    """Two-tier cache of Batfish answers.
+
+    Snapshots are immutable once initialized, so an answer only depends on the
+    snapshot content, the question and its parameters. The first tier is an
+    in-memory LRU of `size` entries; the optional second tier stores answers
+    under `directory` and evicts the least recently used files once they
+    exceed `max_bytes`. Table answers are kept in columnar form in both
+    tiers: their frame and rows are only rebuilt when an answer is used. On
+    disk they are Arrow files, memory-mapped on load; other answers, or all
+    of them when pyarrow is not installed, are pickled.
+    """
+
+    def __init__(self, size=ANSWER_CACHE_SIZE, directory=ANSWER_CACHE_DIR,
+                 max_bytes=ANSWER_CACHE_MAX_BYTES):
+        self.size = size
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+            }
+
+    def clear(self):
+        """Empty the in-memory tier and reset the statistics."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.disk_hits = self.misses = 0
+
+    def _path(self, key, suffix=".pkl"):
+        return os.path.join(self.directory, f"{key}{suffix}")
+
+    def _remember(self, key, value):
+        # Must be called with the lock held.
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+
+        if self.directory:
+            value = self._read(key)
+            if value is not None:
+                with self._lock:
+                    self.disk_hits += 1
+                    self._remember(key, value)
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _read(self, key):
+        path = self._path(key, ".arrow")
+        try:
+            frame, metadata = ColumnarFrame.read_arrow(path)
+            value = _lazy_answer(pickle.loads(metadata["answer"]), frame)
+            os.utime(path)
+            return value
+        except Exception:
+            # Missing, truncated, or written without pyarrow: try the pickle.
+            pass
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as file:
+                value = pickle.load(file)
+            os.utime(path)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            value = None
+        return value
+
+    def _write(self, key, value):
+        tmp = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}"
+        if isinstance(value, _LazyTable):
+            try:
+                shell = pickle.dumps(value._shell, protocol=pickle.HIGHEST_PROTOCOL)
+                value._columnar.write_arrow(tmp, {"answer": shell})
+                os.replace(tmp, self._path(key, ".arrow"))
+                return
+            except ImportError:
+                pass
+        with open(tmp, 'wb') as file:
+            pickle.dump(value, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self._path(key))
+
+    def put(self, key, value):
+        value = _columnar_answer(value)
+        with self._lock:
+            self._remember(key, value)
+        if self.directory:
+            try:
+                self._write(key, value)
+            except Exception as e:
+                print(f"Unable to write answer cache entry: {e}")
+                return
+            self._evict_disk()
+
+    def _evict_disk(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith((".pkl", ".arrow")):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
+
+
+def _row_value(schema, value):
+    """JSON form of a frame cell, as in the rows of a TableAnswer."""
+    from pybatfish.datamodel.answer.base import _get_base_schema, _is_iterable_schema
+
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return None
+    if _is_iterable_schema(schema):
+        base = _get_base_schema(schema)
+        return [_row_value(base, v) for v in value]
+    if schema == "Node":
+        return {"name": value}
+    if hasattr(value, "dict") and callable(value.dict):
+        return value.dict()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _frame_rows(answer, df):
+    """The `rows` of a TableAnswer, rebuilt from its frame.
+
+    Nodes are rebuilt from their name only: the frame does not keep ids.
+    """
+    from pybatfish.datamodel.answer.table import Row
+
+    schemas = [c.schema for c in answer.metadata.column_metadata]
+    return [
+        Row({name: _row_value(schema, v) for name, schema, v in zip(df.columns, schemas, values)})
+        for values in df.itertuples(index=False, name=None)
+    ]
+
+
+class _LazyTable:
+    """Table answer whose frame and rows are decoded from columns on first use.
+
+    Mixed into the class of the cached answer by `_lazy_answer`. Pickling
+    keeps the columnar form.
+    """
+
+    @property
+    def table_data(self):
+        df = self.__dict__.get("_table_data")
+        if df is None:
+            df = self.__dict__["_table_data"] = self._columnar.decode()
+        return df
+
+    @table_data.setter
+    def table_data(self, value):
+        self.__dict__["_table_data"] = value
+
+    @property
+    def rows(self):
+        rows = self.__dict__.get("_rows")
+        if rows is None:
+            rows = self.__dict__["_rows"] = _frame_rows(self, self.table_data)
+        return rows
+
+    @rows.setter
+    def rows(self, value):
+        self.__dict__["_rows"] = value
+
+    def __reduce__(self):
+        return _lazy_answer, (self._shell, self._columnar)
+
+
+@lru_cache(maxsize=None)
+def _lazy_class(cls):
+    return type(cls.__name__, (_LazyTable, cls), {"__module__": cls.__module__})
+
+
+def _lazy_answer(shell, frame):
+    answer = copy.copy(shell)
+    answer.__class__ = _lazy_class(type(shell))
+    answer.__dict__.update(_shell=shell, _columnar=frame)
+    return answer
+
+
+def _columnar_answer(answer):
+    """Cached form of `answer`: columnar for a TableAnswer, else unchanged.
+
+    The raw rows of the answer JSON are dropped, since the frame holds the
+    same values.
+    """
+    if isinstance(answer, _LazyTable):
+        return answer
+    if not (isinstance(answer, dict) and isinstance(getattr(answer, "table_data", None), pd.DataFrame)):
+        return answer
+    frame = ColumnarFrame.encode(answer.table_data)
+    shell = copy.copy(answer)
+    elements = [dict(e) for e in shell["answerElements"]]
+    elements[0].pop("rows", None)
+    shell["answerElements"] = elements
+    shell.__dict__.pop("table_data", None)
+    shell.__dict__.pop("rows", None)
+    return _lazy_answer(shell, frame)
+
+
+answer_cache = AnswerCache()
+
+
+def _detached(answer):
+    """Shallow copy of an answer so callers cannot reshape the cached frame."""
+    if isinstance(answer, _LazyTable):
+        # Its own frame, decoded when it is first used.
+        return _lazy_answer(answer._shell, answer._columnar)
+    if not hasattr(answer, "table_data"):
+        return answer
+    answer = copy.copy(answer)
+    answer.table_data = answer.table_data.copy(deep=False)
+    return answer
+
+
+class _CachedQuestion:
+    """Stands in for a pybatfish question built by `bf.q.<name>(**params)`."""
+
+    def __init__(self, session, name, params):
+        self._session = session
+        self._name = name
+        self._params = params
+        self._question = None
+
+    def _real(self):
+        if self._question is None:
+            self._question = getattr(self._session.bf.q, self._name)(**self._params)
+        return self._question
+
+    def answer(self, snapshot=None, reference_snapshot=None, background=False, **kwargs):
+        if background:
+            return self._real().answer(
+                snapshot=snapshot, reference_snapshot=reference_snapshot,
+                background=background, **kwargs
+            )
+        session = self._session
+        snapshot_hash = session.snapshot_hash(snapshot)
+        reference_hash = (
+            session.snapshot_hash(reference_snapshot) if reference_snapshot else None
+        )
+        if snapshot_hash is None or (reference_snapshot and reference_hash is None):
+            # Unknown content: the name may have been reused, do not cache.
+            return self._real().answer(
+                snapshot=snapshot, reference_snapshot=reference_snapshot, **kwargs
+            )
+        key = cache_key(
+            snapshot_hash,
+            self._name,
+            {"params": self._params, "answer": kwargs},
+            reference_hash,
+        )
+        with span("batfish.answer", question=self._name) as s:
+            cached = session.cache.get(key)
+            s.set(cached=cached is not None)
+            if cached is not None:
+                return _detached(cached)
+            result = self._real().answer(
+                snapshot=snapshot, reference_snapshot=reference_snapshot, **kwargs
+            )
+            if hasattr(result, "table_data"):
+                s.set(rows=len(result.table_data))
+        session.cache.put(key, result)
+        return _detached(result)
+
+    def __getattr__(self, name):
+        return getattr(self._real(), name)
+
+
+class _CachedQuestions:
+    def __init__(self, session):
+        self._session = session
+
+    def __getattr__(self, name):
+        # Let pybatfish raise for unknown questions.
+        getattr(self._session.bf.q, name)
+
+        def make_question(**params):
+            return _CachedQuestion(self._session, name, params)
+
+        return make_question
+
+    def __dir__(self):
+        return dir(self._session.bf.q)
+
+
+class CachingSession:
+    """Wraps a pybatfish Session so that `bf.q.*` answers go through the cache.
+
+    Everything else is delegated to the wrapped session. Snapshot names are
+    mapped to their content hash with `register_snapshot`, so answers stay
+    valid when a name is reused for different content and are shared when
+    different names hold the same content. Questions on snapshots that were
+    not registered bypass the cache.
+    """
+
+    def __init__(self, bf, cache=None, hashes=None):
+        self.bf = bf
+        self.cache = cache or answer_cache
+        self.q = _CachedQuestions(self)
+        self._hashes = {} if hashes is None else hashes
+
+    def register_snapshot(self, name, content_hash):
+        self._hashes[name] = content_hash
+
+    def snapshot_hash(self, snapshot=None):
+        name = self.bf.get_snapshot(snapshot)
+        return self._hashes.get(name)
+
+    def __getattr__(self, name):
+        return getattr(self.bf, name)
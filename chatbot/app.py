@@ -17,54 +17,46 @@
 # Description: This file is part of the AskBatfish project which interacts with
 # Batfish using LLMs.
 
-from langchain_openai import ChatOpenAI
-from langchain.schema import StrOutputParser
-from langchain.schema.runnable import Runnable
-from langchain.schema.runnable.config import RunnableConfig
+import importreport  # first, to time the imports below
+
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.messages import AIMessage, HumanMessage
 from langchain.agents import tool
 from langchain_core.utils.function_calling import convert_to_openai_function
 from langchain.agents.format_scratchpad import format_to_openai_function_messages
 from langchain.agents.output_parsers import OpenAIFunctionsAgentOutputParser
 from langchain.agents import AgentExecutor
 
-from typing import List, Optional
+from typing import Optional
 import chainlit as cl
 
-from tools import (
-    remove_python_code_fence, 
-    create_text_to_code_chain, 
-    create_data_to_text_chain,
-    create_ask_chain, 
-    create_generate_tasks_chain, 
-    create_parsing_status_chain
-)
-from langchain.tools import BaseTool
-
+from tools import get_chain
+from code_cache import code_cache
+from query import SESSION_QUERY_LIMIT, run_blocking
+from rendering import ResultPager
+from compaction import COMPACT_TOKEN_BUDGET, compact_frame, count_tokens
+from frames import FrameStore
+from local_query import run_local
+from memory import MEMORY_SUMMARY_WORDS, ChatMemory
+from pipeline import generate_plan, generate_run, merge_frames, run_code
+from workers import get_worker_pool
+from metrics import TokenUsageHandler, registry, set_session_resolver, span, start_server
+from gateway import chat_model
+from sessions import session_manager
+from snapshot import ensure_snapshot, update_snapshot
+from speculation import Speculation
+
+import asyncio
 import os
+import threading
 from dotenv import load_dotenv
 import re
-from io import StringIO
 
 
 ## pybatfish imports
 # Importing required libraries, setting up logging, and loading questions
 import logging
-import random  # noqa: F401
 import pandas as pd
 
-from pybatfish.client.session import Session  # noqa: F401
-
-# noinspection PyUnresolvedReferences
-from pybatfish.datamodel import Edge, Interface  # noqa: F401
-from pybatfish.datamodel.answer import TableAnswer
-from pybatfish.datamodel.flow import HeaderConstraints, PathConstraints  # noqa: F401
-from pybatfish.datamodel.route import BgpRoute  # noqa: F401
-
-from pandasai import SmartDataframe
-from pandasai.llm import OpenAI
-
 # Configure all pybatfish loggers to use WARN level
 logging.getLogger("pybatfish").setLevel(logging.WARN)
 
@@ -72,19 +64,17 @@ load_dotenv(".env")
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
-bf = None
+def profile_model(profile):
+    return "gpt-3.5-turbo" if profile == "Fast" else "gpt-4o"
 
-ask_chain = None
-text_to_code_chain = None
-data_to_text_chain = None
 
 def init_chains():
-    global ask_chain,text_to_code_chain, data_to_text_chain
-    profile = cl.user_session.get("chat_profile")
-    model = "gpt-3.5-turbo" if profile == "Fast" else "gpt-4o"
-    ask_chain = create_ask_chain(model)
-    text_to_code_chain = create_text_to_code_chain(model)
-    # data_to_text_chain = create_data_to_text_chain(model)
+    # Chains are shared by all sessions; a session only keeps its model.
+    model = profile_model(cl.user_session.get("chat_profile"))
+    cl.user_session.set("model", model)
+    get_chain("ask", model)
+    get_chain("text_to_code", model)
+    get_chain("plan", model)
 
 _basic_suffix = """### You are using the 'Basic' profile 🤖
  
@@ -96,100 +86,342 @@ _agent_suffix = """### You are using the '{profile}' profile 🤖
 
 You can now ask questions."""
 
+set_session_resolver(lambda: cl.user_session.get("id"))
+start_server()
+importreport.report()
+
+
+def current_binding():
+    return session_manager.get(cl.user_session.get("id"))
+
+
 def init_batfish(snapshot_path):
-    global bf
-    bf = Session(host="batfish")
+    binding = session_manager.bind(cl.user_session.get("id"))
+    # Start the query workers, if not yet, while the snapshot is processed.
+    get_worker_pool()
+
+    # Initialize the snapshot, unless Batfish already holds a snapshot with
+    # the same content. Warm-up questions are prefetched by on_chat_start.
+    with span("init_batfish") as s, binding.session() as bf:
+        name, digest, reused = ensure_snapshot(bf, snapshot_path)
+        binding.set_snapshot(name, digest)
+        s.set(reused=reused, bytes=os.path.getsize(snapshot_path))
+
+
+def update_batfish(snapshot_path):
+    """Replace the current snapshot with an edited version of it.
+
+    Returns (changed, updated): the uploaded files (None after a full
+    upload) and whether the snapshot content changed at all.
+    """
+    binding = current_binding()
+    previous = binding.snapshot
+    with binding.session() as bf:
+        name, digest, changed = update_snapshot(bf, previous, snapshot_path)
+    if name == previous:
+        return changed, False
+    binding.set_snapshot(name, digest, reference=previous)
+    return changed, True
+
+
+_update_actions = [
+    cl.Action(name="update_snapshot", value="update", label="Update snapshot"),
+]
+
+
+async def answer_query(task):
+    """Answer `task` with a non-empty DataFrame, or a message for the user."""
+    binding = current_binding()
+    if binding is None:
+        return 'The session has expired, please upload the snapshot again.'
+
+    async with cl.user_session.get("query_limit"):
+        key, entry = await generate_run(get_chain("text_to_code", cl.user_session.get("model")), task, cl.user_session.get("model"))
+        if entry is None:
+            return 'Unable to get a result.'
+
+        result = await run_code(entry, binding)
+        await run_blocking(code_cache.update, key, entry, result)
+        if result is None:
+            return 'Unable to get a result.'
+        if result.empty:
+            return 'Got an empty result.'
+        return result
+
 
-    # Assign a friendly name to your network and snapshot
-    NETWORK_NAME = "example_network"
-    SNAPSHOT_NAME = "example_snapshot"
+async def answer_planned(task):
+    """Answer the independent questions of `task` concurrently.
 
-    SNAPSHOT_PATH = snapshot_path
+    Returns [(question, result)], where a result is a non-empty DataFrame or
+    a message for the user. Runs are bounded by the session's query limit.
+    """
+    binding = current_binding()
+    if binding is None:
+        return [(task, 'The session has expired, please upload the snapshot again.')]
 
-    # Now create the network and initialize the snapshot
-    bf.set_network(NETWORK_NAME)
-    bf.init_snapshot(SNAPSHOT_PATH, name=SNAPSHOT_NAME, overwrite=True)
-    bf.q.routes().answer()
+    model = cl.user_session.get("model")
+    limit = cl.user_session.get("query_limit")
+    async with limit:
+        plan = await generate_plan(get_chain("plan", model), task, model)
+
+    async def answer(question, key, entry):
+        if entry is None:
+            return question, 'Unable to get a result.'
+        async with limit:
+            result = await run_code(entry, binding)
+        await run_blocking(code_cache.update, key, entry, result)
+        if result is None:
+            return question, 'Unable to get a result.'
+        if result.empty:
+            return question, 'Got an empty result.'
+        return question, result
+
+    with span("fan_out", queries=len(plan)):
+        return await asyncio.gather(*(answer(*part) for part in plan))
 
 
 @tool
-def process_query(task: str) -> str:
-    """Useful to answer text queries about the network's configuration or forwarding analysis."""
-    
-    local_namespace = {}
-    
-    output = text_to_code_chain.invoke(task)
-    code = remove_python_code_fence(output)
-    print(f"Generate invocation: {code}")
-    
-    globals_dict = globals().copy()
-    globals_dict['bf'] = bf
-    exec(code, globals_dict, local_namespace)
-    run = local_namespace['run']
-    try:
-        result = run()
-        if not result.empty:
-            return result.to_markdown(index=False)
-        else:
-            return 'Got an empty result.'
-    except Exception as e:
-        print(f"Exception: {e}")
-        return 'Unable to get a result.'
+async def process_query(task: str) -> str:
+    """Useful to answer text queries about the network's configuration or forwarding analysis. A task with several parts is answered at once."""
+    with span("process_query"):
+        results = await answer_planned(task)
+        if len(results) == 1:
+            result = results[0][1]
+            if isinstance(result, str):
+                return result
+            handle = await run_blocking(_store_result, result, task)
+            return await _compact(result, handle)
+
+        # One combined result; the token budget is shared by its parts.
+        frames = [(q, r) for q, r in results if not isinstance(r, str)]
+        if not frames:
+            return "\n".join(f"{q}: {r}" for q, r in results)
+        handle = await run_blocking(_store_result, merge_frames(frames), task)
+        parts = [
+            f"Combined result of {len(results)} queries. Full result handle: {handle} "
+            "(its Query column gives the query of each row)."
+        ]
+        budget = COMPACT_TOKEN_BUDGET // len(results)
+        for question, result in results:
+            if isinstance(result, str):
+                parts.append(f"Query: {question}\n{result}")
+            else:
+                parts.append(f"Query: {question}\n{await _compact(result, budget=budget)}")
+        return "\n\n".join(parts)
+
+
+async def _compact(df, handle=None, budget=COMPACT_TOKEN_BUDGET):
+    model = cl.user_session.get("model")
+    with span("compact", rows=len(df)) as s:
+        text = await run_blocking(compact_frame, df, budget, handle=handle, model=model)
+        s.set(bytes=len(text), tokens=count_tokens(text, model))
+    return text
+
+
+def _frame_store():
+    store = cl.user_session.get("frames")
+    if store is None:
+        store = FrameStore()
+        cl.user_session.set("frames", store)
+    return store
+
+
+def _store_result(df, source=None):
+    """Keep a result frame in the session's frame store; return its handle."""
+    return _frame_store().put(df, source)
+
+
+def _get_pager(handle):
+    pagers = cl.user_session.get("pagers")
+    if pagers is None:
+        pagers = {}
+        cl.user_session.set("pagers", pagers)
+    store = _frame_store()
+    for h in [h for h in pagers if h not in store]:
+        del pagers[h]
+    if handle not in pagers:
+        frame = store.frame(handle)
+        if frame is None:
+            return None
+        pagers[handle] = ResultPager(frame)
+    return pagers[handle]
+
+
+def _result_actions(handle, pager):
+    actions = []
+    if pager.has_next():
+        actions.append(cl.Action(name="next_page", value=handle, label="Next page"))
+    actions.append(cl.Action(name="select_columns", value=handle, label="Columns"))
+    actions.append(cl.Action(name="download_result", value=handle, label="Download CSV"))
+    return actions
+
+
+async def send_result(df, source=None):
+    handle = await run_blocking(_store_result, df, source)
+    await send_page(handle)
+
+
+async def send_page(handle):
+    pager = _get_pager(handle)
+    if pager is None:
+        await cl.Message(content="This result is no longer available.").send()
+        return
+    with span("render", rows=min(pager.page_size, pager.rows)) as s:
+        content = await run_blocking(pager.page_markdown)
+        s.set(bytes=len(content))
+    await cl.Message(content=content, actions=_result_actions(handle, pager)).send()
+
+
+@cl.action_callback("next_page")
+async def on_next_page(action: cl.Action):
+    pager = _get_pager(action.value)
+    if pager is not None:
+        pager.next()
+    await send_page(action.value)
+
+
+@cl.action_callback("select_columns")
+async def on_select_columns(action: cl.Action):
+    pager = _get_pager(action.value)
+    if pager is None:
+        return await send_page(action.value)
+    res = await cl.AskUserMessage(
+        content=f"Columns to show, separated by commas (available: {', '.join(map(str, pager.frame.columns))}):",
+        timeout=120,
+    ).send()
+    if res:
+        columns = [c.strip() for c in res["output"].split(",") if c.strip()]
+        try:
+            pager.project(columns)
+        except ValueError as e:
+            await cl.Message(content=str(e)).send()
+            return
+    await send_page(action.value)
+
+
+@cl.action_callback("download_result")
+async def on_download_result(action: cl.Action):
+    pager = _get_pager(action.value)
+    if pager is None:
+        return await send_page(action.value)
+    content = await run_blocking(pager.to_csv)
+    await cl.Message(
+        content=f"Result with {pager.rows} rows.",
+        elements=[cl.File(name=f"result-{action.value}.csv", content=content, display="inline")],
+    ).send()
+
+@cl.action_callback("update_snapshot")
+async def on_update_snapshot(action: cl.Action):
+    files = await cl.AskFileMessage(
+        content="Upload a zip file of the edited snapshot.",
+        accept=["application/zip"],
+        max_size_mb=20,
+        timeout=280,
+    ).send()
+    if not files:
+        return
+    if current_binding() is None:
+        await cl.Message(content='The session has expired, please upload the snapshot again.').send()
+        return
+
+    # A speculative answer would be computed on the snapshot being replaced.
+    _speculation().cancel()
+    msg = cl.Message(content="Updating network snapshot...", disable_feedback=True)
+    await msg.send()
+    changed, updated = await cl.make_async(update_batfish)(files[0].path)
+    if updated:
+        # Results and their pages belong to the previous snapshot.
+        cl.user_session.set("frames", FrameStore())
+        cl.user_session.set("pagers", {})
+    if not updated:
+        msg.content = "The snapshot is unchanged."
+    elif changed is None:
+        msg.content = "Snapshot uploaded. The previous snapshot is kept as reference for differential questions."
+    else:
+        msg.content = (
+            f"Snapshot updated with {len(changed)} changed files: {', '.join(changed)}. "
+            "The previous snapshot is kept as reference for differential questions."
+        )
+    msg.actions = _update_actions
+    await msg.update()
+
 
 @tool
 def explain_result(df: str) -> str:
     """Useful to explain the Markdown table resulting from a query."""
-    response = data_to_text_chain.invoke({"data": df})
+    response = get_chain("data_to_text", cl.user_session.get("model")).invoke({"data": df})
     return response
 
-@tool
-def analyze_df(md_df: str, question: str) -> str:
-    """Useful to filter and manipulate a Markdown table using text queries."""
-    
-    profile = cl.user_session.get("chat_profile")
-    model = "gpt-3.5-turbo" if profile == "Fast" else "gpt-4o"
+def _pandasai_chat(df, question, model):
+    # pandasai takes seconds to import and only serves this fallback.
+    from pandasai import SmartDataframe
+    from pandasai.llm import OpenAI
+
     llm = OpenAI(model=model, temperature=0)
+    return SmartDataframe(df, config={"llm": llm}).chat(question)
 
-    # Convert Markdown table to DataFrame
-    df = pd.read_csv(StringIO(md_df), delimiter='|', skiprows=1, skipinitialspace=True)
-    df = df.iloc[:, 1:-1]
-    df.columns = [col.strip() for col in df.columns]
-    
-    sdf = SmartDataframe(df, config={"llm": llm})
-    response = sdf.chat(question)
+
+def _analyze(handle, question):
+    df = _frame_store().get(handle)
+    if df is None:
+        return f"Unknown or expired result handle: {handle}."
+
+    model = cl.user_session.get("model")
+
+    # Simple filters and aggregations are answered without the LLM.
+    with span("analyze", engine="local", rows=len(df)) as s:
+        response = run_local(df, question)
+        if response is None:
+            s.set(engine="pandasai")
+            response = _pandasai_chat(df, question, model)
     if isinstance(response, pd.core.frame.DataFrame):
-        return response.to_markdown(index=False)
-    return response
+        new_handle = _store_result(response, f"{question} (on {handle})")
+        with span("compact", rows=len(response)) as s:
+            text = compact_frame(response, handle=new_handle, model=model)
+            s.set(bytes=len(text), tokens=count_tokens(text, model))
+        return text
+    return str(response)
 
 
+@tool
+async def analyze_df(handle: str, question: str) -> str:
+    """Useful to filter and manipulate a previous query result, given its handle, using text queries."""
+    with span("analyze_df"):
+        return await run_blocking(_analyze, handle, question)
 
-def generate_example_tasks():
-    global bf
 
-    chain = create_generate_tasks_chain()
+PREFETCH_QUESTIONS = ["routes", "fileParseStatus", "initIssues", "nodeProperties", "interfaceProperties"]
 
-    df = bf.q.nodeProperties().answer().frame()
-    devices = df.head(5)[['Node','Interfaces']]
 
-    df = bf.q.interfaceProperties().answer().frame()
-    interfaces = df.head(5)[['Interface', 'Primary_Address']]
-    
-    response = chain.invoke({
-        "devices": devices.to_markdown(), "interfaces": interfaces.to_markdown()
-    })
-    return response
+def answer_frame(binding, question):
+    """Answer a parameterless question; the answer cache keeps the result."""
+    with span("prefetch", question=question) as s, binding.session() as bf:
+        df = getattr(bf.q, question)().answer().frame()
+        s.set(rows=len(df))
+        return df
 
-def generate_parsing_status():
-    global bf
 
-    chain = create_parsing_status_chain()
+async def generate_example_tasks(node_properties, interface_properties):
+    chain = get_chain("generate_tasks")
+
+    devices = node_properties.head(5)[['Node','Interfaces']]
+    interfaces = interface_properties.head(5)[['Interface', 'Primary_Address']]
+    
+    with span("llm", chain="example_tasks"):
+        response = await chain.ainvoke({
+            "devices": devices.to_markdown(), "interfaces": interfaces.to_markdown()
+        }, config={"callbacks": [TokenUsageHandler("llm")]})
+    return response
 
-    a = bf.q.fileParseStatus().answer().frame()
-    b = bf.q.initIssues().answer().frame()
+async def generate_parsing_status(parse_status, init_issues):
+    chain = get_chain("parsing_status")
 
-    data = f"File parse status:\n {a.to_markdown()}\n\nInit issues:\n {b.to_markdown()}"
+    with span("render", rows=len(parse_status) + len(init_issues)) as s:
+        data = f"File parse status:\n {parse_status.to_markdown()}\n\nInit issues:\n {init_issues.to_markdown()}"
+        s.set(bytes=len(data))
     
-    response = chain.invoke({"data": data})
+    with span("llm", chain="parsing_status"):
+        response = await chain.ainvoke({"data": data}, config={"callbacks": [TokenUsageHandler("llm")]})
     return response
 
 
@@ -201,49 +433,70 @@ def auth_callback(username: str, password: str) -> Optional[cl.User]:
         return None
 
 
-def init_agent():
-    profile = cl.user_session.get("chat_profile")
-    model = "gpt-3.5-turbo" if profile == "Fast" else "gpt-4o"
-    llm = ChatOpenAI(model_name=model, temperature=0, streaming=True)
-
-    MEMORY_KEY = "chat_history"
-    prompt = ChatPromptTemplate.from_messages(
-        [
-            (
-                "system",
-                """
-                You are the co-pilot of a network engineer.
-                Answer the query you are asked using the provided tools.
-                You can ask the human for more clarifications if the task is ambiguous or if you are not sure about the what to do next.
-                """,
-            ),
-            MessagesPlaceholder(variable_name=MEMORY_KEY),
-            ("user", "{input}"),
-            MessagesPlaceholder(variable_name="agent_scratchpad"),
-        ]
-    )
-    chat_history = []
+_agents = {}
+_agents_lock = threading.Lock()
+
+
+def get_agent(model):
+    """Agent executor for `model`, built once per process.
 
-    tools = [process_query]
-    llm_with_tools = llm.bind(functions=[convert_to_openai_function(t) for t in tools])
+    The chat history is passed on every call, so sessions can share it.
+    """
+    with _agents_lock:
+        if model in _agents:
+            return _agents[model]
 
-    agent = (
-        {
-            "input": lambda x: x["input"],
-            "agent_scratchpad": lambda x: format_to_openai_function_messages(
-                x["intermediate_steps"]
-            ),
-            "chat_history": lambda x: x["chat_history"],
-        }
-        | prompt
-        | llm_with_tools
-        | OpenAIFunctionsAgentOutputParser()
-    )
+        llm = chat_model(model, streaming=True)
 
-    agent_executor = AgentExecutor(agent=agent, tools=tools, verbose=True)
+        MEMORY_KEY = "chat_history"
+        prompt = ChatPromptTemplate.from_messages(
+            [
+                (
+                    "system",
+                    """
+                    You are the co-pilot of a network engineer.
+                    Answer the query you are asked using the provided tools.
+                    You can ask the human for more clarifications if the task is ambiguous or if you are not sure about the what to do next.
+                    """,
+                ),
+                MessagesPlaceholder(variable_name=MEMORY_KEY),
+                ("user", "{input}"),
+                MessagesPlaceholder(variable_name="agent_scratchpad"),
+            ]
+        )
 
-    cl.user_session.set("chat_history", chat_history)
-    cl.user_session.set("agent", agent_executor)
+        tools = [process_query, analyze_df]
+        llm_with_tools = llm.bind(functions=[convert_to_openai_function(t) for t in tools])
+
+        agent = (
+            {
+                "input": lambda x: x["input"],
+                "agent_scratchpad": lambda x: format_to_openai_function_messages(
+                    x["intermediate_steps"]
+                ),
+                "chat_history": lambda x: x["chat_history"],
+            }
+            | prompt
+            | llm_with_tools
+            | OpenAIFunctionsAgentOutputParser()
+        )
+
+        agent_executor = AgentExecutor(agent=agent, tools=tools, verbose=True)
+        _agents[model] = agent_executor
+        return agent_executor
+
+
+def init_agent():
+    model = profile_model(cl.user_session.get("chat_profile"))
+    summary_chain = get_chain("summary", model)
+
+    async def summarize(summary, turns):
+        return await summary_chain.ainvoke({
+            "summary": summary or "(none)", "turns": turns, "max_words": MEMORY_SUMMARY_WORDS
+        })
+
+    cl.user_session.set("memory", ChatMemory(summarize, model=model))
+    cl.user_session.set("agent", get_agent(model))
 
 
 @cl.set_chat_profiles
@@ -262,8 +515,77 @@ async def chat_profile():
     ]
 
 
+async def tracked(coro):
+    """Run `coro` as a task that is cancelled if the user disconnects."""
+    tasks = cl.user_session.get("tasks")
+    task = asyncio.ensure_future(coro)
+    tasks.add(task)
+    try:
+        return await task
+    finally:
+        tasks.discard(task)
+
+
+def background(task):
+    """Track a task started for the session so that it is cancelled with it."""
+    tasks = cl.user_session.get("tasks")
+    tasks.add(task)
+
+    def done(task):
+        tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Background task failed: {task.exception()}")
+
+    task.add_done_callback(done)
+    return task
+
+
+async def prepare_session(snapshot_path, stage):
+    """Load the snapshot and build the chains of the chat session.
+
+    `stage(awaitable, label)` awaits each step and reports its completion.
+    Returns the tasks producing the parsing status and the example tasks,
+    which may still be running.
+    """
+    # Chains do not depend on the snapshot: build them while it is parsed.
+    chains = asyncio.ensure_future(stage(cl.make_async(init_chains)(), "Chains ready"))
+    try:
+        await stage(cl.make_async(init_batfish)(snapshot_path), "Snapshot parsed")
+    except Exception:
+        chains.cancel()
+        raise
+
+    # Warm the answer cache with the questions every session asks first.
+    binding = current_binding()
+    frames = {
+        q: asyncio.ensure_future(run_blocking(answer_frame, binding, q))
+        for q in PREFETCH_QUESTIONS
+    }
+
+    async def parsing_status():
+        return await generate_parsing_status(
+            await frames["fileParseStatus"], await frames["initIssues"]
+        )
+
+    async def example_tasks():
+        return await generate_example_tasks(
+            await frames["nodeProperties"], await frames["interfaceProperties"]
+        )
+
+    status = asyncio.ensure_future(parsing_status())
+    examples = asyncio.ensure_future(example_tasks())
+    for task in [*frames.values(), status, examples]:
+        background(task)
+
+    await chains
+    return status, examples
+
+
 @cl.on_chat_start
 async def on_chat_start():
+    cl.user_session.set("tasks", set())
+    cl.user_session.set("query_limit", asyncio.Semaphore(SESSION_QUERY_LIMIT))
+
     files = None
     while files == None:
         files = await cl.AskFileMessage(
@@ -277,12 +599,17 @@ async def on_chat_start():
 
     msg = cl.Message(content="Processing network snapshot...", disable_feedback=True)
     await msg.send()
-    
-    await cl.make_async(init_batfish)(file.path)
-    
-    await cl.make_async(init_chains)()
 
-    status = await cl.make_async(generate_parsing_status)()
+    progress = []
+
+    async def stage(awaitable, label):
+        result = await awaitable
+        progress.append(f"- {label} ✅")
+        msg.content = "Processing network snapshot...\n\n" + "\n".join(progress)
+        await msg.update()
+        return result
+
+    status, examples = await prepare_session(file.path, stage)
     
     indication_msg = ""
     if not cl.user_session.get("chat_profile") == "Basic":
@@ -290,44 +617,103 @@ async def on_chat_start():
         indication_msg = _agent_suffix.format(profile=cl.user_session.get("chat_profile"))
     else:
         indication_msg = _basic_suffix
-        
-    msg.content = f"""## Network loaded 🚀
 
-{status}"""
-        
+    # The session is usable now; the parsing summary and example tasks
+    # follow as soon as their LLM calls return.
+    msg.content = "## Network loaded 🚀\n\nChecking parsing status..."
     await msg.update()
 
-    msg = cl.Message(content=indication_msg, disable_feedback=True)
-    await msg.send()
+    await cl.Message(content=indication_msg, disable_feedback=True, actions=_update_actions).send()
+    importreport.ready()
+
+    async def show_status():
+        try:
+            content = await status
+        except Exception as e:
+            print(f"Unable to check the parsing status: {e}")
+            content = "The parsing status could not be checked."
+        msg.content = f"""## Network loaded 🚀
+
+{content}"""
+        await msg.update()
+
+    async def show_examples():
+        try:
+            content = f"Here are some tasks you can try:\n\n{await examples}"
+        except Exception as e:
+            print(f"Unable to generate example tasks: {e}")
+            content = "Example tasks could not be generated."
+        await cl.Message(content=content, disable_feedback=True).send()
+
+    background(asyncio.ensure_future(show_status()))
+    background(asyncio.ensure_future(show_examples()))
+
+
+@cl.on_chat_end
+def on_chat_end():
+    for task in cl.user_session.get("tasks") or ():
+        task.cancel()
+    session_manager.release(cl.user_session.get("id"))
+    registry.forget(cl.user_session.get("id"))
+
+
+def latency_breakdown():
+    """Markdown table of the time spent per stage in this chat session."""
+    rows = [
+        (name, v["count"], f"{v['seconds']:.2f}", f"{1000 * v['seconds'] / v['count']:.0f}", f"{1000 * v['max']:.0f}")
+        for name, v in registry.breakdown(cl.user_session.get("id"))
+    ]
+    if not rows:
+        return "No queries yet."
+    df = pd.DataFrame(rows, columns=["Stage", "Calls", "Total (s)", "Mean (ms)", "Max (ms)"])
+    return df.to_markdown(index=False)
 
 
 @cl.on_message
 async def on_message(message: cl.Message):
+    if message.content.strip() == "/stats":
+        await cl.Message(content=latency_breakdown()).send()
+        return
     if not cl.user_session.get("chat_profile") == "Basic":
-        chat_history = cl.user_session.get("chat_history")
+        memory = cl.user_session.get("memory")
         agent = cl.user_session.get("agent")
-        res = await agent.ainvoke(
-            {"input": message.content, "chat_history": chat_history}, callbacks=[cl.AsyncLangchainCallbackHandler(stream_final_answer=True)]
-        )
+        res = await tracked(agent.ainvoke(
+            {"input": message.content, "chat_history": memory.messages()}, callbacks=[cl.AsyncLangchainCallbackHandler(stream_final_answer=True)]
+        ))
         await cl.Message(content=res['output']).send()
 
-        chat_history.extend(
-            [
-                HumanMessage(content=message.content),
-                AIMessage(content=res["output"]),
-            ]
-        )
-        cl.user_session.set("chat_history", chat_history)
+        task = memory.add(message.content, res["output"])
+        if task is not None:
+            background(task)
     else:
-        await run_basic(message)
+        await tracked(run_basic(message))
         
 
+def _speculation():
+    speculation = cl.user_session.get("speculation")
+    if speculation is None:
+        speculation = Speculation()
+        cl.user_session.set("speculation", speculation)
+    return speculation
+
+
 async def run_basic(message: cl.Message):
     msg = message.content
+    speculation = _speculation()
     if msg.startswith("/ask"):
         task = msg[len("/ask"):].strip()
-        res = ask_chain.invoke(task)
+        # Answer the query while it is validated, for the user to send it next.
+        if speculation.enabled:
+            speculation.start(task, background(asyncio.ensure_future(answer_query(task))))
+        res = await get_chain("ask", cl.user_session.get("model")).ainvoke(task)
+        if not res.strip().upper().startswith("OK"):
+            speculation.cancel()
         await cl.Message(content=res).send()
     else:
-        res = process_query(msg)
-        await cl.Message(content=res).send()
+        speculative = speculation.take(msg)
+        with span("answer_query", speculative=speculative is not None):
+            res = await (speculative if speculative is not None else answer_query(msg))
+        if isinstance(res, str):
+            await cl.Message(content=res).send()
+        else:
+            await send_result(res, msg)
@@ -0,0 +1,246 @@
+# batch.py
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# 2024 Amar Abane
+
+# Description: This file is part of the AskBatfish project which interacts with
+# Batfish using LLMs.
+
+
+# Headless batch mode: answer a file of questions on a snapshot.
+#
+#   python batch.py snapshot.zip questions.txt --output results.jsonl
+#   python batch.py snapshot.zip questions.jsonl --output results.parquet
+#
+# Questions are one per line, or JSON lines with "question" and optional "id".
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import Counter
+from dotenv import load_dotenv
+
+from code_cache import code_cache
+from pipeline import generate_run, run_code
+from query import run_blocking
+from sessions import session_manager
+from snapshot import ensure_snapshot
+from tools import get_chain
+from workers import get_worker_pool
+
+
+load_dotenv(".env")
+
+BATCH_LLM_CONCURRENCY = int(os.getenv("BATCH_LLM_CONCURRENCY", "4"))
+BATCH_BATFISH_CONCURRENCY = int(os.getenv("BATCH_BATFISH_CONCURRENCY", "4"))
+
+FIELDS = [
+    "id", "question", "status", "error", "code", "shared", "rows", "columns", "result",
+    "generate_s", "wait_s", "run_s", "total_s",
+]
+
+
+def load_questions(path):
+    questions = []
+    with open(path, 'r') as file:
+        for n, line in enumerate(file, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if path.endswith(".jsonl"):
+                item = json.loads(line)
+                questions.append({"id": str(item.get("id", n)), "question": item["question"]})
+            else:
+                questions.append({"id": str(n), "question": line})
+    return questions
+
+
+class JsonlWriter:
+    def __init__(self, path):
+        self.file = open(path, 'w')
+
+    def write(self, record):
+        self.file.write(json.dumps(record, default=str) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    """Writes records to Parquet in row groups of `batch` records."""
+
+    def __init__(self, path, batch=50):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.schema = pa.schema([
+            ("id", pa.string()), ("question", pa.string()), ("status", pa.string()),
+            ("error", pa.string()), ("code", pa.string()), ("shared", pa.bool_()), ("rows", pa.int64()),
+            ("columns", pa.list_(pa.string())), ("result", pa.string()),
+            ("generate_s", pa.float64()), ("wait_s", pa.float64()),
+            ("run_s", pa.float64()), ("total_s", pa.float64()),
+        ])
+        self.writer = pq.ParquetWriter(path, self.schema)
+        self.batch = batch
+        self.records = []
+
+    def write(self, record):
+        self.records.append(record)
+        if len(self.records) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        if self.records:
+            table = self.pa.Table.from_pylist(self.records, schema=self.schema)
+            self.writer.write_table(table)
+            self.records = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def open_writer(path):
+    if path.endswith(".parquet"):
+        return ParquetWriter(path)
+    return JsonlWriter(path)
+
+
+def load_snapshot(binding, snapshot_path):
+    with binding.session() as bf:
+        name, digest, reused = ensure_snapshot(bf, snapshot_path)
+        binding.set_snapshot(name, digest)
+    return reused
+
+
+async def run_batch(snapshot_path, questions, writer, model="gpt-4o",
+                    llm_concurrency=BATCH_LLM_CONCURRENCY,
+                    batfish_concurrency=BATCH_BATFISH_CONCURRENCY, max_rows=1000):
+    """Answer `questions` on a snapshot, writing one record per question.
+
+    Code generation and Batfish execution are bounded separately; with
+    worker processes, no more queries run at once than there are workers.
+    Questions whose generated code is identical share a single execution.
+    A record's wait_s is the time its query waited for its turn and for a
+    worker.
+    """
+    binding = session_manager.bind(f"batch-{os.getpid()}")
+    try:
+        reused = await run_blocking(load_snapshot, binding, snapshot_path)
+        print(f"Snapshot {binding.snapshot} {'reused' if reused else 'initialized'}")
+
+        chain = get_chain("text_to_code", model)
+        pool = get_worker_pool()
+        if pool is not None and batfish_concurrency > pool.size:
+            print(f"Batfish concurrency limited to the {pool.size} query workers")
+            batfish_concurrency = pool.size
+        llm = asyncio.Semaphore(llm_concurrency)
+        batfish = asyncio.Semaphore(batfish_concurrency)
+        runs = {}
+        statuses = Counter()
+
+        async def execute(entry):
+            queued = time.perf_counter()
+            timings = {}
+            async with batfish:
+                turn = time.perf_counter() - queued
+                df = await run_code(entry, binding, timings)
+                return df, turn + timings["wait_s"], timings["run_s"]
+
+        async def answer(item):
+            start = time.perf_counter()
+            record = dict.fromkeys(FIELDS)
+            record.update(item, shared=False)
+            try:
+                async with llm:
+                    key, entry = await generate_run(chain, item["question"], model)
+                record["generate_s"] = time.perf_counter() - start
+
+                if entry is None:
+                    record["status"] = "invalid_code"
+                else:
+                    source = entry.source.strip()
+                    record["code"] = source
+                    record["shared"] = source in runs
+                    if not record["shared"]:
+                        runs[source] = asyncio.ensure_future(execute(entry))
+                    df, record["wait_s"], record["run_s"] = await runs[source]
+                    await run_blocking(code_cache.update, key, entry, df)
+                    if df is None:
+                        record["status"] = "error"
+                        record["error"] = "The generated code failed"
+                    elif df.empty:
+                        record["status"] = "empty"
+                    else:
+                        record["status"] = "ok"
+                    if df is not None:
+                        record["rows"] = len(df)
+                        record["columns"] = [str(c) for c in df.columns]
+                        record["result"] = df.head(max_rows).to_json(orient="records", default_handler=str)
+            except Exception as e:
+                # One failing question must not stop the others.
+                print(f"Question {item['id']} failed: {e}")
+                record["status"] = "error"
+                record["error"] = f"{type(e).__name__}: {e}"
+
+            record["total_s"] = time.perf_counter() - start
+            statuses[record["status"]] += 1
+            writer.write(record)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(answer(item) for item in questions))
+        print(
+            f"{len(questions)} questions, {len(runs)} distinct queries in "
+            f"{time.perf_counter() - start:.1f} s: {dict(statuses)}"
+        )
+        return statuses
+    finally:
+        session_manager.release(f"batch-{os.getpid()}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Answer a file of questions on a network snapshot.")
+    parser.add_argument("snapshot", help="Zip file of the network snapshot")
+    parser.add_argument("questions", help="Questions, one per line (.txt) or JSON lines (.jsonl)")
+    parser.add_argument("--output", default="results.jsonl", help="Output file, .jsonl or .parquet")
+    parser.add_argument("--model", default="gpt-4o")
+    parser.add_argument("--llm-concurrency", type=int, default=BATCH_LLM_CONCURRENCY)
+    parser.add_argument(
+        "--batfish-concurrency", type=int, default=BATCH_BATFISH_CONCURRENCY,
+        help="Concurrent Batfish queries, at most QUERY_PROCESSES when queries run in worker processes",
+    )
+    parser.add_argument("--max-rows", type=int, default=1000, help="Result rows kept per question")
+    args = parser.parse_args(argv)
+
+    questions = load_questions(args.questions)
+    writer = open_writer(args.output)
+    try:
+        statuses = asyncio.run(run_batch(
+            args.snapshot, questions, writer, model=args.model,
+            llm_concurrency=args.llm_concurrency,
+            batfish_concurrency=args.batfish_concurrency,
+            max_rows=args.max_rows,
+        ))
+    finally:
+        writer.close()
+    return 0 if statuses["ok"] + statuses["empty"] == len(questions) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
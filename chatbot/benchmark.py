@@ -0,0 +1,620 @@
+# benchmark.py
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# 2024 Amar Abane
+
+# Description: This file is part of the AskBatfish project which interacts with
+# Batfish using LLMs.
+
+
+# Offline benchmark of the chat pipeline on the bundled networks/*.zip.
+#
+#   python benchmark.py --output results.json
+#   python benchmark.py --baseline results.json
+#   python benchmark.py --record     # needs Batfish and an OpenAI key
+#
+# Batfish answers and LLM responses are replayed from benchmarks/recordings.
+# Without a recording, Batfish questions get synthetic frames built from the
+# snapshot's node names and the LLM gets canned responses, so every stage
+# runs without any service.
+
+from collections import Counter
+import argparse
+import asyncio
+import functools
+import glob
+import hashlib
+import json
+import os
+import pickle
+import platform
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+RECORDINGS_DIR = os.path.join(HERE, "benchmarks", "recordings")
+NETWORKS_DIR = os.path.join(HERE, "..", "networks")
+
+WORKLOAD = {
+    "process_query": [
+        "Retrieve all routing tables.",
+        "Retrieve all Layer 3 links in the network.",
+        "List the properties of BGP peers.",
+        "Retrieve configuration parameters for all OSPF areas.",
+        "Identify nodes with defined but unused structures.",
+        "Compare the BGP session status and the OSPF areas of all border routers.",
+    ],
+    "analyze_df": [
+        "count routes per node",
+        "show rows where protocol is bgp",
+        "top 5 by metric",
+        "Which node has the most default routes?",
+    ],
+}
+
+
+class Recordings:
+    """Recorded Batfish answers and LLM responses, one pickle per key."""
+
+    def __init__(self, directory=RECORDINGS_DIR, record=False):
+        self.directory = directory
+        self.record = record
+        # Lookups per kind, to tell a replayed run from a synthetic one.
+        self.replayed = Counter()
+        self.missing = Counter()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(*parts):
+        text = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha256(text.encode()).hexdigest()[:24]
+
+    def _path(self, kind, key):
+        return os.path.join(self.directory, kind, f"{key}.pkl")
+
+    def get(self, kind, key):
+        try:
+            with open(self._path(kind, key), 'rb') as file:
+                value = pickle.load(file)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            value = None
+        with self._lock:
+            (self.missing if value is None else self.replayed)[kind] += 1
+        return value
+
+    def put(self, kind, key, value):
+        os.makedirs(os.path.join(self.directory, kind), exist_ok=True)
+        with open(self._path(kind, key), 'wb') as file:
+            pickle.dump(value, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def snapshot_nodes(manifest):
+    """Node names of a snapshot, from the file names of its manifest."""
+    nodes = set()
+    for name in manifest:
+        parts = name.split("/")
+        if parts[0] in ("configs", "hosts") and len(parts) == 2:
+            nodes.add(os.path.splitext(parts[1])[0])
+        elif parts[0] == "sonic_configs" and len(parts) == 3:
+            nodes.add(parts[1])
+    return sorted(nodes)
+
+
+def synthetic_frame(question, nodes):
+    """Stand-in answer with the columns the pipeline reads, a few rows per node."""
+    import pandas as pd
+
+    if question == "nodeProperties":
+        return pd.DataFrame({
+            "Node": nodes,
+            "Interfaces": [[f"eth{i}" for i in range(4)] for _ in nodes],
+        })
+    if question == "interfaceProperties":
+        return pd.DataFrame({
+            "Interface": [f"{n}[eth{i}]" for n in nodes for i in range(4)],
+            "Primary_Address": [f"10.{j}.{i}.1/24" for j, _ in enumerate(nodes) for i in range(4)],
+        })
+    if question == "fileParseStatus":
+        return pd.DataFrame({
+            "File_Name": [f"configs/{n}.cfg" for n in nodes],
+            "Status": "PASSED",
+            "File_Format": "CISCO_IOS",
+            "Nodes": [[n] for n in nodes],
+        })
+    if question == "initIssues":
+        return pd.DataFrame(columns=["Nodes", "Source_Lines", "Type", "Details", "Line_Text", "Parser_Context"])
+    if question == "routes":
+        rows = [
+            (n, "default", f"10.{i}.{k}.0/24", "bgp" if k % 2 else "connected", k * 10, 20 if k % 2 else 0)
+            for i, n in enumerate(nodes) for k in range(20)
+        ]
+        return pd.DataFrame(rows, columns=["Node", "VRF", "Network", "Protocol", "Metric", "Admin_Distance"])
+    return pd.DataFrame({"Node": nodes})
+
+
+class ReplayAnswer:
+    def __init__(self, df):
+        self._df = df
+
+    def frame(self):
+        return self._df.copy(deep=False)
+
+
+class ReplayQuestion:
+    def __init__(self, session, name, params):
+        self._session = session
+        self._name = name
+        self._params = params
+
+    def answer(self, snapshot=None, reference_snapshot=None, **kwargs):
+        session = self._session
+        snapshot = session.get_snapshot(snapshot)
+        key = Recordings.key(snapshot, reference_snapshot, self._name, self._params, kwargs)
+        df = session.recordings.get("batfish", key)
+        if df is None and session.live is not None:
+            live = session.sync()
+            question = getattr(live.q, self._name)(**self._params)
+            df = question.answer(snapshot=snapshot, reference_snapshot=reference_snapshot, **kwargs).frame()
+            session.recordings.put("batfish", key, df)
+        if df is None:
+            df = synthetic_frame(self._name, session.server.nodes(session.network, snapshot))
+        return ReplayAnswer(df)
+
+
+class ReplayQuestions:
+    def __init__(self, session):
+        self._session = session
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        def make_question(**params):
+            return ReplayQuestion(self._session, name, params)
+
+        return make_question
+
+
+class ReplayServer:
+    """Snapshots known to the stand-in Batfish, shared by its sessions.
+
+    With `path`, the snapshots are also kept in that JSON file, for the
+    sessions of the query worker processes.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.snapshots = {}
+
+    def _save(self):
+        if self.path is not None:
+            with open(self.path, 'w') as file:
+                json.dump([[n, s, nodes] for (n, s), nodes in self.snapshots.items()], file)
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as file:
+                self.snapshots = {(n, s): nodes for n, s, nodes in json.load(file)}
+        except (OSError, ValueError):
+            pass
+
+    def nodes(self, network, snapshot):
+        if self.path is not None and (network, snapshot) not in self.snapshots:
+            self._load()
+        return self.snapshots.get((network, snapshot), [])
+
+    def add(self, network, snapshot, nodes):
+        self.snapshots[(network, snapshot)] = nodes
+        self._save()
+
+    def remove(self, network, snapshot):
+        self.snapshots.pop((network, snapshot), None)
+        self._save()
+
+
+class ReplaySession:
+    """Stand-in for a pybatfish Session answering from recordings.
+
+    With `live`, a real Session, snapshot operations are mirrored to it and
+    answers missing from the recordings are fetched from it and recorded.
+    """
+
+    def __init__(self, server, recordings, live=None):
+        self.server = server
+        self.recordings = recordings
+        self.live = live
+        self.network = None
+        self.snapshot = None
+        self.q = ReplayQuestions(self)
+
+    def sync(self):
+        self.live.network = self.network
+        self.live.snapshot = self.snapshot
+        return self.live
+
+    def set_network(self, name=None):
+        self.network = name
+        if self.live is not None:
+            self.live.set_network(name)
+        return name
+
+    def get_snapshot(self, snapshot=None):
+        return snapshot or self.snapshot
+
+    def set_snapshot(self, name=None, index=None):
+        self.snapshot = name
+        return name
+
+    def list_snapshots(self, verbose=False):
+        return [s for (n, s) in self.server.snapshots if n == self.network]
+
+    def delete_snapshot(self, name):
+        self.server.remove(self.network, name)
+        if self.live is not None:
+            self.sync().delete_snapshot(name)
+
+    def init_snapshot(self, upload, name=None, overwrite=False, **kwargs):
+        from snapshot import snapshot_manifest
+
+        self.server.add(self.network, name, snapshot_nodes(snapshot_manifest(upload)))
+        if self.live is not None:
+            self.sync().init_snapshot(upload, name=name, overwrite=overwrite, **kwargs)
+        self.snapshot = name
+        return name
+
+    def fork_snapshot(self, base_name, name=None, overwrite=False, add_files=None, **kwargs):
+        from snapshot import snapshot_manifest
+
+        nodes = set(self.server.nodes(self.network, base_name))
+        if add_files is not None:
+            nodes.update(snapshot_nodes(snapshot_manifest(add_files)))
+        self.server.add(self.network, name, sorted(nodes))
+        if self.live is not None:
+            self.sync().fork_snapshot(base_name, name=name, overwrite=overwrite, add_files=add_files, **kwargs)
+        return name
+
+
+def _run_source(invocation):
+    return f"""def run():
+    {invocation}
+    if isinstance(answer, pd.DataFrame):
+        return answer
+    return answer.frame()"""
+
+
+def _canned_response(prompt):
+    """LLM response used when nothing was recorded for a prompt."""
+    if "Function template" in prompt:
+        # Text-to-code: run the first example invocation of the prompt.
+        invocations = re.findall(r"^Invocation: (.+)$", prompt, re.M)
+        invocations = invocations or ["answer = bf.q.routes().answer().frame()"]
+        if "independent questions" in prompt:
+            # Planner: one question per example for a task with "and".
+            task = re.findall(r"^Input task: (.+)$", prompt, re.M)[-1]
+            count = 2 if " and " in task else 1
+            return "\n\n".join(
+                f"Question: {task} (part {i + 1})\n{_run_source(invocation)}"
+                for i, invocation in enumerate(invocations[:count])
+            )
+        return _run_source(invocations[0])
+    if "minimal information" in prompt:
+        return "OK"
+    return "Replayed response."
+
+
+def replay_chat_model(recordings, live_factory=None):
+    """Factory standing in for ChatOpenAI that replays recorded responses."""
+    from langchain_core.language_models.chat_models import BaseChatModel
+    from langchain_core.messages import AIMessage
+    from langchain_core.outputs import ChatGeneration, ChatResult
+
+    class ReplayChatModel(BaseChatModel):
+        model_name: str = "gpt-4o"
+        live: object = None
+
+        @property
+        def _llm_type(self):
+            return "replay"
+
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+            prompt = "\n".join(str(m.content) for m in messages)
+            key = Recordings.key(self.model_name, prompt)
+            text = recordings.get("llm", key)
+            if text is None and self.live is not None:
+                text = self.live.invoke(messages).content
+                recordings.put("llm", key, text)
+            if text is None:
+                text = _canned_response(prompt)
+            return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    def factory(model_name="gpt-4o", **kwargs):
+        live = live_factory(model_name=model_name, **kwargs) if live_factory else None
+        return ReplayChatModel(model_name=model_name, live=live)
+
+    return factory
+
+
+def replay_pandasai_chat(recordings, live=None):
+    """Stand-in for app._pandasai_chat that replays recorded answers."""
+
+    def chat(df, question, model):
+        key = Recordings.key(list(map(str, df.columns)), len(df), question)
+        result = recordings.get("pandasai", key)
+        if result is None and live is not None:
+            result = live(df, question, model)
+            recordings.put("pandasai", key, result)
+        if result is None:
+            result = df.head()
+        return result
+
+    return chat
+
+
+class Stats:
+    """Latency and allocation samples per stage."""
+
+    def __init__(self, allocations=True):
+        self.allocations = allocations
+        self.samples = {}
+        self.failures = []
+
+    async def measure(self, stage, awaitable):
+        if self.allocations:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        result = await awaitable
+        elapsed = time.perf_counter() - start
+        alloc = tracemalloc.get_traced_memory()[1] - before if self.allocations else None
+        self.samples.setdefault(stage, []).append((elapsed, alloc))
+        return result
+
+    def summary(self):
+        import numpy as np
+
+        stages = {}
+        for stage, samples in self.samples.items():
+            ms = np.array([s[0] for s in samples]) * 1000
+            entry = {
+                "n": len(samples),
+                "mean_ms": round(float(ms.mean()), 3),
+                "p50_ms": round(float(np.percentile(ms, 50)), 3),
+                "p90_ms": round(float(np.percentile(ms, 90)), 3),
+                "p99_ms": round(float(np.percentile(ms, 99)), 3),
+            }
+            if self.allocations:
+                kb = np.array([s[1] for s in samples]) / 1024
+                entry["alloc_peak_kb_p50"] = round(float(np.percentile(kb, 50)), 1)
+                entry["alloc_peak_kb_max"] = round(float(kb.max()), 1)
+            stages[stage] = entry
+        return stages
+
+
+def replay_worker_session(directory, record, server_path, host):
+    """Session factory of the query workers, replaying like the server's sessions."""
+    # Imported by name: the classes of the worker's __main__ would not
+    # unpickle in the server.
+    import benchmark
+
+    live = None
+    if record:
+        from pybatfish.client.session import Session
+        live = Session(host=host)
+    recordings = benchmark.Recordings(directory, record=record)
+    return benchmark.ReplaySession(benchmark.ReplayServer(server_path), recordings, live)
+
+
+def patch_services(recordings):
+    """Point the app at the recorded stand-ins for Batfish and the LLMs."""
+    import app
+    import gateway
+    import sessions
+    import workers
+
+    live_llm = live_chat = None
+    if recordings.record:
+        from langchain_openai import ChatOpenAI
+        live_llm, live_chat = ChatOpenAI, app._pandasai_chat
+    gateway.ChatOpenAI = replay_chat_model(recordings, live_llm)
+    gateway.reset()
+    app._pandasai_chat = replay_pandasai_chat(recordings, live_chat)
+
+    server = ReplayServer(os.path.join(tempfile.mkdtemp(prefix="askbatfish-bench-"), "snapshots.json"))
+    workers.session_factory = functools.partial(
+        replay_worker_session, recordings.directory, recordings.record, server.path
+    )
+
+    class ReplayPool(sessions.SessionPool):
+        def _new_session(self):
+            live = None
+            if recordings.record:
+                from pybatfish.client.session import Session
+                live = Session(host=self.host)
+            return ReplaySession(server, recordings, live)
+
+    sessions.session_manager.pool = ReplayPool()
+    return app
+
+
+async def bench_network(app, zip_path, stats, iterations, cold, profile):
+    import chainlit as cl
+    from chainlit.context import init_http_context
+    from answer_cache import answer_cache
+    from code_cache import code_cache
+    from query import SESSION_QUERY_LIMIT
+
+    network = os.path.splitext(os.path.basename(zip_path))[0]
+
+    async def stage(awaitable, label):
+        return await awaitable
+
+    for _ in range(iterations):
+        if cold:
+            answer_cache.clear()
+            code_cache.clear()
+        context = init_http_context()
+        context.session.chat_profile = profile
+        cl.user_session.set("tasks", set())
+        cl.user_session.set("query_limit", asyncio.Semaphore(SESSION_QUERY_LIMIT))
+
+        async def startup():
+            status, examples = await app.prepare_session(zip_path, stage)
+            return await status, await examples
+
+        await stats.measure(f"{network}/startup", startup())
+
+        binding = app.current_binding()
+        parse_status = app.answer_frame(binding, "fileParseStatus")
+        init_issues = app.answer_frame(binding, "initIssues")
+        await stats.measure(
+            f"{network}/generate_parsing_status",
+            app.generate_parsing_status(parse_status, init_issues),
+        )
+
+        for task in WORKLOAD["process_query"]:
+            await stats.measure(f"{network}/process_query", app.process_query.ainvoke({"task": task}))
+
+        routes = app.answer_frame(binding, "routes")
+        stats.failures.extend(check_budget(f"{network}/compact_frame", routes))
+        handle = app._store_result(routes, "routes")
+        for question in WORKLOAD["analyze_df"]:
+            await stats.measure(
+                f"{network}/analyze_df",
+                app.analyze_df.ainvoke({"handle": handle, "question": question}),
+            )
+
+        await asyncio.gather(*cl.user_session.get("tasks"), return_exceptions=True)
+        app.session_manager.release(cl.user_session.get("id"))
+
+
+def check_budget(stage, df):
+    """Compacted outputs that exceed their token budget, down to tiny budgets."""
+    from compaction import COMPACT_TOKEN_BUDGET, compact_frame, count_tokens
+
+    failures = []
+    for budget in (COMPACT_TOKEN_BUDGET, COMPACT_TOKEN_BUDGET // 4, 40):
+        tokens = count_tokens(compact_frame(df, budget, handle="00000000"))
+        if tokens > budget:
+            failures.append(f"{stage}: {tokens} tokens for a budget of {budget}")
+    return failures
+
+
+def compare(results, baseline, tolerance):
+    """Print the p50 change of every stage; returns the regressed stages."""
+    regressions = []
+    print(f"{'stage':50} {'baseline p50':>14} {'p50':>10} {'change':>8}")
+    for stage, entry in sorted(results["stages"].items()):
+        base = baseline["stages"].get(stage)
+        if base is None or not base["p50_ms"]:
+            print(f"{stage:50} {'-':>14} {entry['p50_ms']:>10.2f}")
+            continue
+        change = entry["p50_ms"] / base["p50_ms"] - 1
+        flag = " REGRESSION" if change > tolerance else ""
+        print(f"{stage:50} {base['p50_ms']:>14.2f} {entry['p50_ms']:>10.2f} {change:>+8.0%}{flag}")
+        if flag:
+            regressions.append(stage)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark of the AskBatfish pipeline.")
+    parser.add_argument("--networks", nargs="*", help="Snapshot zips (default: networks/*.zip)")
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--cold", action="store_true", help="Clear the answer and code caches before every iteration")
+    parser.add_argument("--profile", default="Basic", help="Chat profile used for the session")
+    parser.add_argument("--processes", type=int, help="Query worker processes (default: QUERY_PROCESSES, as the app; 0 runs queries in-process)")
+    parser.add_argument("--recordings", default=RECORDINGS_DIR)
+    parser.add_argument("--record", action="store_true", help="Record missing answers from live Batfish and OpenAI")
+    parser.add_argument("--no-allocations", action="store_true", help="Do not trace allocations (lower overhead)")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--baseline", help="Compare with results saved by --output")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed p50 slowdown before a regression is reported")
+    args = parser.parse_args(argv)
+
+    if not args.record:
+        # Replay must not reach OpenAI, even for embeddings.
+        os.environ.setdefault("EMBEDDINGS_BACKEND", "local")
+        os.environ.setdefault("OPENAI_API_KEY", "replay")
+    os.environ.setdefault("METRICS_PORT", "0")
+    if args.processes is not None:
+        os.environ["QUERY_PROCESSES"] = str(args.processes)
+    networks = [os.path.abspath(n) for n in args.networks or glob.glob(os.path.join(NETWORKS_DIR, "*.zip"))]
+    recordings = Recordings(os.path.abspath(args.recordings), record=args.record)
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+    # The app reads .env and bf_questions.json from its own directory.
+    os.chdir(HERE)
+    sys.path.insert(0, HERE)
+
+    app = patch_services(recordings)
+    from workers import QUERY_PROCESSES
+    stats = Stats(allocations=not args.no_allocations)
+
+    if stats.allocations:
+        tracemalloc.start()
+    for zip_path in sorted(networks):
+        print(f"Benchmarking {zip_path}")
+        asyncio.run(bench_network(app, zip_path, stats, args.iterations, args.cold, args.profile))
+    if stats.allocations:
+        tracemalloc.stop()
+
+    results = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "iterations": args.iterations,
+            "cold": args.cold,
+            "profile": args.profile,
+            "query_processes": QUERY_PROCESSES,
+            "networks": [os.path.basename(n) for n in sorted(networks)],
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "replayed": dict(recordings.replayed),
+            "synthetic": {} if args.record else dict(recordings.missing),
+        },
+        "stages": stats.summary(),
+        "failures": stats.failures,
+    }
+    print(json.dumps(results, indent=2))
+    if results["meta"]["synthetic"]:
+        print(
+            "Warning: synthetic run. Lookups without a recording "
+            f"({', '.join(f'{n} {kind}' for kind, n in results['meta']['synthetic'].items())}) "
+            "got synthetic Batfish frames or canned LLM responses, so the compaction "
+            "and rendering numbers do not reflect real answers. Use --record to fill "
+            f"{recordings.directory}."
+        )
+    if output:
+        with open(output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if stats.failures:
+        print("Failed checks:\n" + "\n".join(stats.failures))
+        return 1
+    if baseline:
+        with open(baseline, 'r') as file:
+            baseline = json.load(file)
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,215 @@
+# code_cache.py
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# 2024 Amar Abane
+
+# Description: This file is part of the AskBatfish project which interacts with
+# Batfish using LLMs.
+
+
+from collections import OrderedDict
+import ast
+import os
+import re
+import threading
+import numpy as np
+from dotenv import load_dotenv
+
+from example_index import EXAMPLES_PATH, get_embeddings, index_digest
+
+
+load_dotenv(".env")
+
+CODE_CACHE_SIZE = int(os.getenv("CODE_CACHE_SIZE", "512"))
+# Cosine similarity above which a paraphrased task reuses cached code.
+# Unset disables paraphrase matching; only exact (normalized) matches hit.
+CODE_CACHE_SIMILARITY = os.getenv("CODE_CACHE_SIMILARITY")
+
+_VALUE_TOKEN = re.compile(r"'[^']*'|\"[^\"]*\"|[\w./:-]*\d[\w./:-]*|[\w-]+/[\w./-]+")
+
+
+def normalize_task(task):
+    task = " ".join(task.strip().lower().split())
+    return task.rstrip(" ?.!")
+
+
+def _values(task):
+    """Node names, addresses, prefixes and quoted strings mentioned in a task.
+
+    Two tasks only count as paraphrases when they mention the same values;
+    'routes on as1border1' and 'routes on as2border1' embed almost identically
+    but need different code.
+    """
+    return frozenset(v.strip("'\"") for v in _VALUE_TOKEN.findall(task))
+
+
+def validate_run(source):
+    """Compile generated source, checking that it defines a `run` function."""
+    tree = ast.parse(source, "<generated>", "exec")
+    if not any(isinstance(n, ast.FunctionDef) and n.name == "run" for n in tree.body):
+        raise ValueError("Generated code does not define run()")
+    return compile(tree, "<generated>", "exec")
+
+
+class CachedCode:
+    def __init__(self, source, code, vector=None):
+        self.source = source
+        self.code = code
+        self.vector = vector
+        # Cache key the entry is stored under; None until it is kept.
+        self.key = None
+
+
+class CodeKey:
+    def __init__(self, cache, task, model):
+        self.cache = cache
+        self.text = normalize_task(task)
+        self.model = model
+        self.values = _values(self.text)
+        self._vector = None
+
+    @property
+    def vector(self):
+        if self._vector is None:
+            v = np.array(self.cache.embeddings.embed_query(self.text), dtype=np.float32)
+            self._vector = v / (np.linalg.norm(v) or 1.0)
+        return self._vector
+
+
+class CodeCache:
+    """LRU cache from normalized task text to validated, compiled run() code.
+
+    Entries are tied to the model and to the content of bf_questions.json;
+    the cache empties itself when either changes. With a similarity
+    threshold, a task that misses exactly can still reuse the code of the
+    closest cached task mentioning the same values.
+    """
+
+    def __init__(self, size=CODE_CACHE_SIZE, similarity=CODE_CACHE_SIMILARITY,
+                 examples_path=EXAMPLES_PATH):
+        self.size = size
+        self.similarity = float(similarity) if similarity else None
+        self.examples_path = examples_path
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self._embeddings = None
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._stat = None
+        self._lock = threading.Lock()
+
+    @property
+    def embeddings(self):
+        if self._embeddings is None:
+            self._embeddings = get_embeddings()
+        return self._embeddings
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "similar_hits": self.similar_hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.similar_hits = self.misses = 0
+
+    def _version(self, model):
+        # Must be called with the lock held.
+        try:
+            st = os.stat(self.examples_path)
+            stat = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            stat = None
+        if stat != self._stat:
+            self._stat = stat
+            self._versions.clear()
+            self._entries.clear()
+        if model not in self._versions:
+            self._versions[model] = index_digest(self.examples_path, model)
+        return self._versions[model]
+
+    def key(self, task, model):
+        return CodeKey(self, task, model)
+
+    def get(self, key):
+        with self._lock:
+            version = self._version(key.model)
+            entry = self._entries.get((version, key.text))
+            if entry is not None:
+                self._entries.move_to_end((version, key.text))
+                self.hits += 1
+                return entry
+            candidates = [
+                (k, e) for k, e in self._entries.items()
+                if k[0] == version and e.vector is not None
+                and _values(k[1]) == key.values
+            ]
+        if self.similarity is not None and candidates:
+            matrix = np.stack([e.vector for _, e in candidates])
+            scores = matrix @ key.vector
+            best = int(scores.argmax())
+            if scores[best] >= self.similarity:
+                with self._lock:
+                    self.similar_hits += 1
+                    if candidates[best][0] in self._entries:
+                        self._entries.move_to_end(candidates[best][0])
+                return candidates[best][1]
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def prepare(self, key, source):
+        """Validate and compile `source` into an entry for `key`, not yet kept.
+
+        Raises SyntaxError or ValueError if the source is not a usable run().
+        """
+        code = validate_run(source)
+        vector = key.vector if self.similarity is not None else None
+        return CachedCode(source, code, vector)
+
+    def put(self, key, entry):
+        with self._lock:
+            version = self._version(key.model)
+            entry.key = (version, key.text)
+            self._entries[entry.key] = entry
+            self._entries.move_to_end(entry.key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return entry
+
+    def discard(self, entry):
+        """Evict `entry` from wherever it was matched, exactly or as a paraphrase."""
+        with self._lock:
+            if entry.key is not None and self._entries.get(entry.key) is entry:
+                del self._entries[entry.key]
+            entry.key = None
+
+    def update(self, key, entry, result):
+        """Record the outcome of running `entry` for `key`.
+
+        `result` is the returned frame, or None if the code failed. Code that
+        failed is evicted; new code is kept once its frame is non-empty.
+        """
+        if result is None:
+            self.discard(entry)
+        elif not result.empty and entry.key is None:
+            self.put(key, entry)
+
+code_cache = CodeCache()
@@ -0,0 +1,435 @@
+# columnar.py
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# 2024 Amar Abane
+
+# Description: This file is part of the AskBatfish project which interacts with
+# Batfish using LLMs.
+
+
+# Compact columnar form of Batfish answer frames.
+#
+# Answer frames hold one Python object per cell: node and VRF names repeated
+# on every row, Interface and NextHop objects. A ColumnarFrame keeps
+# repeated strings as categoricals, the pybatfish datamodel objects as one
+# column per field and lists as one column of all their items, and turns
+# back into the same frame.
+
+from functools import lru_cache
+import importlib
+import json
+import pickle
+import pkgutil
+import numpy as np
+import pandas as pd
+
+from compaction import datamodel_types
+
+
+# Strings are dictionary-encoded when there are at most this many distinct
+# values per row.
+CATEGORY_RATIO = 0.5
+# Rows decoded to check that flattened objects are rebuilt identically.
+_CHECK_ROWS = 20
+
+_META_KEY = b"askbatfish.columnar"
+
+
+@lru_cache(maxsize=1)
+def datamodel_classes():
+    """Map datamodel type names to (class, {field: init argument}).
+
+    Only the attrs classes whose fields are exactly those described in
+    datamodel.json, and can all be passed to the constructor, are listed;
+    objects of other classes are kept as they are.
+    """
+    try:
+        import attr
+        import pybatfish.datamodel as datamodel
+    except ImportError:
+        return {}
+
+    classes = {}
+    for module in pkgutil.iter_modules(datamodel.__path__):
+        try:
+            mod = importlib.import_module(f"{datamodel.__name__}.{module.name}")
+        except ImportError:
+            continue
+        for name, value in vars(mod).items():
+            if isinstance(value, type) and value.__module__ == mod.__name__:
+                classes[name] = value
+
+    result = {}
+    for name, fields in datamodel_types().items():
+        cls = classes.get(name)
+        if cls is None or not attr.has(cls):
+            continue
+        attributes = attr.fields(cls)
+        if {a.name for a in attributes} != set(fields) or not all(a.init for a in attributes):
+            continue
+        result[name] = (cls, {a.name: getattr(a, "alias", None) or a.name.lstrip("_") for a in attributes})
+    return result
+
+
+def _missing_is_none(values, missing):
+    return all(v is None for v in values[missing])
+
+
+def _encode(values, lists=True):
+    """Encode one column, given as a Series; returns a column spec.
+
+    A spec is a dict with a `kind`:
+      raw        a column without Python objects, kept as it is
+      category   strings and None, as a pandas Categorical
+      string     other strings and None, as an Arrow string array
+      int        Python ints and None, as a nullable Int64 array
+      bool       Python bools and None, as a nullable boolean array
+      list       lists of one type (pybatfish's ListWrapper) and None: the
+                 offsets of each row and one encoded column of all the
+                 items; lists of lists are kept as objects
+      objects    datamodel objects and None: the type name of each row as a
+                 category column, and one encoded column per field
+      object     anything else, as an object array
+    """
+    if values.dtype != object:
+        return {"kind": "raw", "data": values.reset_index(drop=True)}
+    array = values.to_numpy()
+    missing = pd.isna(values).to_numpy()
+    if not _missing_is_none(array, missing):
+        return {"kind": "object", "data": array}
+    present = array[~missing]
+    kinds = {type(v) for v in present}
+
+    spec = None
+    if kinds == {str}:
+        categorical = pd.Categorical(array)
+        if len(categorical.categories) <= CATEGORY_RATIO * len(array):
+            return {"kind": "category", "data": categorical}
+        try:
+            import pyarrow as pa
+        except ImportError:
+            return {"kind": "object", "data": array}
+        return {"kind": "string", "data": pa.array(array, pa.string())}
+    elif kinds == {int}:
+        return {"kind": "int", "data": pd.array(array, dtype="Int64")}
+    elif kinds == {bool}:
+        return {"kind": "bool", "data": pd.array(array, dtype="boolean")}
+    elif lists and len(kinds) == 1 and issubclass(next(iter(kinds)), list):
+        spec = _encode_lists(array, missing, next(iter(kinds)))
+    elif kinds and all(k.__name__ in datamodel_classes() for k in kinds):
+        spec = _encode_objects(array, missing, kinds, lists)
+    if spec is not None:
+        check = min(len(array), _CHECK_ROWS)
+        if all(type(a) is type(b) and a == b for a, b in zip(_decode(spec, 0, check), array[:check])):
+            return spec
+    return {"kind": "object", "data": array}
+
+
+def _encode_lists(array, missing, container):
+    lengths = np.array([0 if m else len(v) for v, m in zip(array, missing)], dtype=np.int64)
+    items = pd.Series([item for v in array[~missing] for item in v], dtype=object)
+    return {
+        "kind": "list",
+        "container": container,
+        "offsets": np.concatenate([[0], np.cumsum(lengths)]),
+        "missing": missing,
+        "items": _encode(items, lists=False),
+    }
+
+
+def _encode_objects(array, missing, kinds, lists=True):
+    classes = datamodel_classes()
+    names = [k.__name__ for k in kinds]
+    fields = list(dict.fromkeys(f for name in names for f in classes[name][1]))
+    types = np.array([None if m else type(v).__name__ for v, m in zip(array, missing)], dtype=object)
+    columns = {}
+    for field in fields:
+        column = pd.Series([getattr(v, field, None) for v in array], dtype=object)
+        columns[field] = _encode(column, lists)
+    return {
+        "kind": "objects",
+        "types": {"kind": "category", "data": pd.Categorical(types)},
+        "fields": columns,
+    }
+
+
+def _decode(spec, start, stop):
+    """Values of rows [start, stop) of an encoded column."""
+    kind = spec["kind"]
+    data = spec.get("data")
+    if kind == "raw":
+        return data.iloc[start:stop].to_numpy()
+    if kind == "category":
+        codes = data.codes[start:stop]
+        categories = np.asarray(data.categories, dtype=object)
+        out = np.empty(len(codes), dtype=object)
+        out[codes >= 0] = categories[codes[codes >= 0]]
+        return out
+    if kind in ("int", "bool"):
+        part = data[start:stop]
+        out = np.empty(len(part), dtype=object)
+        mask = part.isna()
+        out[~mask] = part[~mask].to_numpy(dtype="int64" if kind == "int" else bool).tolist()
+        return out
+    if kind == "string":
+        out = np.empty(max(0, min(stop, len(data)) - start), dtype=object)
+        out[:] = data.slice(start, len(out)).to_pylist()
+        return out
+    if kind == "object":
+        return data[start:stop]
+    if kind == "list":
+        offsets = spec["offsets"]
+        stop = min(stop, len(offsets) - 1)
+        start = min(start, stop)
+        base = offsets[start]
+        items = _decode(spec["items"], base, offsets[stop])
+        container = spec["container"]
+        out = np.empty(stop - start, dtype=object)
+        for i in range(start, stop):
+            if not spec["missing"][i]:
+                out[i - start] = container(items[offsets[i] - base:offsets[i + 1] - base].tolist())
+        return out
+
+    classes = datamodel_classes()
+    types = _decode(spec["types"], start, stop)
+    fields = {field: _decode(s, start, stop) for field, s in spec["fields"].items()}
+    out = np.empty(len(types), dtype=object)
+    for i, name in enumerate(types):
+        if name is not None:
+            cls, arguments = classes[name]
+            out[i] = cls(**{arg: fields[field][i] for field, arg in arguments.items()})
+    return out
+
+
+def _nbytes(spec):
+    kind = spec["kind"]
+    if kind == "objects":
+        return _nbytes(spec["types"]) + sum(_nbytes(s) for s in spec["fields"].values())
+    if kind == "list":
+        return int(spec["offsets"].nbytes + spec["missing"].nbytes) + _nbytes(spec["items"])
+    data = spec["data"]
+    if kind == "raw":
+        return int(data.memory_usage(index=False, deep=True))
+    if kind == "category":
+        return int(data.codes.nbytes + data.categories.memory_usage(deep=True))
+    if kind in ("int", "bool", "string"):
+        return int(data.nbytes)
+    # Object arrays: the pointers, plus the objects measured on a sample.
+    sample = data[:100]
+    per_row = pd.Series(sample, dtype=object).memory_usage(index=False, deep=True) / max(len(sample), 1)
+    return int(per_row * len(data))
+
+
+class ColumnarFrame:
+    """Compact, read-only form of a DataFrame; `decode` rebuilds it.
+
+    Rows can be decoded by range and column, so that a page of a large
+    result is rebuilt without the rest. `write_arrow` and `read_arrow` store
+    it as a memory-mappable Arrow IPC file.
+    """
+
+    def __init__(self, names, specs, length, index=None):
+        self.names = names
+        self.specs = specs
+        self.length = length
+        self.index = index
+
+    @classmethod
+    def encode(cls, df):
+        index = df.index
+        if isinstance(index, pd.RangeIndex) and index.start == 0 and index.step == 1:
+            index = None
+        specs = [_encode(df.iloc[:, j]) for j in range(df.shape[1])]
+        return cls(list(df.columns), specs, len(df), index)
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def columns(self):
+        return pd.Index(self.names)
+
+    @property
+    def nbytes(self):
+        index = 0 if self.index is None else int(self.index.memory_usage(deep=True))
+        return index + sum(_nbytes(spec) for spec in self.specs)
+
+    def decode(self, start=0, stop=None, columns=None):
+        """The frame, or its rows [start, stop) and the given columns."""
+        stop = self.length if stop is None else min(stop, self.length)
+        start = min(start, stop)
+        positions = range(len(self.names)) if columns is None else [
+            self.names.index(c) for c in columns
+        ]
+        index = (
+            pd.RangeIndex(start, stop) if self.index is None else self.index[start:stop]
+        )
+        data = {}
+        for j in positions:
+            spec = self.specs[j]
+            if spec["kind"] == "raw":
+                data[j] = spec["data"].iloc[start:stop].set_axis(index)
+            else:
+                data[j] = pd.Series(_decode(spec, start, stop), index=index, dtype=object)
+        df = pd.DataFrame(data, index=index)
+        df.columns = [self.names[j] for j in positions]
+        return df
+
+    def write_arrow(self, path, metadata=None):
+        """Write an Arrow IPC file; `metadata` maps str keys to bytes."""
+        import pyarrow as pa
+
+        arrays, names = [], []
+        schema_metadata = {}
+
+        def flatten(spec, name, offsets=None):
+            # List items are stored as Arrow lists, one per row, so that all
+            # the columns have the same length.
+            kind = spec["kind"]
+            if kind == "objects":
+                return {
+                    "kind": kind,
+                    "types": flatten(spec["types"], f"{name}#type", offsets),
+                    "fields": {f: flatten(s, f"{name}.{f}", offsets) for f, s in spec["fields"].items()},
+                }
+            if kind == "list":
+                container = spec["container"]
+                arrays.append(pa.array(np.diff(spec["offsets"]), mask=spec["missing"]))
+                names.append(name)
+                return {
+                    "kind": kind,
+                    "column": name,
+                    "container": f"{container.__module__}:{container.__qualname__}",
+                    "items": flatten(spec["items"], f"{name}[]", spec["offsets"]),
+                }
+            data = spec["data"]
+            entry = {"kind": kind, "column": name}
+            if kind == "raw" and not isinstance(data.dtype, np.dtype):
+                # Extension dtypes are rare in answers: keep the whole column.
+                key = f"askbatfish.raw.{name}"
+                schema_metadata[key.encode()] = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+                entry["metadata"] = key
+                return entry
+            if kind == "raw":
+                array = pa.array(data.to_numpy())
+                entry["dtype"] = data.dtype.str
+            elif kind == "category":
+                codes = np.asarray(data.codes, dtype=np.int32)
+                array = pa.DictionaryArray.from_arrays(
+                    pa.array(codes, mask=codes < 0),
+                    pa.array(np.asarray(data.categories, dtype=object), pa.string()),
+                )
+            elif kind == "int":
+                array = pa.array(data.to_numpy(dtype="int64", na_value=0), mask=data.isna())
+            elif kind == "bool":
+                array = pa.array(data.to_numpy(dtype=bool, na_value=False), mask=data.isna())
+            elif kind == "string":
+                array = data
+            elif all(v is None or type(v) is str for v in data):
+                array = pa.array(data, pa.string())
+                entry["encoding"] = "string"
+            else:
+                array = pa.array(
+                    [None if v is None else pickle.dumps(v, protocol=pickle.HIGHEST_PROTOCOL) for v in data],
+                    pa.binary(),
+                )
+                entry["encoding"] = "pickle"
+            if offsets is not None:
+                array = pa.LargeListArray.from_arrays(pa.array(offsets, pa.int64()), array)
+                entry["items"] = True
+            arrays.append(array)
+            names.append(name)
+            return entry
+
+        layout = [flatten(spec, str(j)) for j, spec in enumerate(self.specs)]
+        meta = {
+            "names": [str(n) for n in self.names],
+            "length": self.length,
+            "layout": layout,
+        }
+        schema_metadata[_META_KEY] = json.dumps(meta).encode()
+        if self.index is not None:
+            schema_metadata[b"askbatfish.index"] = pickle.dumps(self.index, protocol=pickle.HIGHEST_PROTOCOL)
+        for key, value in (metadata or {}).items():
+            schema_metadata[key.encode()] = value
+        table = pa.Table.from_arrays(arrays, names=names).replace_schema_metadata(schema_metadata)
+        with pa.OSFile(path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+    @classmethod
+    def read_arrow(cls, path):
+        """Read a file written by `write_arrow`; returns (frame, metadata)."""
+        import pyarrow as pa
+
+        with pa.memory_map(path, 'r') as source:
+            table = pa.ipc.open_file(source).read_all()
+        schema_metadata = dict(table.schema.metadata or {})
+        meta = json.loads(schema_metadata.pop(_META_KEY))
+        index = schema_metadata.pop(b"askbatfish.index", None)
+
+        def rebuild(entry):
+            kind = entry["kind"]
+            if kind == "objects":
+                return {
+                    "kind": kind,
+                    "types": rebuild(entry["types"]),
+                    "fields": {f: rebuild(e) for f, e in entry["fields"].items()},
+                }
+            if "metadata" in entry:
+                return {"kind": kind, "data": pickle.loads(schema_metadata.pop(entry["metadata"].encode()))}
+            array = table.column(entry["column"]).combine_chunks()
+            if kind == "list":
+                module, _, name = entry["container"].partition(":")
+                container = importlib.import_module(module)
+                for part in name.split("."):
+                    container = getattr(container, part)
+                lengths = array.fill_null(0).to_numpy(zero_copy_only=False).astype(np.int64)
+                return {
+                    "kind": kind,
+                    "container": container,
+                    "offsets": np.concatenate([[0], np.cumsum(lengths)]),
+                    "missing": array.is_null().to_numpy(zero_copy_only=False),
+                    "items": rebuild(entry["items"]),
+                }
+            if entry.get("items"):
+                array = array.flatten()
+            if kind == "raw":
+                data = pd.Series(array.to_numpy(zero_copy_only=False).astype(np.dtype(entry["dtype"])))
+            elif kind == "category":
+                codes = array.indices.fill_null(-1).to_numpy(zero_copy_only=False)
+                data = pd.Categorical.from_codes(codes, categories=array.dictionary.to_pylist())
+            elif kind == "string":
+                data = array
+            elif kind == "int":
+                data = pd.arrays.IntegerArray(
+                    array.fill_null(0).to_numpy(zero_copy_only=False).astype("int64"),
+                    array.is_null().to_numpy(zero_copy_only=False),
+                )
+            elif kind == "bool":
+                data = pd.arrays.BooleanArray(
+                    array.fill_null(False).to_numpy(zero_copy_only=False).astype(bool),
+                    array.is_null().to_numpy(zero_copy_only=False),
+                )
+            elif entry.get("encoding") == "string":
+                data = np.array(array.to_pylist(), dtype=object)
+            else:
+                data = np.empty(len(array), dtype=object)
+                data[:] = [None if v is None else pickle.loads(v) for v in array.to_pylist()]
+            return {"kind": kind, "data": data}
+
+        specs = [rebuild(entry) for entry in meta["layout"]]
+        frame = cls(meta["names"], specs, meta["length"], pickle.loads(index) if index else None)
+        metadata = {key.decode(): value for key, value in schema_metadata.items()}
+        return frame, metadata
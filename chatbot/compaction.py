@@ -0,0 +1,249 @@
+# compaction.py
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# 2024 Amar Abane
+
+# Description: This file is part of the AskBatfish project which interacts with
+# Batfish using LLMs.
+
+
+from collections import Counter
+from functools import lru_cache
+import json
+import os
+import numpy as np
+import tiktoken
+from dotenv import load_dotenv
+
+
+load_dotenv(".env")
+
+COMPACT_TOKEN_BUDGET = int(os.getenv("COMPACT_TOKEN_BUDGET", "1500"))
+DATAMODEL_PATH = os.getenv("DATAMODEL_PATH")
+
+LIST_ITEMS = 3
+MAX_CELL_CHARS = 80
+INTERN_MIN_CHARS = 6
+
+
+def _datamodel_candidates():
+    if DATAMODEL_PATH:
+        return [DATAMODEL_PATH]
+    here = os.path.dirname(os.path.abspath(__file__))
+    return [
+        os.path.join(here, "pybatfish_docs", "datamodel.json"),
+        os.path.join(here, "..", "pybatfish_docs", "datamodel.json"),
+    ]
+
+
+@lru_cache(maxsize=1)
+def datamodel_types():
+    """Map pybatfish datamodel type names to their fields and field types."""
+    for path in _datamodel_candidates():
+        try:
+            with open(path, 'r') as file:
+                categories = json.load(file)
+        except (OSError, ValueError):
+            continue
+        return {
+            name: fields
+            for types in categories.values()
+            for name, fields in types.items()
+        }
+    print("Datamodel description not found, using str() for Batfish objects")
+    return {}
+
+
+@lru_cache(maxsize=1)
+def load_datamodel():
+    """Map pybatfish datamodel type names to the fields worth showing.
+
+    Fields with a constant default (the `type` discriminator of NextHop* and
+    friends) carry no information and are left out.
+    """
+    return {
+        name: [f for f, t in fields.items() if "=" not in t]
+        for name, fields in datamodel_types().items()
+    }
+
+
+@lru_cache(maxsize=8)
+def _encoding(model):
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # tiktoken downloads its BPE files on first use; offline, estimate.
+        print(f"Unable to load tiktoken encoding for {model}: {e}")
+        return None
+
+
+def count_tokens(text, model="gpt-4o"):
+    encoding = _encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def _type_name(value):
+    name = type(value).__name__
+    return name if name in load_datamodel() else None
+
+
+def _encode(value, fields=None):
+    if value is None:
+        return ""
+    if isinstance(value, (list, tuple)):
+        items = [_encode(v) for v in value[:LIST_ITEMS]]
+        if len(value) > LIST_ITEMS:
+            items.append(f"+{len(value) - LIST_ITEMS} more")
+        return "[" + "; ".join(items) + "]"
+    if fields is None and _type_name(value):
+        fields = load_datamodel()[_type_name(value)]
+    if fields:
+        text = ", ".join(_encode(getattr(value, f, None)) for f in fields)
+        return "{" + text + "}"
+    text = str(value).replace("\n", " ").replace("|", "/")
+    if len(text) > MAX_CELL_CHARS:
+        text = text[:MAX_CELL_CHARS - 3] + "..."
+    return text
+
+
+def _column_types(df):
+    """Datamodel type of each column, judged from its first non-null cells."""
+    types = {}
+    for col in df.columns:
+        sample = df[col].dropna().head(20)
+        names = {_type_name(v) for v in sample}
+        if len(names) == 1 and None not in names:
+            types[col] = names.pop()
+    return types
+
+
+def _totals(df, max_values=5, max_unique=20):
+    """Value counts of the low-cardinality columns of the full frame."""
+    lines = []
+    for col in df.columns:
+        try:
+            counts = df[col].value_counts(dropna=True)
+        except TypeError:
+            continue
+        if len(counts) < 2 or len(counts) > max_unique:
+            continue
+        shown = ", ".join(f"{_encode(v)}={n}" for v, n in counts.head(max_values).items())
+        extra = f", +{len(counts) - max_values} values" if len(counts) > max_values else ""
+        lines.append(f"{col}: {shown}{extra}")
+    return lines
+
+
+def _render(df, positions, types):
+    fields = {col: load_datamodel()[t] for col, t in types.items()}
+    rows = [
+        [_encode(df.iat[p, j], fields.get(col)) for j, col in enumerate(df.columns)]
+        for p in positions
+    ]
+
+    # Intern repeated long values (node names, VRFs, interfaces) as @n.
+    counts = Counter(v for row in rows for v in row if len(v) >= INTERN_MIN_CHARS)
+    codes = {}
+    for value, n in counts.most_common():
+        if n < 2:
+            break
+        code = f"@{len(codes) + 1}"
+        if len(code) < len(value):
+            codes[value] = code
+
+    header = [
+        f"{col}:{types[col]}{{{', '.join(fields[col])}}}" if col in types else str(col)
+        for col in df.columns
+    ]
+    lines = ["#|" + "|".join(header)]
+    for p, row in zip(positions, rows):
+        lines.append(f"{p}|" + "|".join(codes.get(v, v) for v in row))
+    if codes:
+        legend = ", ".join(f"{code}={value}" for value, code in codes.items())
+        lines.insert(0, f"Legend: {legend}")
+    return "\n".join(lines)
+
+
+def _truncate(text, budget, model):
+    """Cut `text` to at most `budget` tokens, marking the cut."""
+    marker = "\n[truncated]"
+    budget = max(0, budget - count_tokens(marker, model))
+    encoding = _encoding(model)
+    if encoding is None:
+        # Same estimate as count_tokens.
+        return text[:max(0, (budget - 1) * 4)] + marker
+    tokens = encoding.encode(text, disallowed_special=())
+    return encoding.decode(tokens[:budget]) + marker
+
+
+def _sample(n, k):
+    if k >= n:
+        return list(range(n))
+    return sorted(set(np.linspace(0, n - 1, k).round().astype(int).tolist()))
+
+
+def compact_frame(df, budget=COMPACT_TOKEN_BUDGET, handle=None, model="gpt-4o"):
+    """Encode a Batfish answer frame for the agent within `budget` tokens.
+
+    Rows are pipe-separated without padding, prefixed with their position in
+    the full frame. Batfish objects are written as their datamodel fields,
+    long lists are cut, and repeated values are interned in a legend. When
+    all rows do not fit, an evenly spaced sample is shown together with value
+    counts computed on the full frame, as many of them as fit. The result
+    never exceeds `budget` tokens: if even the header does not fit, it is
+    cut.
+    """
+    n = len(df)
+    summary = f"{n} rows x {len(df.columns)} columns."
+    if handle is not None:
+        summary += f" Full result handle: {handle}."
+    types = _column_types(df)
+
+    text = f"{summary}\n{_render(df, range(n), types)}" if n <= 200 else None
+    if text is not None and count_tokens(text, model) <= budget:
+        return text
+
+    totals = _totals(df)
+
+    def attempt(k):
+        positions = _sample(n, k)
+        parts = [f"{summary} Showing {len(positions)} sampled rows."]
+        if totals:
+            parts.append("Totals: " + "; ".join(totals))
+        parts.append(_render(df, positions, types))
+        return "\n".join(parts)
+
+    # Without any row, drop value counts until the rest fits.
+    while totals and count_tokens(attempt(0), model) > budget:
+        totals.pop()
+
+    # Estimate the row cost, then search for the largest sample that fits.
+    probe = attempt(min(n, 10))
+    per_row = max(1, count_tokens(probe, model) // max(1, min(n, 10)))
+    lo, hi = 0, min(n, 2 * budget // per_row + 1)
+    best = attempt(0)
+    while lo <= hi:
+        k = (lo + hi) // 2
+        candidate = attempt(k)
+        if count_tokens(candidate, model) <= budget:
+            best, lo = candidate, k + 1
+        else:
+            hi = k - 1
+    if count_tokens(best, model) > budget:
+        best = _truncate(best, budget, model)
+    return best
@@ -0,0 +1,369 @@
+# docs_index.py
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# 2024 Amar Abane
+
+# Description: This file is part of the AskBatfish project which interacts with
+# Batfish using LLMs.
+
+
+# Retrieval over pybatfish_docs, used to ground code generation.
+#
+# The docs are split into chunks at their question and section headings.
+# Chunks are ranked by a BM25 inverted index combined with the cosine
+# similarity of their embeddings; both are saved as .npy files under
+# EXAMPLE_INDEX_DIR and memory-mapped by the server.
+
+import glob
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+import numpy as np
+from dotenv import load_dotenv
+
+from compaction import count_tokens
+from example_index import (
+    EXAMPLE_INDEX_DIR, _normalize, embed_queries, embedding_model_name, get_embeddings,
+)
+from metrics import span
+
+
+load_dotenv(".env")
+
+DOCS_PATH = os.getenv("DOCS_PATH")
+DOCS_TOKEN_BUDGET = int(os.getenv("DOCS_TOKEN_BUDGET", "600"))
+DOCS_TOP_K = int(os.getenv("DOCS_TOP_K", "3"))
+
+# Bump when the chunking changes, to rebuild saved indexes.
+_VERSION = "1"
+CHUNK_TOKENS = 300
+DENSE_WEIGHT = 0.5
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "for", "from", "how", "i",
+    "in", "is", "it", "of", "on", "or", "that", "the", "this", "to", "what", "which",
+    "with", "all", "show", "get", "list", "me", "my", "return", "find",
+}
+
+_lock = threading.Lock()
+_indexes = {}
+
+
+def _docs_dir():
+    if DOCS_PATH:
+        return DOCS_PATH
+    here = os.path.dirname(os.path.abspath(__file__))
+    for path in (os.path.join(here, "pybatfish_docs"), os.path.join(here, "..", "pybatfish_docs")):
+        if os.path.isdir(path):
+            return path
+    return None
+
+
+def _doc_files(directory):
+    files = sorted(glob.glob(os.path.join(directory, "*", "*.md")))
+    files += [
+        path for path in (
+            os.path.join(directory, "datamodel.md"),
+            os.path.join(directory, "fb_questions.json"),
+        ) if os.path.exists(path)
+    ]
+    return files
+
+
+def terms(text):
+    """Lowercase words of `text`, plus the parts of camelCase words."""
+    result = []
+    for word in re.findall(r"[A-Za-z0-9]+", text):
+        lower = word.lower()
+        if lower not in _STOPWORDS:
+            result.append(lower)
+        parts = re.findall(r"[A-Z]?[a-z]+|[A-Z]+(?![a-z])|\d+", word)
+        if len(parts) > 1:
+            result.extend(p.lower() for p in parts if p.lower() not in _STOPWORDS)
+    return result
+
+
+def _split(text, limit=CHUNK_TOKENS):
+    """Split `text` at blank lines, then lines, into pieces of about `limit` tokens."""
+    pieces, current, size = [], [], 0
+    units = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        if count_tokens(paragraph) > limit:
+            units.extend(paragraph.split("\n"))
+        else:
+            units.append(paragraph)
+    for unit in units:
+        tokens = count_tokens(unit)
+        if current and size + tokens > limit:
+            pieces.append("\n\n".join(current))
+            current, size = [], 0
+        current.append(unit)
+        size += tokens
+    if current:
+        pieces.append("\n\n".join(current))
+    return pieces
+
+
+def _clean(markdown):
+    # Notebook outputs: rendered frames and indented text results.
+    markdown = re.sub(r"<div>.*?</div>", "", markdown, flags=re.S)
+    lines = [line for line in markdown.split("\n") if not line.startswith(("    ", "<"))]
+    markdown = "\n".join(lines)
+    # Cells that only display a result or select the example snapshot.
+    markdown = re.sub(
+        r"(Print the first .*\n\s*)?```python\s*"
+        r"(result\.head\(\d*\)|result\.iloc\[\d+\]|bf\.set_(network|snapshot)\([^)]*\))?\s*```",
+        "", markdown,
+    )
+    return re.sub(r"\n{3,}", "\n\n", markdown).strip()
+
+
+def markdown_chunks(text, source):
+    """Chunks of a notebook exported to Markdown, one per section.
+
+    Headings down to level 5 (a question in the basic docs) start a new
+    section; each chunk starts with the path of headings it belongs to.
+    """
+    chunks = []
+    path = {}
+    body = []
+    fenced = False
+
+    def flush():
+        content = _clean("\n".join(body))
+        if path and content:
+            title = " > ".join(path[level] for level in sorted(path))
+            for piece in _split(content):
+                chunks.append({"source": source, "title": title, "text": f"{title}\n\n{piece}"})
+        body.clear()
+
+    for line in text.split("\n"):
+        if line.startswith("```"):
+            fenced = not fenced
+        heading = None if fenced else re.match(r"(#{1,5}) (.+)", line)
+        if heading:
+            flush()
+            level = len(heading.group(1))
+            path = {k: v for k, v in path.items() if k < level}
+            path[level] = heading.group(2).strip()
+        else:
+            body.append(line)
+    flush()
+    return chunks
+
+
+def question_chunks(questions, source):
+    """Chunks of fb_questions.json, grouping the questions of a category."""
+    chunks = []
+    for category, entry in questions.items():
+        title = f"Questions on {category}"
+        text = "\n\n".join(
+            f"Question: {q['question']}\nInvocation: {q['invocation']}"
+            for q in entry.get("questions", [])
+        )
+        for piece in _split(text):
+            chunks.append({"source": source, "title": title, "text": f"{title}\n\n{piece}"})
+    return chunks
+
+
+def load_chunks(directory):
+    chunks = []
+    for path in _doc_files(directory):
+        source = os.path.relpath(path, directory)
+        with open(path, 'r') as file:
+            if path.endswith(".json"):
+                chunks.extend(question_chunks(json.load(file), source))
+            else:
+                chunks.extend(markdown_chunks(file.read(), source))
+    for chunk in chunks:
+        chunk["tokens"] = count_tokens(chunk["text"])
+    return chunks
+
+
+def docs_digest(directory, model):
+    h = hashlib.sha256()
+    h.update(f"{_VERSION}:{model}".encode())
+    for path in _doc_files(directory):
+        h.update(os.path.relpath(path, directory).encode())
+        with open(path, 'rb') as file:
+            h.update(file.read())
+    return h.hexdigest()[:16]
+
+
+class DocsIndex:
+    """Doc chunks with a BM25 inverted index and normalized embeddings.
+
+    The postings are in CSR form: the chunks containing term t are
+    `postings[indptr[t]:indptr[t + 1]]`, with their precomputed BM25
+    weights at the same positions of `weights`.
+    """
+
+    _ARRAYS = ("matrix", "indptr", "postings", "weights")
+
+    def __init__(self, chunks, vocabulary, matrix, indptr, postings, weights):
+        self.chunks = chunks
+        self.vocabulary = vocabulary
+        self.matrix = matrix
+        self.indptr = indptr
+        self.postings = postings
+        self.weights = weights
+
+    @classmethod
+    def build(cls, chunks, embeddings):
+        counts = [{} for _ in chunks]
+        lengths = np.zeros(len(chunks), dtype=np.float32)
+        for i, chunk in enumerate(chunks):
+            words = terms(chunk["text"])
+            lengths[i] = len(words)
+            for word in words:
+                counts[i][word] = counts[i].get(word, 0) + 1
+        vocabulary = {}
+        by_term = []
+        for i, tf in enumerate(counts):
+            for word, n in tf.items():
+                t = vocabulary.setdefault(word, len(vocabulary))
+                if t == len(by_term):
+                    by_term.append([])
+                by_term[t].append((i, n))
+
+        average = float(lengths.mean()) if len(chunks) else 0.0
+        indptr = np.zeros(len(by_term) + 1, dtype=np.int64)
+        postings, weights = [], []
+        for t, entries in enumerate(by_term):
+            idf = math.log(1 + (len(chunks) - len(entries) + 0.5) / (len(entries) + 0.5))
+            for i, n in entries:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[i] / average)
+                postings.append(i)
+                weights.append(idf * n * (BM25_K1 + 1) / (n + norm))
+            indptr[t + 1] = len(postings)
+
+        vectors = embeddings.embed_documents([chunk["text"] for chunk in chunks])
+        return cls(
+            chunks, vocabulary,
+            _normalize(np.array(vectors, dtype=np.float32)),
+            indptr, np.array(postings, dtype=np.int32), np.array(weights, dtype=np.float32),
+        )
+
+    @classmethod
+    def load(cls, directory, digest):
+        with open(os.path.join(directory, f"{digest}.docs.json"), 'r') as file:
+            data = json.load(file)
+        arrays = [
+            np.load(os.path.join(directory, f"{digest}.docs.{name}.npy"), mmap_mode="r")
+            for name in cls._ARRAYS
+        ]
+        vocabulary = {word: t for t, word in enumerate(data["vocabulary"])}
+        return cls(data["chunks"], vocabulary, *arrays)
+
+    def save(self, directory, digest):
+        os.makedirs(directory, exist_ok=True)
+        # The .json file is written last: its presence means a complete index.
+        tmp = os.path.join(directory, f".{digest}.{os.getpid()}")
+        for name in self._ARRAYS:
+            np.save(f"{tmp}.{name}.npy", np.asarray(getattr(self, name)))
+            os.replace(f"{tmp}.{name}.npy", os.path.join(directory, f"{digest}.docs.{name}.npy"))
+        with open(tmp + ".json", 'w') as file:
+            json.dump({"chunks": self.chunks, "vocabulary": list(self.vocabulary)}, file)
+        os.replace(tmp + ".json", os.path.join(directory, f"{digest}.docs.json"))
+
+    def bm25(self, query):
+        scores = np.zeros(len(self.chunks), dtype=np.float32)
+        for word in set(terms(query)):
+            t = self.vocabulary.get(word)
+            if t is not None:
+                start, end = self.indptr[t], self.indptr[t + 1]
+                scores[self.postings[start:end]] += self.weights[start:end]
+        return scores
+
+    def search(self, query, vector=None, dense_weight=DENSE_WEIGHT):
+        """Chunk indices ordered by decreasing relevance to `query`.
+
+        Chunks matching no query term are left out when there is no
+        `vector`; otherwise both scores are scaled to [0, 1] and mixed.
+        """
+        scores = self.bm25(query)
+        top = scores.max() if len(scores) else 0.0
+        if top > 0:
+            scores /= top
+        if vector is not None:
+            dense = self.matrix @ _normalize(np.array([vector], dtype=np.float32))[0]
+            low, high = dense.min(), dense.max()
+            if high > low:
+                dense = (dense - low) / (high - low)
+            scores = (1 - dense_weight) * scores + dense_weight * dense
+        elif top <= 0:
+            return np.empty(0, dtype=np.int64)
+        return np.argsort(-scores, kind="stable")
+
+
+def get_docs_index(embeddings=None):
+    """Return the docs index shared by the process, or None without docs.
+
+    As for the example index, it is built once per content digest and
+    saved under EXAMPLE_INDEX_DIR, normally at image build time.
+    """
+    directory = _docs_dir()
+    if directory is None:
+        return None, None
+    embeddings = embeddings or get_embeddings()
+    model = embedding_model_name(embeddings)
+    with _lock:
+        # The docs do not change while the server runs: hash them once.
+        if (directory, model) not in _indexes:
+            digest = docs_digest(directory, model)
+            try:
+                index = DocsIndex.load(EXAMPLE_INDEX_DIR, digest)
+            except FileNotFoundError:
+                chunks = load_chunks(directory)
+                print(f"Building docs index {digest} ({len(chunks)} chunks)")
+                try:
+                    index = DocsIndex.build(chunks, embeddings)
+                    index.save(EXAMPLE_INDEX_DIR, digest)
+                except Exception as e:
+                    # Retrieval only adds context; generation works without it.
+                    print(f"Unable to build the docs index: {e}")
+                    index = None
+            _indexes[(directory, model)] = index
+        return _indexes[(directory, model)], embeddings
+
+
+def docs_context(question, budget=DOCS_TOKEN_BUDGET, k=DOCS_TOP_K):
+    """The most relevant doc chunks for `question`, within `budget` tokens."""
+    if budget <= 0 or k <= 0:
+        return ""
+    index, embeddings = get_docs_index()
+    if index is None:
+        return ""
+    with span("docs_retrieval") as s:
+        try:
+            vector = embed_queries(embeddings, [question])[0]
+        except Exception as e:
+            print(f"Unable to embed the question, using BM25 only: {e}")
+            vector = None
+        picked, used = [], 0
+        for i in index.search(question, vector):
+            tokens = index.chunks[i]["tokens"]
+            if used + tokens > budget:
+                continue
+            picked.append(index.chunks[i]["text"])
+            used += tokens
+            if len(picked) == k or budget - used < 50:
+                break
+        s.set(rows=len(picked), tokens=used)
+    return "\n\n---\n\n".join(picked)
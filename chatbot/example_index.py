@@ -0,0 +1,244 @@
+# example_index.py
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# 2024 Amar Abane
+
+# Description: This file is part of the AskBatfish project which interacts with
+# Batfish using LLMs.
+
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.example_selectors.base import BaseExampleSelector
+
+from collections import OrderedDict
+from typing import Dict, List
+import hashlib
+import json
+import os
+import re
+import threading
+import numpy as np
+from dotenv import load_dotenv
+
+from metrics import span
+
+
+load_dotenv(".env")
+
+EXAMPLES_PATH = os.getenv("EXAMPLES_PATH", "bf_questions.json")
+EXAMPLE_INDEX_DIR = os.getenv("EXAMPLE_INDEX_DIR", ".index")
+EMBEDDINGS_BACKEND = os.getenv("EMBEDDINGS_BACKEND", "openai")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-ada-002")
+
+_lock = threading.Lock()
+_indexes = {}
+
+_QUERY_CACHE_SIZE = 256
+_query_vectors = OrderedDict()
+_query_lock = threading.Lock()
+
+
+class LocalHashEmbeddings(Embeddings):
+    """Deterministic bag-of-words embedder that needs no network.
+
+    Words and character trigrams are hashed into a fixed number of buckets.
+    It is only meant for tests and offline runs, not for production quality.
+    """
+
+    def __init__(self, dim=256):
+        self.dim = dim
+
+    def _embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in re.findall(r"[a-z0-9]+", text.lower()):
+            features = [word] + [word[i:i + 3] for i in range(len(word) - 2)]
+            for feature in features:
+                digest = hashlib.md5(feature.encode()).digest()
+                vector[int.from_bytes(digest[:4], "little") % self.dim] += 1.0
+        return vector.tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+def get_embeddings(backend=EMBEDDINGS_BACKEND):
+    if backend == "local":
+        return LocalHashEmbeddings()
+    from gateway import embeddings
+    return embeddings(EMBEDDING_MODEL)
+
+
+def embedding_model_name(embeddings):
+    if isinstance(embeddings, LocalHashEmbeddings):
+        return f"local-hash-{embeddings.dim}"
+    return getattr(embeddings, "model", EMBEDDING_MODEL)
+
+
+def embed_queries(embeddings, texts):
+    """Embed `texts`, reusing the vectors of recently embedded queries.
+
+    The example selector and the docs index embed the same task; only the
+    first of them pays for the embedding.
+    """
+    model = embedding_model_name(embeddings)
+    with _query_lock:
+        vectors = [_query_vectors.get((model, text)) for text in texts]
+    missing = [text for text, vector in zip(texts, vectors) if vector is None]
+    if missing:
+        computed = dict(zip(missing, embeddings.embed_documents(missing)))
+        with _query_lock:
+            for text, vector in computed.items():
+                _query_vectors[(model, text)] = vector
+                while len(_query_vectors) > _QUERY_CACHE_SIZE:
+                    _query_vectors.popitem(last=False)
+        vectors = [computed[text] if vector is None else vector for text, vector in zip(texts, vectors)]
+    return vectors
+
+
+def load_examples(path=EXAMPLES_PATH):
+    try:
+        with open(path, 'r') as file:
+            return json.loads(file.read())
+    except FileNotFoundError:
+        print(f"File not found: {path}")
+        return []
+
+
+def index_digest(path=EXAMPLES_PATH, model=EMBEDDING_MODEL):
+    """Hash of the examples file content and the embedding model.
+
+    Any change to either produces a new digest, hence a new index.
+    """
+    h = hashlib.sha256()
+    h.update(model.encode())
+    try:
+        with open(path, 'rb') as file:
+            h.update(file.read())
+    except FileNotFoundError:
+        pass
+    return h.hexdigest()[:16]
+
+
+def _normalize(matrix):
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class ExampleIndex:
+    """Examples and their L2-normalized embeddings as one (n, d) matrix."""
+
+    def __init__(self, examples, matrix):
+        self.examples = examples
+        self.matrix = matrix
+
+    @classmethod
+    def build(cls, examples, embeddings):
+        vectors = embeddings.embed_documents([e["question"] for e in examples])
+        return cls(examples, _normalize(np.array(vectors, dtype=np.float32)))
+
+    @classmethod
+    def load(cls, directory, digest):
+        """Load an index saved by `save`, memory-mapping the embeddings."""
+        with open(os.path.join(directory, f"{digest}.json"), 'r') as file:
+            examples = json.load(file)
+        matrix = np.load(os.path.join(directory, f"{digest}.npy"), mmap_mode="r")
+        return cls(examples, matrix)
+
+    def save(self, directory, digest):
+        os.makedirs(directory, exist_ok=True)
+        # Write to temporary names first so that concurrent loaders never
+        # observe a half-written index.
+        tmp = os.path.join(directory, f".{digest}.{os.getpid()}")
+        np.save(tmp + ".npy", np.asarray(self.matrix))
+        with open(tmp + ".json", 'w') as file:
+            json.dump(self.examples, file)
+        os.replace(tmp + ".npy", os.path.join(directory, f"{digest}.npy"))
+        os.replace(tmp + ".json", os.path.join(directory, f"{digest}.json"))
+
+    def add(self, example, vector):
+        self.examples = self.examples + [example]
+        self.matrix = np.vstack([self.matrix, _normalize(np.array([vector]))])
+
+    def top_k(self, queries, k):
+        """Return the indices of the k most similar examples for each query.
+
+        `queries` is a (m, d) matrix; the result is a (m, k) array ordered by
+        decreasing cosine similarity.
+        """
+        k = min(k, len(self.examples))
+        if k == 0:
+            return np.empty((len(queries), 0), dtype=np.int64)
+        scores = _normalize(queries) @ self.matrix.T
+        best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        order = np.take_along_axis(scores, best, axis=1).argsort(axis=1)[:, ::-1]
+        return np.take_along_axis(best, order, axis=1)
+
+
+class VectorExampleSelector(BaseExampleSelector):
+    """In-process replacement for SemanticSimilarityExampleSelector."""
+
+    def __init__(self, index, embeddings, k=3, input_keys=("question",)):
+        self.index = index
+        self.embeddings = embeddings
+        self.k = k
+        self.input_keys = list(input_keys)
+
+    def _text(self, input_variables):
+        return " ".join(str(input_variables[key]) for key in self.input_keys)
+
+    def add_example(self, example: Dict[str, str]) -> None:
+        self.index.add(example, self.embeddings.embed_query(self._text(example)))
+
+    def select_examples(self, input_variables: Dict[str, str]) -> List[dict]:
+        return self.select_examples_batch([input_variables])[0]
+
+    def select_examples_batch(self, inputs: List[Dict[str, str]]) -> List[List[dict]]:
+        with span("example_selection", rows=len(inputs)):
+            vectors = embed_queries(self.embeddings, [self._text(i) for i in inputs])
+            best = self.index.top_k(np.array(vectors, dtype=np.float32), self.k)
+        return [[dict(self.index.examples[i]) for i in row] for row in best]
+
+
+def get_example_index(path=EXAMPLES_PATH, embeddings=None):
+    """Return the example index shared by all chains and sessions.
+
+    The examples are embedded once per content digest and saved under
+    EXAMPLE_INDEX_DIR; later processes memory-map the saved matrix until
+    `bf_questions.json` or the embedding model changes.
+    """
+    embeddings = embeddings or get_embeddings()
+    digest = index_digest(path, embedding_model_name(embeddings))
+    with _lock:
+        index = _indexes.get(digest)
+        if index is None:
+            try:
+                index = ExampleIndex.load(EXAMPLE_INDEX_DIR, digest)
+            except FileNotFoundError:
+                examples = load_examples(path)
+                print(f"Building example index {digest} ({len(examples)} examples)")
+                index = ExampleIndex.build(examples, embeddings)
+                index.save(EXAMPLE_INDEX_DIR, digest)
+            _indexes.clear()
+            _indexes[digest] = index
+    return index, embeddings
+
+
+def get_example_selector(k=3, path=EXAMPLES_PATH, embeddings=None):
+    index, embeddings = get_example_index(path, embeddings)
+    return VectorExampleSelector(index, embeddings, k=k, input_keys=["question"])
@@ -0,0 +1,93 @@
+# frames.py
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# 2024 Amar Abane
+
+# Description: This file is part of the AskBatfish project which interacts with
+# Batfish using LLMs.
+
+
+from collections import OrderedDict
+import os
+import threading
+import uuid
+from dotenv import load_dotenv
+
+from columnar import ColumnarFrame
+
+
+load_dotenv(".env")
+
+FRAME_STORE_MAX_BYTES = int(os.getenv("FRAME_STORE_MAX_BYTES", str(256 << 20)))
+FRAME_STORE_MAX_FRAMES = int(os.getenv("FRAME_STORE_MAX_FRAMES", "32"))
+
+
+class FrameStore:
+    """Per-session registry of result frames, addressed by short handles.
+
+    Tools exchange handles instead of serialized tables, so frames keep their
+    types and never travel through the LLM context. Frames are kept in
+    columnar form and rebuilt by `get`. The least recently used frames are
+    dropped once the store exceeds `max_bytes` or `max_frames`; the newest
+    frame is always kept.
+    """
+
+    def __init__(self, max_bytes=FRAME_STORE_MAX_BYTES, max_frames=FRAME_STORE_MAX_FRAMES):
+        self.max_bytes = max_bytes
+        self.max_frames = max_frames
+        self.nbytes = 0
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def __contains__(self, handle):
+        return handle in self._frames
+
+    def put(self, df, source=None):
+        handle = uuid.uuid4().hex[:8]
+        frame = ColumnarFrame.encode(df)
+        size = frame.nbytes
+        with self._lock:
+            self._frames[handle] = (frame, size, source)
+            self.nbytes += size
+            while len(self._frames) > 1 and (
+                self.nbytes > self.max_bytes or len(self._frames) > self.max_frames
+            ):
+                _, (_, old_size, _) = self._frames.popitem(last=False)
+                self.nbytes -= old_size
+        return handle
+
+    def frame(self, handle):
+        """The columnar form of a frame, to decode only some of its rows."""
+        with self._lock:
+            entry = self._frames.get(handle)
+            if entry is None:
+                return None
+            self._frames.move_to_end(handle)
+            return entry[0]
+
+    def get(self, handle):
+        frame = self.frame(handle)
+        return None if frame is None else frame.decode()
+
+    def source(self, handle):
+        """Task or operation that produced the frame, if recorded."""
+        entry = self._frames.get(handle)
+        return entry[2] if entry else None
+
+    def handles(self):
+        with self._lock:
+            return list(self._frames)
@@ -0,0 +1,482 @@
+# gateway.py
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# 2024 Amar Abane
+
+# Description: This file is part of the AskBatfish project which interacts with
+# Batfish using LLMs.
+
+
+# Process-wide gateway to the OpenAI API.
+#
+# Every chain, the agent and the embedders get their clients from here, so
+# that they share one connection pool, one limiter per model and one retry
+# policy. A burst of sessions then queues in the limiter instead of hitting
+# the API at once and collapsing into 429 retries.
+
+from concurrent.futures import Future
+from typing import Any, List
+import asyncio
+import hashlib
+import os
+import random
+import threading
+import time
+import httpx
+from dotenv import load_dotenv
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.load import dumps
+from langchain_core.outputs import ChatResult
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+
+from compaction import count_tokens
+from metrics import registry
+
+
+load_dotenv(".env")
+
+# Requests in flight per model.
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+# Tokens per minute per chat model; 0 disables the token limit.
+LLM_TOKENS_PER_MINUTE = int(os.getenv("LLM_TOKENS_PER_MINUTE", "200000"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "32"))
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+# Seconds an embedding waits for others to share its request.
+EMBEDDING_BATCH_DELAY = float(os.getenv("EMBEDDING_BATCH_DELAY", "0.01"))
+
+_BACKOFF = 1.0
+_MAX_BACKOFF = 30.0
+_POLL = 0.05
+_RETRIED = (408, 409, 429, 500, 502, 503, 504)
+
+_lock = threading.Lock()
+_limiters = {}
+_chat_models = {}
+_embeddings = {}
+_http = {}
+
+
+class RateLimiter:
+    """Concurrency and token-rate limit of one model.
+
+    At most `concurrency` requests run at once, and the tokens they use are
+    taken from a bucket refilled at `tokens_per_minute`. Requests are charged
+    their prompt estimate up front and the actual usage once they return.
+    `pause` holds every request back, e.g. after the API answered 429.
+    Works across threads and event loops.
+    """
+
+    def __init__(self, concurrency=LLM_MAX_CONCURRENCY, tokens_per_minute=LLM_TOKENS_PER_MINUTE):
+        self.concurrency = concurrency
+        self.capacity = tokens_per_minute
+        self.active = 0
+        self._tokens = float(tokens_per_minute)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _try_acquire(self, tokens):
+        """0 when the request may start, else the seconds to wait."""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            if self.active >= self.concurrency:
+                return _POLL
+            if self.capacity > 0:
+                rate = self.capacity / 60
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * rate)
+                self._updated = now
+                # A prompt larger than the bucket waits for a full bucket.
+                needed = min(tokens, self.capacity)
+                if self._tokens < needed:
+                    return (needed - self._tokens) / rate
+                self._tokens -= tokens
+            self.active += 1
+            return 0
+
+    def acquire(self, tokens=0):
+        wait = self._try_acquire(tokens)
+        while wait > 0:
+            time.sleep(min(wait, 1.0))
+            wait = self._try_acquire(tokens)
+
+    async def aacquire(self, tokens=0):
+        wait = self._try_acquire(tokens)
+        while wait > 0:
+            await asyncio.sleep(min(wait, 1.0))
+            wait = self._try_acquire(tokens)
+
+    def release(self, refund=0):
+        """End a request; `refund` is the estimate minus the tokens used."""
+        with self._lock:
+            self.active -= 1
+            if self.capacity > 0:
+                self._tokens = min(self.capacity, self._tokens + refund)
+
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+def limiter(model):
+    with _lock:
+        if model not in _limiters:
+            # Embedding calls are short and cheap: only their concurrency is limited.
+            tokens = 0 if model.startswith("text-embedding") else LLM_TOKENS_PER_MINUTE
+            _limiters[model] = RateLimiter(LLM_MAX_CONCURRENCY, tokens)
+        return _limiters[model]
+
+
+def _retry_delay(error, attempt):
+    """Seconds to wait before retrying after `error`, or None to give up."""
+    status = getattr(error, "status_code", None)
+    if status not in _RETRIED and not isinstance(error, httpx.TransportError):
+        if type(error).__name__ not in ("APIConnectionError", "APITimeoutError"):
+            return None
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return min(float(headers.get("retry-after")), _MAX_BACKOFF)
+    except (TypeError, ValueError):
+        return min(_BACKOFF * 2 ** attempt, _MAX_BACKOFF) * (0.5 + random.random() / 2)
+
+
+def _used_tokens(result):
+    usage = (getattr(result, "llm_output", None) or {}).get("token_usage") or {}
+    return usage.get("total_tokens")
+
+
+def _on_error(model, limits, error, attempt):
+    limits.release()
+    delay = _retry_delay(error, attempt)
+    if delay is None or attempt == LLM_MAX_RETRIES:
+        raise error
+    print(f"{model} request failed ({error}), retrying in {delay:.1f} s")
+    registry.count("askbatfish_llm_retries_total", model, 1)
+    # Every caller of the model waits, not only this one.
+    limits.pause(delay)
+
+
+def call(model, tokens, fn):
+    """Run the request `fn()` within the limits of `model`, with retries."""
+    limits = limiter(model)
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        limits.acquire(tokens)
+        try:
+            result = fn()
+        except Exception as e:
+            _on_error(model, limits, e, attempt)
+            continue
+        used = _used_tokens(result)
+        limits.release(tokens - used if used else 0)
+        return result
+
+
+async def acall(model, tokens, fn):
+    """Async `call`: `fn()` returns the awaitable of the request."""
+    limits = limiter(model)
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        await limits.aacquire(tokens)
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            limits.release()
+            raise
+        except Exception as e:
+            _on_error(model, limits, e, attempt)
+            continue
+        used = _used_tokens(result)
+        limits.release(tokens - used if used else 0)
+        return result
+
+
+class _Abandoned(Exception):
+    """The request was cancelled; the callers waiting for it run their own."""
+
+
+class SingleFlight:
+    """Runs identical concurrent requests once and gives all callers the result.
+
+    The first caller of a key runs the request; the others, in any thread or
+    event loop, wait for its outcome. Keys are forgotten as soon as the
+    request ends, so this is not a cache.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def _join(self, key):
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                return future, False
+            future = self._calls[key] = Future()
+            return future, True
+
+    def _finish(self, key, future, result=None, error=None):
+        with self._lock:
+            del self._calls[key]
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+
+    def do(self, key, fn):
+        """`(result, shared)`; `shared` is True if another caller ran it."""
+        while True:
+            future, leader = self._join(key)
+            if not leader:
+                try:
+                    return future.result(), True
+                except _Abandoned:
+                    continue
+            try:
+                result = fn()
+            except BaseException as e:
+                self._finish(key, future, error=e if isinstance(e, Exception) else _Abandoned())
+                raise
+            self._finish(key, future, result)
+            return result, False
+
+    async def ado(self, key, fn):
+        while True:
+            future, leader = self._join(key)
+            if not leader:
+                try:
+                    # Shielded: a cancelled follower must not cancel the leader.
+                    return await asyncio.shield(asyncio.wrap_future(future)), True
+                except _Abandoned:
+                    continue
+            try:
+                result = await fn()
+            except BaseException as e:
+                self._finish(key, future, error=e if isinstance(e, Exception) else _Abandoned())
+                raise
+            self._finish(key, future, result)
+            return result, False
+
+
+_flights = SingleFlight()
+
+
+def _prompt_tokens(model, messages):
+    return sum(count_tokens(str(m.content), model) for m in messages)
+
+
+class GatewayChatModel(BaseChatModel):
+    """Chat model sending its requests through the gateway.
+
+    Wraps the ChatOpenAI `client` shared by every user of the model.
+    Requests of non-streaming clients are coalesced with identical ones in
+    flight; the callers that share a result do not report its token usage.
+    """
+
+    client: Any = None
+    model_name: str = "gpt-4o"
+
+    @property
+    def _llm_type(self):
+        return "gateway"
+
+    @property
+    def _identifying_params(self):
+        return {"model_name": self.model_name, "streaming": self._streaming}
+
+    @property
+    def _streaming(self):
+        return bool(getattr(self.client, "streaming", False))
+
+    def _flight_key(self, messages, stop, kwargs):
+        payload = dumps([self.model_name, messages, stop, kwargs], sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    @staticmethod
+    def _result(result, shared):
+        if not shared:
+            return result
+        registry.count("askbatfish_llm_coalesced_total", "llm", 1)
+        # Own copies: langchain sets the run id on the returned messages.
+        return ChatResult(generations=[g.copy(deep=True) for g in result.generations])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        tokens = _prompt_tokens(self.model_name, messages)
+
+        def request():
+            return call(self.model_name, tokens, lambda: self.client._generate(
+                messages, stop=stop, run_manager=run_manager, **kwargs
+            ))
+
+        if self._streaming:
+            # Tokens are streamed to this caller's callbacks only.
+            return request()
+        return self._result(*_flights.do(self._flight_key(messages, stop, kwargs), request))
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        tokens = _prompt_tokens(self.model_name, messages)
+
+        def request():
+            return acall(self.model_name, tokens, lambda: self.client._agenerate(
+                messages, stop=stop, run_manager=run_manager, **kwargs
+            ))
+
+        if self._streaming:
+            return await request()
+        return self._result(*await _flights.ado(self._flight_key(messages, stop, kwargs), request))
+
+
+class _EmbeddingBatcher:
+    """Gathers the texts embedded within `delay` seconds into shared requests.
+
+    Identical texts waiting or in flight are embedded once.
+    """
+
+    def __init__(self, embed, size=EMBEDDING_BATCH_SIZE, delay=EMBEDDING_BATCH_DELAY):
+        self.embed = embed
+        self.size = max(1, size)
+        self.delay = delay
+        self._pending = {}
+        self._running = {}
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def submit(self, texts):
+        futures = []
+        with self._lock:
+            for text in texts:
+                future = self._pending.get(text) or self._running.get(text)
+                if future is None:
+                    future = self._pending[text] = Future()
+                futures.append(future)
+            full = len(self._pending) >= self.size
+            if not full and self._timer is None:
+                self._timer = threading.Timer(self.delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        while full:
+            # Large inputs (index builds) are sent right away.
+            full = self.flush(full_only=True)
+        return [future.result() for future in futures]
+
+    def _take(self, full_only):
+        with self._lock:
+            if full_only and len(self._pending) < self.size:
+                return None
+            texts = list(self._pending)[:self.size]
+            batch = {text: self._pending.pop(text) for text in texts}
+            self._running.update(batch)
+            if self._timer is not None and not self._pending:
+                self._timer.cancel()
+                self._timer = None
+            return batch
+
+    def flush(self, full_only=False):
+        """Send one batch; True if another full batch is waiting."""
+        if not full_only:
+            with self._lock:
+                self._timer = None
+        batch = self._take(full_only)
+        if batch:
+            try:
+                vectors = self.embed(list(batch))
+            except Exception as e:
+                vectors, error = None, e
+            else:
+                error = None
+            with self._lock:
+                for text in batch:
+                    del self._running[text]
+            for i, future in enumerate(batch.values()):
+                if error is None:
+                    future.set_result(vectors[i])
+                else:
+                    future.set_exception(error)
+        with self._lock:
+            waiting = len(self._pending)
+            if waiting and self._timer is None:
+                self._timer = threading.Timer(self.delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+            return waiting >= self.size
+
+
+class GatewayEmbeddings(Embeddings):
+    """Embedder batching the requests of all its callers through the gateway."""
+
+    def __init__(self, client, model):
+        self.client = client
+        self.model = model
+        self._batcher = _EmbeddingBatcher(self._embed)
+
+    def _embed(self, texts):
+        tokens = sum(len(text) // 4 + 1 for text in texts)
+        return call(self.model, tokens, lambda: self.client.embed_documents(texts))
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._batcher.submit(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._batcher.submit([text])[0]
+
+
+def _http_clients():
+    """Connection pools shared by every client."""
+    with _lock:
+        if not _http:
+            limits = httpx.Limits(
+                max_connections=LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_MAX_CONNECTIONS,
+            )
+            _http["sync"] = httpx.Client(limits=limits)
+            _http["async"] = httpx.AsyncClient(limits=limits)
+        return _http["sync"], _http["async"]
+
+
+def chat_model(model="gpt-4o", streaming=False):
+    """The process-wide chat model for `model`."""
+    key = (model, streaming)
+    with _lock:
+        if key in _chat_models:
+            return _chat_models[key]
+    http_client, http_async_client = _http_clients()
+    # Retries are done by the gateway, so that they honor the limiter.
+    client = ChatOpenAI(
+        model_name=model, temperature=0, streaming=streaming, max_retries=0,
+        http_client=http_client, http_async_client=http_async_client,
+    )
+    with _lock:
+        return _chat_models.setdefault(key, GatewayChatModel(client=client, model_name=model))
+
+
+def embeddings(model):
+    """The process-wide OpenAI embedder for `model`."""
+    with _lock:
+        if model in _embeddings:
+            return _embeddings[model]
+    http_client, http_async_client = _http_clients()
+    client = OpenAIEmbeddings(
+        model=model, max_retries=0,
+        http_client=http_client, http_async_client=http_async_client,
+    )
+    with _lock:
+        return _embeddings.setdefault(model, GatewayEmbeddings(client, model))
+
+
+def reset():
+    """Forget the clients, e.g. after replacing ChatOpenAI in the benchmark."""
+    with _lock:
+        _chat_models.clear()
+        _embeddings.clear()
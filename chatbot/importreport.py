@@ -0,0 +1,98 @@
+# importreport.py
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# 2024 Amar Abane
+
+# Description: This file is part of the AskBatfish project which interacts with
+# Batfish using LLMs.
+
+
+# Startup report: what the process imported, how long each top-level
+# package took, and the time to the first usable chat session.
+#
+# With IMPORT_REPORT set, importing this module first (as app.py does) starts
+# timing the imports.
+
+from collections import defaultdict
+import builtins
+import os
+import sys
+import threading
+import time
+from dotenv import load_dotenv
+
+
+load_dotenv(".env")
+
+# Number of packages listed in the report; 0, the default, disables it
+# and leaves the import machinery untouched.
+IMPORT_REPORT = int(os.getenv("IMPORT_REPORT", "0"))
+
+_started = time.perf_counter()
+_times = defaultdict(float)
+_local = threading.local()
+_import = builtins.__import__
+_ready = False
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if level or name in sys.modules:
+        return _import(name, globals, locals, fromlist, level)
+    # Stack of the time spent in nested imports, to report exclusive times.
+    stack = _local.__dict__.setdefault("stack", [])
+    stack.append(0.0)
+    start = time.perf_counter()
+    try:
+        return _import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.perf_counter() - start
+        nested = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        _times[name.partition(".")[0]] += elapsed - nested
+
+
+def install():
+    if IMPORT_REPORT > 0 and builtins.__import__ is _import:
+        builtins.__import__ = _timed_import
+
+
+def uninstall():
+    if builtins.__import__ is _timed_import:
+        builtins.__import__ = _import
+
+
+def report(limit=IMPORT_REPORT):
+    """Print the slowest top-level packages imported so far and stop timing."""
+    uninstall()
+    if limit <= 0:
+        return
+    total = sum(_times.values())
+    slowest = sorted(_times.items(), key=lambda item: -item[1])[:limit]
+    print(
+        f"Imported {len(_times)} packages in {total:.2f} s: "
+        + ", ".join(f"{name} {seconds:.2f} s" for name, seconds in slowest)
+    )
+
+
+def ready():
+    """Print the time from startup to the first usable session, once."""
+    global _ready
+    if _ready or IMPORT_REPORT <= 0:
+        return
+    _ready = True
+    print(f"First session ready {time.perf_counter() - _started:.2f} s after startup")
+
+
+install()
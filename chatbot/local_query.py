@@ -0,0 +1,253 @@
+# local_query.py
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# 2024 Amar Abane
+
+# Description: This file is part of the AskBatfish project which interacts with
+# Batfish using LLMs.
+
+
+import re
+import pandas as pd
+
+
+# Words that may surround the recognized clauses without changing the
+# meaning of a request ("show me only the rows ...").
+_FILLER = {
+    "a", "all", "and", "are", "display", "entries", "find", "for", "get",
+    "give", "in", "keep", "list", "me", "of", "only", "please", "return",
+    "routes", "rows", "show", "that", "the", "them", "then", "those",
+    "with", "number", "results", "records", "filter", "data", "table",
+}
+
+_SYNONYMS = {
+    "node": ["Node", "Hostname", "Interface"],
+    "device": ["Node", "Hostname"],
+    "router": ["Node", "Hostname"],
+    "host": ["Node", "Hostname"],
+    "hostname": ["Hostname", "Node", "Interface"],
+    "prefix": ["Prefix", "Network"],
+    "network": ["Network", "Prefix"],
+    "protocol": ["Protocol"],
+    "interface": ["Interface"],
+    "vrf": ["VRF"],
+    "next hop": ["Next_Hop", "Next_Hop_IP"],
+    "nexthop": ["Next_Hop", "Next_Hop_IP"],
+}
+
+_VALUE = r"(?:'(?P<q1>[^']*)'|\"(?P<q2>[^\"]*)\"|(?P<w>[^\s,]+))"
+_COLUMN = r"(?P<col>[a-z_][\w ]*?)"
+
+_FILTER = re.compile(
+    rf"\b(?:where|whose|if|with)\s+(?:the\s+)?{_COLUMN}\s+"
+    rf"(?P<op>is not|is|equals|==|=|!=|contains|matches|starts with|>=|<=|>|<)\s+{_VALUE}"
+)
+_ON_NODE = re.compile(rf"\b(?:on|for|from)\s+(?:node|device|router)?\s*{_VALUE}")
+_PROJECT = re.compile(r"\b(?:columns?|fields?|select)\s+(?P<cols>[\w ,]+?)(?=$|\s+(?:where|sort|order|top|count|group)\b)")
+_SORT = re.compile(rf"\b(?:sort(?:ed)?|order(?:ed)?)\s+by\s+{_COLUMN}(?:\s+(?P<dir>asc|ascending|desc|descending))?(?=$|[\s,])")
+_COUNT = re.compile(rf"\b(?:count|how many|number of)\b(?:\s+\w+)*?\s+(?:per|by|for each|grouped by)\s+{_COLUMN}(?=$|[\s,])")
+_GROUP = re.compile(rf"\bgroup(?:ed)?\s+by\s+{_COLUMN}(?=$|[\s,])")
+_TOP = re.compile(rf"\b(?:top|first|head)\s+(?P<n>\d+)(?:\s+(?!by\b)\w+)?(?:\s+by\s+{_COLUMN})?(?=$|[\s,])")
+_TOTAL = re.compile(r"\b(?:count|how many|number of)\b")
+
+
+def _key(name):
+    return re.sub(r"[\s_]+", "_", str(name).strip().lower())
+
+
+def resolve_column(df, name):
+    """Find the frame column meant by `name`, or None."""
+    name = name.strip().lower()
+    columns = {_key(c): c for c in df.columns}
+    if _key(name) in columns:
+        return columns[_key(name)]
+    for candidate in _SYNONYMS.get(name, []) + _SYNONYMS.get(name.rstrip("s"), []):
+        if candidate in df.columns:
+            return candidate
+    if _key(name.rstrip("s")) in columns:
+        return columns[_key(name.rstrip("s"))]
+    return None
+
+
+def _value(match):
+    for group in ("q1", "q2", "w"):
+        if match.group(group) is not None:
+            return match.group(group)
+    return None
+
+
+def _as_text(series):
+    """String view of a Batfish column; lists are joined, None stays empty."""
+    return series.map(
+        lambda v: "" if v is None else ", ".join(map(str, v)) if isinstance(v, (list, tuple)) else str(v)
+    )
+
+
+def _mask(df, column, op, value):
+    series = df[column]
+    if op in (">", "<", ">=", "<="):
+        numbers = pd.to_numeric(series, errors="coerce")
+        target = float(value)
+        return {
+            ">": numbers > target, "<": numbers < target,
+            ">=": numbers >= target, "<=": numbers <= target,
+        }[op]
+
+    text = _as_text(series).str.lower()
+    value = value.lower()
+    if op in ("contains", "matches"):
+        mask = text.str.contains(value, regex=False)
+    elif op == "starts with":
+        mask = text.str.startswith(value)
+    else:
+        mask = text == value
+        # Interface cells print as host[iface]; match either part too.
+        hosts = series.map(lambda v: str(getattr(v, "hostname", "")).lower())
+        ifaces = series.map(lambda v: str(getattr(v, "interface", "")).lower())
+        mask = mask | (hosts == value) | (ifaces == value)
+    if op in ("is not", "!="):
+        mask = ~mask
+    return mask
+
+
+class LocalQuery:
+    """A parsed request: filters, then grouping, sorting, top-N and projection."""
+
+    def __init__(self):
+        self.filters = []
+        self.group_by = None
+        self.sort_by = None
+        self.descending = False
+        self.top = None
+        self.columns = None
+        self.total = False
+
+    def apply(self, df):
+        for column, op, value in self.filters:
+            df = df[_mask(df, column, op, value)]
+        if self.group_by is not None:
+            keys = _as_text(df[self.group_by])
+            df = (
+                keys.groupby(keys).size()
+                .rename_axis(self.group_by).reset_index(name="Count")
+                .sort_values(["Count", self.group_by], ascending=[False, True])
+            )
+        elif self.total and self.columns is None and self.sort_by is None:
+            return pd.DataFrame({"Count": [len(df)]})
+        if self.sort_by is not None:
+            key = self.sort_by
+            numbers = pd.to_numeric(df[key], errors="coerce")
+            if numbers.notna().all():
+                df = df.assign(_key=numbers)
+            else:
+                df = df.assign(_key=_as_text(df[key]).str.lower())
+            df = df.sort_values("_key", ascending=not self.descending, kind="stable").drop(columns="_key")
+        if self.top is not None:
+            df = df.head(self.top)
+        if self.columns is not None:
+            df = df[self.columns]
+        return df.reset_index(drop=True)
+
+
+def parse(df, question):
+    """Turn a simple request into a LocalQuery, or None if it is not understood.
+
+    Every word of the request must be part of a recognized clause or be a
+    filler word; anything else means the request needs the LLM.
+    """
+    text = " ".join(question.strip().lower().rstrip("?.!").split())
+    query = LocalQuery()
+    consumed = []
+
+    def free(match):
+        start, end = match.span()
+        return all(end <= s or start >= e for s, e in consumed)
+
+    m = _COUNT.search(text) or _GROUP.search(text)
+    if m:
+        query.group_by = resolve_column(df, m.group("col"))
+        if query.group_by is None:
+            return None
+        consumed.append(m.span())
+    elif _TOTAL.search(text):
+        query.total = True
+        consumed.append(_TOTAL.search(text).span())
+
+    m = _SORT.search(text)
+    if m:
+        query.sort_by = resolve_column(df, m.group("col"))
+        if query.sort_by is None:
+            return None
+        query.descending = (m.group("dir") or "").startswith("desc")
+        consumed.append(m.span())
+
+    m = _TOP.search(text)
+    if m and free(m):
+        query.top = int(m.group("n"))
+        if m.group("col"):
+            query.sort_by = resolve_column(df, m.group("col"))
+            if query.sort_by is None:
+                return None
+            query.descending = True
+        consumed.append(m.span())
+
+    m = _PROJECT.search(text)
+    if m and free(m) and query.group_by is None:
+        names = [n for n in re.split(r"\s*,\s*|\s+and\s+", m.group("cols")) if n]
+        columns = [resolve_column(df, n) for n in names]
+        if not columns or None in columns:
+            return None
+        query.columns = columns
+        consumed.append(m.span())
+
+    for m in _FILTER.finditer(text):
+        if not free(m):
+            continue
+        column = resolve_column(df, m.group("col"))
+        if column is None:
+            return None
+        query.filters.append((column, m.group("op"), _value(m)))
+        consumed.append(m.span())
+    for m in _ON_NODE.finditer(text):
+        if not free(m):
+            continue
+        column = resolve_column(df, "node")
+        if column is None:
+            return None
+        # "for bgp" is not a node: only take names the frame has.
+        if not _mask(df, column, "is", _value(m)).any():
+            return None
+        query.filters.append((column, "is", _value(m)))
+        consumed.append(m.span())
+
+    # Whatever is left must be filler.
+    rest = text
+    for start, end in sorted(consumed, reverse=True):
+        rest = rest[:start] + " " + rest[end:]
+    leftover = [w for w in re.findall(r"[\w']+", rest) if w not in _FILLER]
+    if leftover or not consumed:
+        return None
+    return query
+
+
+def run_local(df, question):
+    """Answer `question` on `df` without an LLM; None if it is not understood."""
+    query = parse(df, question)
+    if query is None:
+        return None
+    try:
+        return query.apply(df)
+    except (KeyError, ValueError, TypeError) as e:
+        print(f"Local query failed, falling back: {e}")
+        return None
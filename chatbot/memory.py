@@ -0,0 +1,133 @@
+# memory.py
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# 2024 Amar Abane
+
+# Description: This file is part of the AskBatfish project which interacts with
+# Batfish using LLMs.
+
+
+from collections import deque
+import asyncio
+import os
+from dotenv import load_dotenv
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from compaction import count_tokens
+
+
+load_dotenv(".env")
+
+MEMORY_TOKEN_BUDGET = int(os.getenv("MEMORY_TOKEN_BUDGET", "2000"))
+MEMORY_SUMMARY_WORDS = int(os.getenv("MEMORY_SUMMARY_WORDS", "200"))
+
+# Markdown tables with more rows than this are replaced by a reference.
+TABLE_MAX_ROWS = 3
+
+
+def strip_tables(text):
+    """Replace the markdown tables of a message with a one-line reference.
+
+    Tables are the bulk of the answers and are kept server-side by handle,
+    so the text around them (including any handle) is all the agent needs.
+    """
+    out, block = [], []
+    for line in text.split("\n") + [None]:
+        if line is not None and line.lstrip().startswith("|"):
+            block.append(line)
+            continue
+        if len(block) > TABLE_MAX_ROWS + 2:
+            out.append(f"[table with {len(block) - 2} rows omitted]")
+        else:
+            out.extend(block)
+        block = []
+        if line is not None:
+            out.append(line)
+    return "\n".join(out)
+
+
+def _clip(text, tokens, limit):
+    if tokens <= limit:
+        return text
+    # Token counts are close enough to proportional to cut by characters.
+    return text[:len(text) * limit // tokens] + " [...]"
+
+
+def _format(turns):
+    return "\n\n".join(f"Engineer: {human}\nCo-pilot: {ai}" for human, ai in turns)
+
+
+class ChatMemory:
+    """Chat history of the agent, kept within a token budget.
+
+    Recent turns are kept verbatim, minus their tables. When they exceed
+    the budget, the oldest turns are folded into a running summary by
+    `summarize(summary, turns)`, an async function returning the new
+    summary, in the background. Without `summarize` they are dropped.
+    """
+
+    def __init__(self, summarize=None, budget=MEMORY_TOKEN_BUDGET, model="gpt-4o"):
+        self.summarize = summarize
+        self.budget = budget
+        self.model = model
+        self.summary = ""
+        self._summary_tokens = 0
+        self._turns = deque()
+        self._tokens = 0
+        self._pending = []
+        self._task = None
+
+    def add(self, human, ai):
+        """Record a turn; returns the summarization task it started, if any."""
+        human, ai = strip_tables(human), strip_tables(ai)
+        half = self.budget // 2
+        human = _clip(human, count_tokens(human, self.model), half)
+        ai = _clip(ai, count_tokens(ai, self.model), half)
+        tokens = count_tokens(human, self.model) + count_tokens(ai, self.model)
+        self._turns.append(((human, ai), tokens))
+        self._tokens += tokens
+
+        while len(self._turns) > 1 and self._tokens + self._summary_tokens > self.budget:
+            turn, tokens = self._turns.popleft()
+            self._tokens -= tokens
+            if self.summarize is not None:
+                self._pending.append(turn)
+
+        if self._pending and (self._task is None or self._task.done()):
+            self._task = asyncio.ensure_future(self._fold())
+            return self._task
+        return None
+
+    async def _fold(self):
+        while self._pending:
+            turns, self._pending = self._pending, []
+            try:
+                summary = await self.summarize(self.summary, _format(turns))
+            except Exception as e:
+                # Keep the turns for the next attempt.
+                print(f"Unable to summarize the chat history: {e}")
+                self._pending = turns + self._pending
+                return
+            tokens = count_tokens(summary, self.model)
+            self.summary = _clip(summary, tokens, self.budget // 2)
+            self._summary_tokens = min(tokens, self.budget // 2)
+
+    def messages(self):
+        messages = []
+        if self.summary:
+            messages.append(SystemMessage(content=f"Summary of the earlier conversation:\n{self.summary}"))
+        for (human, ai), _ in self._turns:
+            messages.append(HumanMessage(content=human))
+            messages.append(AIMessage(content=ai))
+        return messages
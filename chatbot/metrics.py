@@ -0,0 +1,287 @@
+# metrics.py
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# 2024 Amar Abane
+
+# Description: This file is part of the AskBatfish project which interacts with
+# Batfish using LLMs.
+
+
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import contextvars
+import json
+import os
+import threading
+import time
+from dotenv import load_dotenv
+from langchain_core.callbacks import BaseCallbackHandler
+
+
+load_dotenv(".env")
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+# Address the exporter listens on; localhost unless set, e.g. to 0.0.0.0.
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# Per-session traces are only served when set to 1: they describe queries.
+METRICS_SESSIONS = os.getenv("METRICS_SESSIONS", "0") == "1"
+METRICS_TRACES = int(os.getenv("METRICS_TRACES", "20"))
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Span attributes that are summed into counters.
+_COUNTED = {
+    "rows": "askbatfish_rows_total",
+    "bytes": "askbatfish_payload_bytes_total",
+    "tokens": "askbatfish_tokens_total",
+}
+
+_current = contextvars.ContextVar("metrics_span", default=None)
+_session_id = None
+
+
+class Span:
+    def __init__(self, name, attrs, parent=None):
+        self.name = name
+        self.attrs = attrs
+        self.parent = parent
+        self.children = []
+        self.duration = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "ms": round(self.duration * 1000, 2),
+            **self.attrs,
+            **({"children": [c.to_dict() for c in self.children]} if self.children else {}),
+        }
+
+
+class MetricsRegistry:
+    """Stage latency histograms and counters, in total and per chat session.
+
+    Spans are recorded as they end; `render` gives the Prometheus text
+    format and `sessions` the latency breakdown and latest traces of every
+    chat session.
+    """
+
+    def __init__(self, buckets=BUCKETS, traces=METRICS_TRACES):
+        self.buckets = buckets
+        self.traces = traces
+        self._histograms = {}
+        self._counters = defaultdict(float)
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def record(self, s, session=None):
+        with self._lock:
+            counts = self._histograms.setdefault(s.name, [[0] * len(self.buckets), 0, 0.0])
+            for i, bound in enumerate(self.buckets):
+                if s.duration <= bound:
+                    counts[0][i] += 1
+            counts[1] += 1
+            counts[2] += s.duration
+            for attr, metric in _COUNTED.items():
+                if isinstance(s.attrs.get(attr), (int, float)):
+                    self._counters[(metric, s.name)] += s.attrs[attr]
+            if s.attrs.get("error"):
+                self._counters[("askbatfish_errors_total", s.name)] += 1
+            if session is not None:
+                entry = self._sessions.setdefault(
+                    session, {"stages": {}, "traces": deque(maxlen=self.traces)}
+                )
+                stage = entry["stages"].setdefault(s.name, {"count": 0, "seconds": 0.0, "max": 0.0})
+                stage["count"] += 1
+                stage["seconds"] += s.duration
+                stage["max"] = max(stage["max"], s.duration)
+                if s.parent is None:
+                    entry["traces"].append(s.to_dict())
+
+    def count(self, metric, stage, value):
+        with self._lock:
+            self._counters[(metric, stage)] += value
+
+    def forget(self, session):
+        with self._lock:
+            self._sessions.pop(session, None)
+
+    def breakdown(self, session):
+        """Latency per stage of one session, slowest total first."""
+        with self._lock:
+            entry = self._sessions.get(session)
+            if entry is None:
+                return []
+            return sorted(
+                ((name, dict(v)) for name, v in entry["stages"].items()),
+                key=lambda item: -item[1]["seconds"],
+            )
+
+    def sessions(self):
+        with self._lock:
+            return {
+                session: {"stages": dict(entry["stages"]), "traces": list(entry["traces"])}
+                for session, entry in self._sessions.items()
+            }
+
+    def render(self):
+        lines = [
+            "# HELP askbatfish_stage_seconds Latency of the query pipeline stages.",
+            "# TYPE askbatfish_stage_seconds histogram",
+        ]
+        with self._lock:
+            for name, (buckets, count, total) in sorted(self._histograms.items()):
+                for bound, n in zip(self.buckets, buckets):
+                    lines.append(f'askbatfish_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {n}')
+                lines.append(f'askbatfish_stage_seconds_bucket{{stage="{name}",le="+Inf"}} {count}')
+                lines.append(f'askbatfish_stage_seconds_sum{{stage="{name}"}} {total}')
+                lines.append(f'askbatfish_stage_seconds_count{{stage="{name}"}} {count}')
+            metrics = sorted(self._counters.items())
+            sessions = len(self._sessions)
+        current = None
+        for (metric, stage), value in metrics:
+            if metric != current:
+                lines.append(f"# TYPE {metric} counter")
+                current = metric
+            lines.append(f'{metric}{{stage="{stage}"}} {value:g}')
+        lines.append("# TYPE askbatfish_sessions gauge")
+        lines.append(f"askbatfish_sessions {sessions}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+def set_session_resolver(resolver):
+    """Use `resolver()` to find the chat session a span belongs to."""
+    global _session_id
+    _session_id = resolver
+
+
+def _current_session():
+    if _session_id is None:
+        return None
+    try:
+        return _session_id()
+    except Exception:
+        # Outside of a chat session, e.g. in a background thread.
+        return None
+
+
+def current_span():
+    return _current.get()
+
+
+@contextmanager
+def span(name, **attrs):
+    """Time a stage; attributes can be added with `.set()` while it runs."""
+    parent = _current.get()
+    s = Span(name, attrs, parent)
+    token = _current.set(s)
+    start = time.perf_counter()
+    try:
+        yield s
+    except BaseException:
+        s.attrs["error"] = True
+        raise
+    finally:
+        s.duration = time.perf_counter() - start
+        _current.reset(token)
+        if parent is not None:
+            parent.children.append(s)
+        registry.record(s, _current_session())
+
+
+def _adopt(record, parent, session):
+    children = record.pop("children", [])
+    s = Span(record.pop("name"), record, parent)
+    s.duration = record.pop("ms") / 1000
+    for child in children:
+        _adopt(child, s, session)
+    if parent is not None:
+        parent.children.append(s)
+    registry.record(s, session)
+
+
+def adopt(records):
+    """Record spans timed in another process as children of the current span.
+
+    `records` are the `Span.to_dict()` of those spans.
+    """
+    parent = _current.get()
+    session = _current_session()
+    for record in records:
+        _adopt(dict(record), parent, session)
+
+
+class TokenUsageHandler(BaseCallbackHandler):
+    """Adds the token usage reported by OpenAI to the current span."""
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def on_llm_end(self, response, **kwargs):
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        tokens = usage.get("total_tokens")
+        if not tokens:
+            return
+        s = _current.get()
+        if s is not None:
+            s.set(
+                tokens=s.attrs.get("tokens", 0) + tokens,
+                prompt_tokens=s.attrs.get("prompt_tokens", 0) + usage.get("prompt_tokens", 0),
+            )
+        else:
+            registry.count("askbatfish_tokens_total", self.stage, tokens)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = registry.render().encode()
+            content_type = "text/plain; version=0.0.4"
+        elif self.path == "/sessions" and METRICS_SESSIONS:
+            body = json.dumps(registry.sessions(), default=list).encode()
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+
+
+def start_server(port=METRICS_PORT, host=METRICS_HOST):
+    """Serve /metrics (and /sessions if enabled) on `host:port` in a daemon thread, once."""
+    global _server
+    if _server is not None or not port:
+        return _server
+    try:
+        _server = ThreadingHTTPServer((host, port), _Handler)
+    except OSError as e:
+        print(f"Unable to start the metrics server on port {port}: {e}")
+        return None
+    threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+    return _server
@@ -0,0 +1,205 @@
+# pipeline.py
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# 2024 Amar Abane
+
+# Description: This file is part of the AskBatfish project which interacts with
+# Batfish using LLMs.
+
+
+# Text-to-code and execution steps of a query, shared by the chat app and
+# the batch CLI.
+
+from collections import OrderedDict
+import re
+import threading
+import time
+import pandas as pd
+
+from code_cache import code_cache
+from metrics import TokenUsageHandler, span
+from query import compile_run, run_blocking
+from tools import remove_python_code_fence
+from workers import QueryError, get_worker_pool
+
+
+_PLAN_CACHE_SIZE = 128
+_plans = OrderedDict()
+_plans_lock = threading.Lock()
+
+
+async def generate_run(chain, task, model):
+    """Return (key, entry) with the run() code for `task`.
+
+    The code comes from the code cache, or from `chain`; new code is only
+    cached by `code_cache.update` once it has produced a non-empty frame.
+    `entry` is None if the generated code is not a valid run() function.
+    """
+    key = code_cache.key(task, model)
+    with span("code_cache") as s:
+        entry = await run_blocking(code_cache.get, key)
+        s.set(hit=entry is not None)
+    if entry is None:
+        with span("llm", chain="text_to_code"):
+            output = await chain.ainvoke(
+                task, config={"callbacks": [TokenUsageHandler("llm")]}
+            )
+        code = remove_python_code_fence(output)
+        print(f"Generate invocation: {code}")
+        try:
+            entry = await run_blocking(code_cache.prepare, key, code)
+        except (SyntaxError, ValueError) as e:
+            print(f"Invalid generated code: {e}")
+            return key, None
+    return key, entry
+
+
+def parse_plan(output, task):
+    """Split the planner output into (question, run() source) pairs.
+
+    The output is a 'Question: ...' line followed by a function, for each
+    question. Without any such line, it is the code of `task` itself.
+    """
+    parts = re.split(r"^Question:[ \t]*(.*)$", output.strip(), flags=re.M)
+    if len(parts) == 1:
+        return [(task, remove_python_code_fence(output.strip()))]
+    return [
+        (question.strip(), remove_python_code_fence(code.strip()))
+        for question, code in zip(parts[1::2], parts[2::2])
+        if code.strip()
+    ]
+
+
+async def generate_plan(chain, task, model):
+    """Return [(question, key, entry)], the independent questions of `task`.
+
+    A task that needs a single invocation goes through the code cache like
+    with generate_run; for one that needs several, the list of questions is
+    kept and the code of each question is cached on its own. `entry` is None
+    for a question whose generated code is not a valid run() function.
+    """
+    key = code_cache.key(task, model)
+    with _plans_lock:
+        questions = _plans.get((key.text, model))
+        if questions is not None:
+            _plans.move_to_end((key.text, model))
+    with span("code_cache") as s:
+        if questions is None:
+            entry = await run_blocking(code_cache.get, key)
+            if entry is not None:
+                s.set(hit=True)
+                return [(task, key, entry)]
+        else:
+            keys = [code_cache.key(q, model) for q in questions]
+            entries = [await run_blocking(code_cache.get, k) for k in keys]
+            if all(e is not None for e in entries):
+                s.set(hit=True)
+                return list(zip(questions, keys, entries))
+        s.set(hit=False)
+
+    with span("llm", chain="plan"):
+        output = await chain.ainvoke(
+            task, config={"callbacks": [TokenUsageHandler("llm")]}
+        )
+    parts = parse_plan(output, task)
+    if len(parts) == 1:
+        parts = [(task, parts[0][1])]
+    planned = []
+    for question, code in parts:
+        k = key if len(parts) == 1 else code_cache.key(question, model)
+        try:
+            entry = await run_blocking(code_cache.prepare, k, code)
+        except (SyntaxError, ValueError) as e:
+            print(f"Invalid generated code for {question!r}: {e}")
+            entry = None
+        planned.append((question, k, entry))
+    if len(planned) > 1:
+        with _plans_lock:
+            _plans[(key.text, model)] = [question for question, _, _ in planned]
+            while len(_plans) > _PLAN_CACHE_SIZE:
+                _plans.popitem(last=False)
+    return planned
+
+
+def merge_frames(results):
+    """Concatenate the frames of several questions, with a Query column.
+
+    `results` is a list of (question, frame); columns that a frame does not
+    have are left empty in its rows.
+    """
+    frames = [
+        df.assign(Query=question)[["Query", *(c for c in df.columns if c != "Query")]]
+        for question, df in results
+    ]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
+async def run_code(entry, binding, timings=None):
+    """Run generated code; return the result frame, or None on failure.
+
+    With worker processes, a worker is acquired on the event loop before
+    the run goes to the query executor. If `timings` is a dict, the seconds
+    spent waiting for a worker and running are stored in it as "wait_s"
+    and "run_s".
+    """
+    timings = {} if timings is None else timings
+    pool = get_worker_pool()
+    if pool is None:
+        start = time.perf_counter()
+        try:
+            return await run_blocking(_run_in_process, entry, binding)
+        finally:
+            timings.update(wait_s=0.0, run_s=time.perf_counter() - start)
+
+    hashes = {
+        name: binding.hashes[name]
+        for name in (binding.snapshot, binding.reference) if name in binding.hashes
+    }
+    queued = time.perf_counter()
+    deadline = time.monotonic() + pool.timeout
+    with span("run", worker=True) as s:
+        start = None
+        try:
+            async with pool.slot(deadline):
+                start = time.perf_counter()
+                result, size = await run_blocking(
+                    pool.run, entry.source, binding.network, binding.snapshot,
+                    binding.reference, hashes, deadline=deadline,
+                )
+        except QueryError as e:
+            print(f"Exception: {e}")
+            return None
+        finally:
+            end = time.perf_counter()
+            start = end if start is None else start
+            timings.update(wait_s=start - queued, run_s=end - start)
+            s.set(wait_ms=round(timings["wait_s"] * 1000, 2))
+        s.set(rows=len(result), bytes=size)
+    return result
+
+
+def _run_in_process(entry, binding):
+    with binding.session() as bf:
+        with span("exec"):
+            run = compile_run(entry.code, bf, binding.reference)
+        try:
+            with span("run") as s:
+                result = run()
+                if not isinstance(result, pd.DataFrame):
+                    raise TypeError(f"run() returned {type(result).__name__}")
+                s.set(rows=len(result))
+            return result
+        except Exception as e:
+            print(f"Exception: {e}")
+            return None
@@ -0,0 +1,98 @@
+# prebuild.py
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# 2024 Amar Abane
+
+# Description: This file is part of the AskBatfish project which interacts with
+# Batfish using LLMs.
+
+
+# Build-time artifacts, so that the server does not compute them on its
+# first session. Run once in the image:
+#
+#   python prebuild.py
+#
+# Every step is optional: one that fails (e.g. no network or API key at
+# build time) is done at runtime instead, as before.
+
+import compileall
+import time
+
+
+MODELS = ["gpt-4o", "gpt-3.5-turbo"]
+
+
+def build_example_index():
+    from example_index import get_example_index
+
+    index, _ = get_example_index()
+    return f"{len(index.examples)} examples"
+
+
+def build_docs_index():
+    from docs_index import get_docs_index
+
+    index, _ = get_docs_index()
+    if index is None:
+        raise RuntimeError("pybatfish_docs not found or not indexed")
+    return f"{len(index.chunks)} chunks"
+
+
+def fetch_encodings():
+    # Saved under TIKTOKEN_CACHE_DIR.
+    from compaction import _encoding
+
+    loaded = [model for model in MODELS if _encoding(model) is not None]
+    if not loaded:
+        raise RuntimeError("no encoding could be loaded")
+    return ", ".join(loaded)
+
+
+def build_prompts():
+    # Chains are cheap to build but check that every template is valid.
+    from tools import _chain_builders, get_chain
+
+    for kind in _chain_builders:
+        get_chain(kind)
+    return f"{len(_chain_builders)} chains"
+
+
+def compile_sources():
+    if not compileall.compile_dir(".", maxlevels=0, quiet=1):
+        raise RuntimeError("compilation failed")
+    return "bytecode written"
+
+
+STEPS = [
+    ("example index", build_example_index),
+    ("tokenizer", fetch_encodings),
+    ("docs index", build_docs_index),
+    ("prompts", build_prompts),
+    ("bytecode", compile_sources),
+]
+
+
+def main():
+    for name, step in STEPS:
+        start = time.perf_counter()
+        try:
+            result = step()
+        except Exception as e:
+            print(f"{name}: skipped ({e})")
+            continue
+        print(f"{name}: {result} in {time.perf_counter() - start:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# query.py
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# 2024 Amar Abane
+
+# Description: This file is part of the AskBatfish project which interacts with
+# Batfish using LLMs.
+
+
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import contextvars
+import functools
+import os
+from dotenv import load_dotenv
+
+import pandas as pd
+# noinspection PyUnresolvedReferences
+from pybatfish.datamodel import Edge, Interface  # noqa: F401
+from pybatfish.datamodel.answer import TableAnswer
+from pybatfish.datamodel.flow import HeaderConstraints, PathConstraints  # noqa: F401
+from pybatfish.datamodel.route import BgpRoute  # noqa: F401
+
+
+load_dotenv(".env")
+
+QUERY_WORKERS = int(os.getenv("QUERY_WORKERS", "8"))
+SESSION_QUERY_LIMIT = int(os.getenv("SESSION_QUERY_LIMIT", "2"))
+
+_executor = ThreadPoolExecutor(max_workers=QUERY_WORKERS, thread_name_prefix="query")
+
+# Names available to the generated code, besides `bf`.
+_namespace = {
+    "pd": pd,
+    "Edge": Edge,
+    "Interface": Interface,
+    "HeaderConstraints": HeaderConstraints,
+    "PathConstraints": PathConstraints,
+    "BgpRoute": BgpRoute,
+    "TableAnswer": TableAnswer,
+}
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """Run blocking Batfish or pandas work in the bounded query executor.
+
+    The caller's context is propagated, so Chainlit's user_session keeps
+    working inside `fn`.
+    """
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    call = functools.partial(ctx.run, fn, *args, **kwargs)
+    return await loop.run_in_executor(_executor, call)
+
+
+def compile_run(code, bf, reference=None):
+    """Execute the generated code and return the `run` function it defines.
+
+    `reference` is the snapshot that differential questions compare against,
+    exposed to the code as REFERENCE_SNAPSHOT.
+    """
+    globals_dict = dict(_namespace)
+    globals_dict['bf'] = bf
+    globals_dict['REFERENCE_SNAPSHOT'] = reference
+    local_namespace = {}
+    exec(code, globals_dict, local_namespace)
+    return local_namespace['run']
@@ -0,0 +1,79 @@
+# rendering.py
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# 2024 Amar Abane
+
+# Description: This file is part of the AskBatfish project which interacts with
+# Batfish using LLMs.
+
+
+import math
+import os
+from dotenv import load_dotenv
+
+
+load_dotenv(".env")
+
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "50"))
+
+
+class ResultPager:
+    """Keeps a result frame server-side and renders it one page at a time.
+
+    `frame` is the ColumnarFrame of the result. Only the rows of the
+    requested page are decoded and formatted, so the cost of showing a
+    result does not depend on its size.
+    """
+
+    def __init__(self, frame, page_size=PAGE_SIZE):
+        self.frame = frame
+        self.page_size = page_size
+        self.page = 0
+        self.columns = list(frame.columns)
+
+    @property
+    def rows(self):
+        return len(self.frame)
+
+    @property
+    def pages(self):
+        return max(1, math.ceil(self.rows / self.page_size))
+
+    def has_next(self):
+        return self.page + 1 < self.pages
+
+    def next(self):
+        if self.has_next():
+            self.page += 1
+        return self.page
+
+    def project(self, columns):
+        """Restrict the rendered columns; unknown names raise ValueError."""
+        unknown = [c for c in columns if c not in self.frame.columns]
+        if unknown:
+            raise ValueError(f"Unknown columns: {', '.join(unknown)}")
+        self.columns = list(columns) or list(self.frame.columns)
+        self.page = 0
+
+    def page_markdown(self, page=None):
+        page = self.page if page is None else page
+        start = page * self.page_size
+        end = min(start + self.page_size, self.rows)
+        table = self.frame.decode(start, end, self.columns).to_markdown(index=False)
+        if self.pages == 1:
+            return table
+        return f"{table}\n\nRows {start + 1}-{end} of {self.rows} (page {page + 1}/{self.pages})"
+
+    def to_csv(self):
+        return self.frame.decode(columns=self.columns).to_csv(index=False).encode()
@@ -0,0 +1,194 @@
+# sessions.py
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# 2024 Amar Abane
+
+# Description: This file is part of the AskBatfish project which interacts with
+# Batfish using LLMs.
+
+
+from contextlib import contextmanager
+import os
+import queue
+import threading
+import time
+from dotenv import load_dotenv
+
+from pybatfish.client import restv2helper
+from pybatfish.client.session import Session
+from requests.adapters import HTTPAdapter
+
+from answer_cache import CachingSession
+from snapshot import pin_snapshot, unpin_snapshot
+
+
+load_dotenv(".env")
+
+BATFISH_HOST = os.getenv("BATFISH_HOST", "batfish")
+BATFISH_NETWORK = os.getenv("BATFISH_NETWORK", "example_network")
+SESSION_POOL_SIZE = int(os.getenv("SESSION_POOL_SIZE", "8"))
+SESSION_IDLE_TIMEOUT = float(os.getenv("SESSION_IDLE_TIMEOUT", "3600"))
+
+
+def _configure_http_pool(size):
+    """Size the connection pool that pybatfish shares between all sessions.
+
+    pybatfish sends every request through one module-level requests session
+    whose adapter keeps 10 connections; give it one per pooled Session and
+    keep its retry policy.
+    """
+    adapter = HTTPAdapter(
+        pool_connections=size,
+        pool_maxsize=size,
+        max_retries=restv2helper._adapter.max_retries,
+    )
+    restv2helper._requests_session.mount("http://", adapter)
+    restv2helper._requests_session.mount("https://", adapter)
+
+
+class SessionPool:
+    """Bounded pool of pybatfish Sessions.
+
+    Creating a Session downloads all question templates, so sessions are kept
+    and handed out again. At most `size` sessions are in use at once; callers
+    block until one is released.
+    """
+
+    def __init__(self, host=BATFISH_HOST, size=SESSION_POOL_SIZE):
+        self.host = host
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        _configure_http_pool(size)
+
+    def acquire(self):
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self._new_session()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _new_session(self):
+        return Session(host=self.host)
+
+    def release(self, bf):
+        bf.network = None
+        bf.snapshot = None
+        self._idle.put(bf)
+        self._slots.release()
+
+
+class BatfishBinding:
+    """Network and snapshot of one chat session.
+
+    The binding holds no Session itself; `session()` borrows one from the
+    pool and points it at this binding's network and snapshot.
+    """
+
+    def __init__(self, pool, network):
+        self.pool = pool
+        self.network = network
+        self.snapshot = None
+        self.reference = None
+        self.hashes = {}
+        self.last_used = time.monotonic()
+
+    def _repin(self, old, new):
+        if old != new:
+            if new is not None:
+                pin_snapshot(self.network, new)
+            if old is not None:
+                unpin_snapshot(self.network, old)
+
+    def set_snapshot(self, name, digest, reference=None):
+        """Make `name` current; `reference` is kept for differential questions."""
+        self._repin(self.reference, reference)
+        self._repin(self.snapshot, name)
+        self.snapshot = name
+        self.reference = reference
+        self.hashes[name] = digest
+
+    def close(self):
+        self._repin(self.snapshot, None)
+        self._repin(self.reference, None)
+        self.snapshot = None
+        self.reference = None
+
+    @contextmanager
+    def session(self):
+        bf = self.pool.acquire()
+        try:
+            bf.network = self.network
+            bf.snapshot = self.snapshot
+            self.last_used = time.monotonic()
+            yield CachingSession(bf, hashes=self.hashes)
+        finally:
+            self.last_used = time.monotonic()
+            self.pool.release(bf)
+
+
+class SessionManager:
+    """Gives every chat session its own Batfish binding."""
+
+    def __init__(self, pool=None, network=BATFISH_NETWORK, idle_timeout=SESSION_IDLE_TIMEOUT):
+        self.pool = pool or SessionPool()
+        self.network = network
+        self.idle_timeout = idle_timeout
+        self._bindings = {}
+        self._lock = threading.Lock()
+        self._network_ready = False
+
+    def bind(self, session_id):
+        self.reap_idle()
+        binding = BatfishBinding(self.pool, self.network)
+        if not self._network_ready:
+            with binding.session() as bf:
+                bf.set_network(self.network)
+            self._network_ready = True
+        with self._lock:
+            old = self._bindings.pop(session_id, None)
+            self._bindings[session_id] = binding
+        if old is not None:
+            old.close()
+        return binding
+
+    def get(self, session_id):
+        with self._lock:
+            return self._bindings.get(session_id)
+
+    def release(self, session_id):
+        with self._lock:
+            binding = self._bindings.pop(session_id, None)
+        if binding is not None:
+            binding.close()
+
+    def reap_idle(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = [
+                sid for sid, b in self._bindings.items()
+                if now - b.last_used > self.idle_timeout
+            ]
+            bindings = [self._bindings.pop(sid) for sid in expired]
+        for binding in bindings:
+            binding.close()
+        return len(bindings)
+
+
+session_manager = SessionManager()
@@ -0,0 +1,251 @@
+# snapshot.py
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# 2024 Amar Abane
+
+# Description: This file is part of the AskBatfish project which interacts with
+# Batfish using LLMs.
+
+
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+import hashlib
+import os
+import tempfile
+import threading
+import zipfile
+from dotenv import load_dotenv
+
+
+load_dotenv(".env")
+
+MAX_SNAPSHOTS = int(os.getenv("MAX_SNAPSHOTS", "8"))
+
+_lock = threading.Lock()
+_recent = OrderedDict()
+_pins = Counter()
+_manifests = {}
+# Per-snapshot upload locks, with the number of threads using each.
+_uploads = {}
+
+
+def _snapshot_files(archive):
+    """Yield (relative path, ZipInfo) for the files of a snapshot archive.
+
+    Paths are taken relative to the archive's top-level directory, so the
+    same configs zipped under a different folder name give the same paths.
+    """
+    infos = [i for i in archive.infolist() if not i.is_dir()]
+    roots = {i.filename.split("/", 1)[0] for i in infos if "/" in i.filename}
+    strip_root = len(roots) == 1 and all("/" in i.filename for i in infos)
+    for info in infos:
+        name = info.filename.split("/", 1)[1] if strip_root else info.filename
+        if os.path.basename(name).startswith(".") or name.startswith("__MACOSX/"):
+            continue
+        yield name, info
+
+
+def snapshot_manifest(zip_path):
+    """Map each file of a snapshot archive to the sha256 of its content."""
+    manifest = {}
+    with zipfile.ZipFile(zip_path) as archive:
+        for name, info in _snapshot_files(archive):
+            h = hashlib.sha256()
+            with archive.open(info) as file:
+                for chunk in iter(lambda: file.read(1 << 20), b''):
+                    h.update(chunk)
+            manifest[name] = h.hexdigest()
+    return manifest
+
+
+def manifest_digest(manifest):
+    h = hashlib.sha256()
+    for name in sorted(manifest):
+        h.update(name.encode())
+        h.update(b"\0")
+        h.update(manifest[name].encode())
+        h.update(b"\n")
+    return h.hexdigest()
+
+
+def snapshot_name(digest):
+    return f"snap_{digest[:24]}"
+
+
+def _touch(network, name):
+    # Must be called with the lock held.
+    key = (network, name)
+    _recent[key] = True
+    _recent.move_to_end(key)
+
+
+def pin_snapshot(network, name):
+    """Protect a snapshot from eviction while a chat session uses it."""
+    with _lock:
+        _pins[(network, name)] += 1
+        _touch(network, name)
+
+
+def unpin_snapshot(network, name):
+    with _lock:
+        _pins[(network, name)] -= 1
+        if _pins[(network, name)] <= 0:
+            del _pins[(network, name)]
+
+
+@contextmanager
+def _uploading(network, name):
+    """Serialize the checks and uploads of one snapshot in this process.
+
+    Sessions uploading the same content at the same time would otherwise
+    all miss it and re-initialize it while the first one is using it.
+    """
+    key = (network, name)
+    with _lock:
+        lock, users = _uploads.get(key, (None, 0))
+        lock = lock or threading.Lock()
+        _uploads[key] = (lock, users + 1)
+    try:
+        with lock:
+            yield
+    finally:
+        with _lock:
+            lock, users = _uploads[key]
+            if users == 1:
+                del _uploads[key]
+            else:
+                _uploads[key] = (lock, users - 1)
+
+
+def _evict(bf, keep):
+    """Delete least recently used snapshots beyond MAX_SNAPSHOTS.
+
+    Snapshots that this process has not used (e.g. created before a restart)
+    are considered the oldest. Only content-addressed snapshots are deleted,
+    and never one that is pinned by a chat session.
+    """
+    network = bf.network
+    existing = [s for s in bf.list_snapshots() if s.startswith("snap_")]
+    if len(existing) <= MAX_SNAPSHOTS:
+        return
+    with _lock:
+        rank = {key[1]: i for i, key in enumerate(_recent) if key[0] == network}
+        pinned = {key[1] for key in _pins if key[0] == network}
+    candidates = sorted(
+        (s for s in existing if s != keep and s not in pinned),
+        key=lambda s: rank.get(s, -1),
+    )
+    for name in candidates[:len(existing) - MAX_SNAPSHOTS]:
+        try:
+            bf.delete_snapshot(name)
+            print(f"Deleted snapshot {name}")
+        except Exception as e:
+            print(f"Unable to delete snapshot {name}: {e}")
+        with _lock:
+            _recent.pop((network, name), None)
+            _manifests.pop((network, name), None)
+
+
+def ensure_snapshot(bf, zip_path):
+    """Make the snapshot of `zip_path` current, uploading it only if needed.
+
+    The snapshot is named after the content hash of its configs. If Batfish
+    already holds that snapshot it is reused as is, skipping parsing and
+    dataplane computation; concurrent uploads of the same content in this
+    process wait for the first one and reuse it. Returns (name, digest,
+    reused).
+    """
+    manifest = snapshot_manifest(zip_path)
+    digest = manifest_digest(manifest)
+    name = snapshot_name(digest)
+
+    with _uploading(bf.network, name):
+        reused = name in bf.list_snapshots()
+        if reused:
+            bf.set_snapshot(name)
+        else:
+            bf.init_snapshot(zip_path, name=name, overwrite=True)
+
+    with _lock:
+        _touch(bf.network, name)
+        _manifests[(bf.network, name)] = manifest
+    _evict(bf, keep=name)
+    return name, digest, reused
+
+
+def manifest_delta(old, new):
+    """Files added or modified in `new`, and files removed from `old`."""
+    changed = sorted(n for n, h in new.items() if old.get(n) != h)
+    removed = sorted(n for n in old if n not in new)
+    return changed, removed
+
+
+def _delta_archive(zip_path, names):
+    """Write the files `names` of a snapshot archive to a new zip.
+
+    The files keep their place in the snapshot layout (configs/, hosts/...),
+    under a single top-level directory as Batfish expects.
+    """
+    names = set(names)
+    fd, path = tempfile.mkstemp(suffix=".zip")
+    os.close(fd)
+    with zipfile.ZipFile(zip_path) as archive, \
+            zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as delta:
+        for name, info in _snapshot_files(archive):
+            if name in names:
+                with archive.open(info) as src, delta.open(f"snapshot/{name}", "w") as dst:
+                    for chunk in iter(lambda: src.read(1 << 20), b''):
+                        dst.write(chunk)
+    return path
+
+
+def update_snapshot(bf, base, zip_path):
+    """Make an edited version of snapshot `base` current.
+
+    The archive is diffed against the manifest of `base` file by file, and
+    only the changed files are uploaded by forking `base`. A full upload is
+    done when files were removed (a fork can only add or replace files) or
+    when the manifest of `base` is not known, e.g. after a restart. The
+    result is content-addressed like `ensure_snapshot`, so the answers
+    cached for `base` stay valid.
+
+    Returns (name, digest, changed) where `changed` lists the uploaded
+    files, or is None when the whole archive was uploaded or reused.
+    """
+    manifest = snapshot_manifest(zip_path)
+    digest = manifest_digest(manifest)
+    name = snapshot_name(digest)
+    with _lock:
+        base_manifest = _manifests.get((bf.network, base))
+
+    changed = None
+    with _uploading(bf.network, name):
+        if name in bf.list_snapshots():
+            bf.set_snapshot(name)
+        elif base_manifest is None or manifest_delta(base_manifest, manifest)[1]:
+            bf.init_snapshot(zip_path, name=name, overwrite=True)
+        else:
+            changed = manifest_delta(base_manifest, manifest)[0]
+            delta = _delta_archive(zip_path, changed)
+            try:
+                bf.fork_snapshot(base, name=name, add_files=delta, overwrite=True)
+            finally:
+                os.remove(delta)
+            bf.set_snapshot(name)
+
+    with _lock:
+        _touch(bf.network, name)
+        _manifests[(bf.network, name)] = manifest
+    _evict(bf, keep=name)
+    return name, digest, changed
@@ -0,0 +1,78 @@
+# speculation.py
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# 2024 Amar Abane
+
+# Description: This file is part of the AskBatfish project which interacts with
+# Batfish using LLMs.
+
+
+import asyncio
+import os
+from dotenv import load_dotenv
+
+from code_cache import normalize_task
+
+
+load_dotenv(".env")
+
+# Seconds a speculative answer waits for its query; 0 disables speculation.
+SPECULATION_TTL = float(os.getenv("SPECULATION_TTL", "120"))
+
+
+class Speculation:
+    """Per-session answer started before the query that needs it is sent.
+
+    In Basic mode, `/ask <query>` starts answering the query while it is
+    validated; when the user then sends the same query, its answer is
+    already computed or on its way. Only the latest speculation is kept: it
+    is cancelled when another query is sent, when a new one starts, or
+    after `ttl` seconds.
+    """
+
+    def __init__(self, ttl=SPECULATION_TTL):
+        self.ttl = ttl
+        self._text = None
+        self._task = None
+        self._expiry = None
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def start(self, text, task):
+        self.cancel()
+        self._text = normalize_task(text)
+        self._task = task
+        self._expiry = asyncio.get_running_loop().call_later(self.ttl, self._expire, task)
+
+    def _expire(self, task):
+        if task is self._task:
+            self.cancel()
+
+    def take(self, text):
+        """The task answering `text`, if speculated; any other is cancelled."""
+        task = self._task
+        if task is not None and not task.cancelled() and self._text == normalize_task(text):
+            self._expiry.cancel()
+            self._text = self._task = self._expiry = None
+            return task
+        self.cancel()
+        return None
+
+    def cancel(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._expiry.cancel()
+        self._text = self._task = self._expiry = None
@@ -23,9 +23,9 @@ import logging
 import random  # noqa: F401
 from typing import List, Optional  # noqa: F401
 
+from functools import lru_cache
+
 import pandas as pd
-from IPython.display import display
-from pandas.io.formats.style import Styler
 
 from pybatfish.client.session import Session  # noqa: F401
 
@@ -49,11 +49,25 @@ pd.set_option("display.html.use_mathjax", False)
 _STYLE_UUID = "pybfstyle"
 
 
-class MyStyler(Styler):
-    """A custom styler for displaying DataFrames in HTML"""
+@lru_cache(maxsize=None)
+def _styler():
+    # IPython and the pandas styler (jinja2) are only needed to display.
+    from pandas.io.formats.style import Styler
+
+    class MyStyler(Styler):
+        """A custom styler for displaying DataFrames in HTML"""
+
+        def __repr__(self):
+            return repr(self.data)
 
-    def __repr__(self):
-        return repr(self.data)
+    return MyStyler
+
+
+def __getattr__(name):
+    # startup.MyStyler stays available, built on first access.
+    if name == "MyStyler":
+        return _styler()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def show(df):
@@ -63,6 +77,8 @@ def show(df):
     Replaces newlines and double-spaces in the input with HTML markup, and
     left-aligns the text.
     """
+    from IPython.display import display
+
     if isinstance(df, TableAnswer):
         df = df.frame()
 
@@ -71,7 +87,7 @@ def show(df):
         display(df)
         return
     display(
-        MyStyler(df)
+        _styler()(df)
         .set_uuid(_STYLE_UUID)
         .format(get_html)
         .set_properties(**{"text-align": "left", "vertical-align": "top"})
@@ -0,0 +1,118 @@
+# test_answer_cache.py
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# 2024 Amar Abane
+
+# Description: This file is part of the AskBatfish project which interacts with
+# Batfish using LLMs.
+
+
+import os
+import pickle
+
+import pytest
+from pybatfish.datamodel.answer.table import TableAnswer
+
+import answer_cache
+from answer_cache import AnswerCache, cache_key
+
+COLUMNS = [
+    ("Node", "Node"), ("Interface", "Interface"), ("Active", "Boolean"), ("MTU", "Integer"),
+    ("Description", "String"), ("Prefixes", "List<Prefix>"), ("Peers", "Set<Node>"),
+]
+
+
+@pytest.fixture
+def answer():
+    rows = [
+        {
+            "Node": {"name": f"r{i % 5}"},
+            "Interface": {"hostname": f"r{i % 5}", "interface": f"Gi0/{i}"},
+            "Active": i % 3 != 0,
+            "MTU": 1500 if i % 2 else 9000,
+            "Description": None if i % 4 else f"link {i}",
+            "Prefixes": [f"10.{i}.{j}.0/24" for j in range(i % 3)],
+            "Peers": [{"name": f"r{j}"} for j in range(i % 4)],
+        }
+        for i in range(50)
+    ]
+    metadata = {
+        "columnMetadata": [
+            {"name": name, "schema": schema, "isKey": True, "isValue": False, "description": ""}
+            for name, schema in COLUMNS
+        ],
+        "textDesc": "",
+    }
+    return TableAnswer({
+        "answerElements": [{"metadata": metadata, "rows": rows, "summary": {"numResults": len(rows)}}],
+        "status": "SUCCESS",
+        "question": {},
+    })
+
+
+def assert_same_answer(expected, actual):
+    a, b = expected.frame(), actual.frame()
+    assert list(a.columns) == list(b.columns)
+    for column in a.columns:
+        for x, y in zip(a[column], b[column]):
+            assert type(x) is type(y) and x == y, (column, x, y)
+    assert [dict(r) for r in expected.rows] == [dict(r) for r in actual.rows]
+
+
+def test_memory_round_trip(answer):
+    cache = AnswerCache(size=4)
+    cache.put("k", answer)
+    cached = cache.get("k")
+    # Decoded only when used.
+    assert "_table_data" not in cached.__dict__
+    assert "rows" not in cached["answerElements"][0]
+    assert_same_answer(answer, answer_cache._detached(cached))
+
+
+def test_disk_round_trip(answer, tmp_path):
+    AnswerCache(directory=str(tmp_path)).put("k", answer)
+    assert os.path.exists(tmp_path / "k.arrow")
+    cache = AnswerCache(directory=str(tmp_path))
+    assert_same_answer(answer, cache.get("k"))
+    assert cache.stats()["disk_hits"] == 1
+
+
+def test_pickle_round_trip(answer):
+    cache = AnswerCache()
+    cache.put("k", answer)
+    assert_same_answer(answer, pickle.loads(pickle.dumps(cache.get("k"))))
+
+
+def test_detached_frames_are_independent(answer):
+    cache = AnswerCache()
+    cache.put("k", answer)
+    first = answer_cache._detached(cache.get("k"))
+    first.frame().drop(columns="MTU", inplace=True)
+    assert "MTU" in answer_cache._detached(cache.get("k")).frame().columns
+
+
+def test_lru_eviction():
+    cache = AnswerCache(size=2)
+    for key in "abc":
+        cache.put(key, key.upper())
+    assert cache.get("a") is None
+    assert cache.get("c") == "C"
+    assert cache.stats() == {"hits": 1, "disk_hits": 0, "misses": 1, "entries": 2}
+
+
+def test_cache_key_ignores_parameter_order():
+    assert cache_key("h", "routes", {"nodes": "r1", "vrfs": "default"}) == \
+        cache_key("h", "routes", {"vrfs": "default", "nodes": "r1"})
+    assert cache_key("h", "routes", {}) != cache_key("h2", "routes", {})
+    assert cache_key("h", "routes", {}) != cache_key("h", "routes", {}, reference_hash="h2")
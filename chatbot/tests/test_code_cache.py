@@ -0,0 +1,132 @@
+# test_code_cache.py
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# 2024 Amar Abane
+
+# Description: This file is part of the AskBatfish project which interacts with
+# Batfish using LLMs.
+
+
+import pandas as pd
+import pytest
+
+from code_cache import CodeCache, normalize_task
+
+SOURCE = "def run():\n    return bf.q.routes().answer().frame()"
+FRAME = pd.DataFrame({"Node": ["r1"]})
+
+
+class WordEmbeddings:
+    """Bag-of-words vectors: tasks with the same words embed identically."""
+
+    words = ["show", "list", "routes", "routing", "table", "bgp", "peers", "on", "the", "all"]
+
+    def embed_query(self, text):
+        return [float(text.split().count(w)) for w in self.words] + [1.0]
+
+
+@pytest.fixture
+def examples(tmp_path):
+    path = tmp_path / "bf_questions.json"
+    path.write_text("{}")
+    return path
+
+
+def make_cache(examples, similarity=None, size=8):
+    cache = CodeCache(size=size, similarity=similarity, examples_path=str(examples))
+    cache._embeddings = WordEmbeddings()
+    return cache
+
+
+def keep(cache, task, model="gpt-4o", source=SOURCE):
+    key = cache.key(task, model)
+    entry = cache.prepare(key, source)
+    cache.update(key, entry, FRAME)
+    return entry
+
+
+def test_normalize_task():
+    assert normalize_task("  Show   the Routes?! ") == "show the routes"
+
+
+def test_exact_match_after_normalization(examples):
+    cache = make_cache(examples)
+    entry = keep(cache, "Show the routes")
+    assert cache.get(cache.key("show   the routes?", "gpt-4o")) is entry
+    assert cache.stats()["hits"] == 1
+
+
+def test_keyed_by_model_and_examples(examples):
+    cache = make_cache(examples)
+    keep(cache, "show the routes")
+    assert cache.get(cache.key("show the routes", "gpt-3.5-turbo")) is None
+    examples.write_text('{"changed": true}')
+    assert cache.get(cache.key("show the routes", "gpt-4o")) is None
+
+
+def test_kept_only_after_non_empty_result(examples):
+    cache = make_cache(examples)
+    key = cache.key("show the routes", "gpt-4o")
+    entry = cache.prepare(key, SOURCE)
+    cache.update(key, entry, pd.DataFrame())
+    assert cache.get(key) is None
+    cache.update(key, entry, None)
+    assert cache.get(key) is None
+    cache.update(key, entry, FRAME)
+    assert cache.get(key) is entry
+
+
+def test_invalid_source_is_rejected(examples):
+    cache = make_cache(examples)
+    key = cache.key("show the routes", "gpt-4o")
+    with pytest.raises(ValueError):
+        cache.prepare(key, "x = 1")
+    with pytest.raises(SyntaxError):
+        cache.prepare(key, "def run(:")
+
+
+def test_paraphrase_match(examples):
+    cache = make_cache(examples, similarity=0.95)
+    entry = keep(cache, "show all routes on as1border1")
+    assert cache.get(cache.key("on as1border1 show all routes", "gpt-4o")) is entry
+    assert cache.stats()["similar_hits"] == 1
+    # Same words, different node: different code.
+    assert cache.get(cache.key("show all routes on as2border1", "gpt-4o")) is None
+    # Different words.
+    assert cache.get(cache.key("list bgp peers on as1border1", "gpt-4o")) is None
+
+
+def test_paraphrase_disabled_without_threshold(examples):
+    cache = make_cache(examples)
+    keep(cache, "show all routes on as1border1")
+    assert cache.get(cache.key("on as1border1 show all routes", "gpt-4o")) is None
+
+
+def test_failure_discards_the_matched_entry(examples):
+    cache = make_cache(examples, similarity=0.95)
+    entry = keep(cache, "show all routes on as1border1")
+    key = cache.key("on as1border1 show all routes", "gpt-4o")
+    matched = cache.get(key)
+    assert matched is entry
+    cache.update(key, matched, None)
+    assert cache.get(cache.key("show all routes on as1border1", "gpt-4o")) is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_lru_size(examples):
+    cache = make_cache(examples, size=2)
+    for task in ("show the routes", "list bgp peers", "show the routing table"):
+        keep(cache, task)
+    assert cache.stats()["entries"] == 2
+    assert cache.get(cache.key("show the routes", "gpt-4o")) is None
@@ -0,0 +1,101 @@
+# test_columnar.py
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# 2024 Amar Abane
+
+# Description: This file is part of the AskBatfish project which interacts with
+# Batfish using LLMs.
+
+
+import numpy as np
+import pandas as pd
+import pytest
+from pybatfish.datamodel.primitives import Interface, ListWrapper
+from pybatfish.datamodel.route import NextHopDiscard, NextHopInterface, NextHopIp
+
+from columnar import ColumnarFrame
+
+
+def assert_same(expected, actual):
+    assert list(expected.columns) == list(actual.columns)
+    assert expected.index.equals(actual.index)
+    for column in expected.columns:
+        assert expected[column].dtype == actual[column].dtype, column
+        for a, b in zip(expected[column], actual[column]):
+            assert type(a) is type(b), (column, a, b)
+            assert a is b or a == b or (a != a and b != b), (column, a, b)
+
+
+@pytest.fixture
+def routes():
+    n = 60
+    nodes = [f"border{i % 4}" for i in range(n)]
+    return pd.DataFrame({
+        "Node": nodes,
+        "Network": [f"10.0.{i}.0/24" for i in range(n)],
+        "Next_Hop": [
+            [NextHopInterface(interface="Gi0/0", ip="10.0.0.1"), NextHopIp(ip="10.1.0.1"), NextHopDiscard()][i % 3]
+            for i in range(n)
+        ],
+        "Interface": [None if i % 7 == 0 else Interface(hostname=nodes[i], interface="Gi0/1") for i in range(n)],
+        "Admin_Distance": np.arange(n),
+        "Tag": pd.Series([None if i % 2 else i for i in range(n)], dtype=object),
+        "Active": [None if i % 5 == 0 else i % 2 == 0 for i in range(n)],
+        "Peers": [None if i % 9 == 0 else ListWrapper(nodes[:i % 4]) for i in range(n)],
+        "Path": [[Interface(hostname=nodes[i], interface="Gi0/2")] * (i % 3) for i in range(n)],
+        "Other": [{"a": i} for i in range(n)],
+    })
+
+
+def test_encode_compacts_columns(routes):
+    frame = ColumnarFrame.encode(routes)
+    kinds = dict(zip(frame.names, (spec["kind"] for spec in frame.specs)))
+    assert kinds == {
+        "Node": "category", "Network": "string", "Next_Hop": "objects", "Interface": "objects",
+        "Admin_Distance": "raw", "Tag": "int", "Active": "bool", "Peers": "list", "Path": "list",
+        "Other": "object",
+    }
+
+
+def test_round_trip(routes):
+    assert_same(routes, ColumnarFrame.encode(routes).decode())
+
+
+def test_decode_rows_and_columns(routes):
+    page = ColumnarFrame.encode(routes).decode(13, 27, ["Peers", "Node", "Next_Hop"])
+    assert_same(routes.iloc[13:27][["Peers", "Node", "Next_Hop"]], page)
+
+
+def test_filtered_index(routes):
+    subset = routes[routes["Node"] == "border1"]
+    assert_same(subset, ColumnarFrame.encode(subset).decode())
+
+
+def test_arrow_round_trip(routes, tmp_path):
+    path = str(tmp_path / "frame.arrow")
+    subset = routes.iloc[5:]
+    ColumnarFrame.encode(subset).write_arrow(path, {"answer": b"shell"})
+    frame, metadata = ColumnarFrame.read_arrow(path)
+    assert metadata == {"answer": b"shell"}
+    assert_same(subset, frame.decode())
+    assert_same(subset.iloc[10:20], frame.decode(10, 20))
+
+
+def test_extension_dtypes_and_empty(tmp_path):
+    df = pd.DataFrame({"a": pd.array([1, None], dtype="Int64"), "b": pd.Categorical(["x", "y"])})
+    path = str(tmp_path / "frame.arrow")
+    ColumnarFrame.encode(df).write_arrow(path)
+    assert_same(df, ColumnarFrame.read_arrow(path)[0].decode())
+    empty = pd.DataFrame()
+    assert_same(empty, ColumnarFrame.encode(empty).decode())
@@ -0,0 +1,64 @@
+# test_compaction.py
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# 2024 Amar Abane
+
+# Description: This file is part of the AskBatfish project which interacts with
+# Batfish using LLMs.
+
+
+import pandas as pd
+import pytest
+from pybatfish.datamodel.primitives import Interface
+
+from compaction import compact_frame, count_tokens
+
+
+def routes(n):
+    return pd.DataFrame({
+        "Node": [f"border-router-{i % 6}" for i in range(n)],
+        "Network": [f"10.{i // 256}.{i % 256}.0/24" for i in range(n)],
+        "Interface": [Interface(hostname=f"border-router-{i % 6}", interface=f"Ethernet{i % 8}") for i in range(n)],
+        "Protocol": [["bgp", "ospf", "connected"][i % 3] for i in range(n)],
+        "AS_Path": [list(range(i % 7)) for i in range(n)],
+    })
+
+
+def test_small_frame_is_shown_whole():
+    text = compact_frame(routes(12), budget=1500)
+    assert text.startswith("12 rows x 5 columns.")
+    assert "sampled" not in text
+    # Repeated node names are interned in the legend.
+    assert "=border-router-1" in text
+    assert "\n11|" in text
+
+
+@pytest.mark.parametrize("n", [50, 400, 5000])
+@pytest.mark.parametrize("budget", [1500, 300, 60])
+def test_within_budget(n, budget):
+    text = compact_frame(routes(n), budget=budget, handle="frame-1")
+    assert count_tokens(text) <= budget
+
+
+def test_sample_keeps_totals_of_the_full_frame():
+    text = compact_frame(routes(3000), budget=600)
+    assert "Showing" in text
+    assert "Protocol: bgp=1000, ospf=1000, connected=1000" in text
+
+
+def test_header_cut_when_nothing_fits():
+    wide = pd.DataFrame({f"column_with_a_long_name_{i}": ["x"] * 300 for i in range(100)})
+    text = compact_frame(wide, budget=40)
+    assert count_tokens(text) <= 40
+    assert text.endswith("[truncated]")
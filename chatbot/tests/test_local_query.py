@@ -0,0 +1,70 @@
+# test_local_query.py
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# 2024 Amar Abane
+
+# Description: This file is part of the AskBatfish project which interacts with
+# Batfish using LLMs.
+
+
+import pandas as pd
+import pytest
+
+from local_query import parse, run_local
+
+
+@pytest.fixture
+def routes():
+    return pd.DataFrame({
+        "Node": ["r1", "r1", "r2", "R3"],
+        "VRF": ["default"] * 4,
+        "Network": ["10.0.0.0/24", "10.0.1.0/24", "10.0.2.0/24", "10.0.3.0/24"],
+        "Protocol": ["bgp", "ospf", "bgp", "connected"],
+        "Metric": [10, 20, 5, 0],
+    })
+
+
+def test_filter_on_column(routes):
+    df = run_local(routes, "only rows where Node is r2")
+    assert df["Network"].tolist() == ["10.0.2.0/24"]
+
+
+def test_top_by_metric(routes):
+    df = run_local(routes, "top 2 by metric")
+    assert df["Metric"].tolist() == [20, 10]
+
+
+def test_count_per_protocol(routes):
+    df = run_local(routes, "count routes per protocol")
+    assert df.to_dict("records") == [
+        {"Protocol": "bgp", "Count": 2},
+        {"Protocol": "connected", "Count": 1},
+        {"Protocol": "ospf", "Count": 1},
+    ]
+
+
+def test_on_known_node(routes):
+    df = run_local(routes, "show routes on r3")
+    assert df["Node"].tolist() == ["R3"]
+
+
+def test_for_unknown_node_is_not_parsed(routes):
+    # "bgp" is not a node: the request must go to the LLM, not filter
+    # everything out.
+    assert parse(routes, "show routes for bgp") is None
+    assert run_local(routes, "show routes for bgp") is None
+
+
+def test_unknown_words_are_not_parsed(routes):
+    assert parse(routes, "which routes are redistributed into bgp") is None
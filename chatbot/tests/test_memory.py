@@ -0,0 +1,111 @@
+# test_memory.py
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# 2024 Amar Abane
+
+# Description: This file is part of the AskBatfish project which interacts with
+# Batfish using LLMs.
+
+
+import asyncio
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from compaction import count_tokens
+from memory import ChatMemory, strip_tables
+
+
+def table(rows):
+    lines = ["| Node | VRF |", "|---|---|"]
+    return "\n".join(lines + [f"| r{i} | default |" for i in range(rows)])
+
+
+def total_tokens(memory):
+    return sum(count_tokens(m.content) for m in memory.messages())
+
+
+def test_strip_tables():
+    text = f"Routes:\n{table(10)}\nHandle: frame-1"
+    assert strip_tables(text) == "Routes:\n[table with 10 rows omitted]\nHandle: frame-1"
+    small = f"Routes:\n{table(2)}"
+    assert strip_tables(small) == small
+
+
+def test_recent_turns_are_kept_verbatim():
+    memory = ChatMemory(budget=2000)
+    memory.add("show routes", "Here they are.")
+    memory.add("and bgp peers?", "There are 4.")
+    assert [type(m) for m in memory.messages()] == [HumanMessage, AIMessage, HumanMessage, AIMessage]
+    assert memory.messages()[3].content == "There are 4."
+
+
+def test_old_turns_are_dropped_without_summarizer():
+    memory = ChatMemory(budget=200)
+    for i in range(20):
+        memory.add(f"question {i} " + "word " * 20, f"answer {i} " + "word " * 20)
+    assert total_tokens(memory) <= 200
+    assert memory.messages()[-1].content.startswith("answer 19")
+    assert not memory.summary
+
+
+def test_old_turns_are_folded_into_the_summary():
+    folded = []
+
+    async def summarize(summary, turns):
+        folded.append(turns)
+        return (summary + " " + str(len(folded))).strip()
+
+    async def chat():
+        memory = ChatMemory(summarize=summarize, budget=200)
+        for i in range(20):
+            task = memory.add(f"question {i} " + "word " * 20, f"answer {i} " + "word " * 20)
+            if task is not None:
+                await task
+        return memory
+
+    memory = asyncio.run(chat())
+    assert "Engineer: question 0" in folded[0]
+    messages = memory.messages()
+    assert isinstance(messages[0], SystemMessage)
+    assert memory.summary in messages[0].content
+    assert messages[-1].content.startswith("answer 19")
+
+
+def test_failed_summary_keeps_the_turns():
+    calls = []
+
+    async def summarize(summary, turns):
+        calls.append(turns)
+        if len(calls) == 1:
+            raise RuntimeError("rate limited")
+        return "summary"
+
+    async def chat():
+        memory = ChatMemory(summarize=summarize, budget=100)
+        for i in range(6):
+            task = memory.add(f"question {i} " + "word " * 20, f"answer {i}")
+            if task is not None:
+                await task
+        return memory
+
+    memory = asyncio.run(chat())
+    assert memory.summary == "summary"
+    # The turns of the failed attempt were folded by the next one.
+    assert "question 0" in calls[1]
+
+
+def test_long_turn_is_clipped():
+    memory = ChatMemory(budget=100)
+    memory.add("show routes", "word " * 1000)
+    assert total_tokens(memory) <= 100
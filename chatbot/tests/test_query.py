@@ -0,0 +1,58 @@
+# test_query.py
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# 2024 Amar Abane
+
+# Description: This file is part of the AskBatfish project which interacts with
+# Batfish using LLMs.
+
+
+import asyncio
+import contextvars
+import threading
+
+import pandas as pd
+
+from query import compile_run, run_blocking
+
+user = contextvars.ContextVar("user", default=None)
+
+
+def test_run_blocking_keeps_the_caller_context():
+    async def main():
+        user.set("alice")
+        return await run_blocking(lambda: (user.get(), threading.current_thread().name))
+
+    value, thread = asyncio.run(main())
+    assert value == "alice"
+    assert thread.startswith("query")
+
+
+def test_run_blocking_does_not_block_the_loop():
+    async def main():
+        event = threading.Event()
+        blocked = asyncio.ensure_future(run_blocking(event.wait, 5))
+        await asyncio.sleep(0)
+        # The loop keeps running while the executor thread waits.
+        event.set()
+        return await blocked
+
+    assert asyncio.run(main()) is True
+
+
+def test_compile_run_exposes_bf_and_reference():
+    source = "def run():\n    return pd.DataFrame({'bf': [bf], 'ref': [REFERENCE_SNAPSHOT]})"
+    run = compile_run(source, "session", reference="base")
+    assert run().to_dict("records") == [{"bf": "session", "ref": "base"}]
+    assert isinstance(run(), pd.DataFrame)
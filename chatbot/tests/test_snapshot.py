@@ -0,0 +1,155 @@
+# test_snapshot.py
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# 2024 Amar Abane
+
+# Description: This file is part of the AskBatfish project which interacts with
+# Batfish using LLMs.
+
+
+import threading
+import time
+import zipfile
+
+import pytest
+
+import snapshot
+from snapshot import (
+    ensure_snapshot, manifest_delta, manifest_digest, snapshot_manifest, update_snapshot,
+)
+
+
+def make_zip(path, files, root="snapshot"):
+    with zipfile.ZipFile(path, "w") as archive:
+        for name, content in files.items():
+            archive.writestr(f"{root}/{name}" if root else name, content)
+    return str(path)
+
+
+CONFIGS = {"configs/r1.cfg": "hostname r1\n", "configs/r2.cfg": "hostname r2\n"}
+
+
+class FakeSession:
+    """Records the uploads that a pybatfish Session would make."""
+
+    def __init__(self, network):
+        self.network = network
+        self.snapshot = None
+        self.snapshots = {}
+        self.inits = []
+        self.forks = []
+        self._lock = threading.Lock()
+
+    def list_snapshots(self):
+        with self._lock:
+            return list(self.snapshots)
+
+    def set_snapshot(self, name):
+        self.snapshot = name
+
+    def init_snapshot(self, zip_path, name, overwrite=False):
+        time.sleep(0.05)
+        with self._lock:
+            self.inits.append(name)
+            self.snapshots[name] = zip_path
+        self.snapshot = name
+
+    def fork_snapshot(self, base, name, add_files, overwrite=False):
+        with zipfile.ZipFile(add_files) as archive:
+            self.forks.append((base, name, sorted(archive.namelist())))
+        with self._lock:
+            self.snapshots[name] = add_files
+
+    def delete_snapshot(self, name):
+        with self._lock:
+            del self.snapshots[name]
+
+
+def test_manifest_ignores_root_folder_and_hidden_files(tmp_path):
+    a = snapshot_manifest(make_zip(tmp_path / "a.zip", CONFIGS, root="site-a"))
+    b = snapshot_manifest(make_zip(tmp_path / "b.zip", {**CONFIGS, ".DS_Store": "x"}, root="other"))
+    assert a == b
+    assert sorted(a) == ["configs/r1.cfg", "configs/r2.cfg"]
+    assert manifest_digest(a) == manifest_digest(dict(reversed(list(b.items()))))
+
+
+def test_manifest_delta():
+    old = {"a": "1", "b": "2", "c": "3"}
+    new = {"a": "1", "b": "20", "d": "4"}
+    assert manifest_delta(old, new) == (["b", "d"], ["c"])
+    assert manifest_delta(old, old) == ([], [])
+
+
+def test_same_content_is_reused(tmp_path):
+    bf = FakeSession("reuse")
+    first = ensure_snapshot(bf, make_zip(tmp_path / "a.zip", CONFIGS))
+    second = ensure_snapshot(bf, make_zip(tmp_path / "b.zip", CONFIGS, root="copy"))
+    assert first[2] is False and second[2] is True
+    assert first[0] == second[0] == bf.snapshot
+    assert bf.inits == [first[0]]
+
+
+def test_concurrent_uploads_initialize_once(tmp_path):
+    bf = FakeSession("concurrent")
+    path = make_zip(tmp_path / "a.zip", CONFIGS)
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(ensure_snapshot(bf, path)))
+        for _ in range(4)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(bf.inits) == 1
+    assert sorted(reused for _, _, reused in results) == [False, True, True, True]
+    assert not snapshot._uploads
+
+
+def test_update_uploads_only_changed_files(tmp_path):
+    bf = FakeSession("update")
+    base, _, _ = ensure_snapshot(bf, make_zip(tmp_path / "a.zip", CONFIGS))
+    edited = {**CONFIGS, "configs/r2.cfg": "hostname r2\nntp server 10.0.0.1\n", "hosts/h1.json": "{}"}
+    name, _, changed = update_snapshot(bf, base, make_zip(tmp_path / "b.zip", edited))
+    assert changed == ["configs/r2.cfg", "hosts/h1.json"]
+    assert bf.forks == [(base, name, ["snapshot/configs/r2.cfg", "snapshot/hosts/h1.json"])]
+    assert bf.snapshot == name
+
+
+def test_update_with_removed_files_uploads_everything(tmp_path):
+    bf = FakeSession("removed")
+    base, _, _ = ensure_snapshot(bf, make_zip(tmp_path / "a.zip", CONFIGS))
+    name, _, changed = update_snapshot(bf, base, make_zip(tmp_path / "b.zip", {"configs/r1.cfg": "hostname r1\n"}))
+    assert changed is None
+    assert bf.inits == [base, name]
+    assert not bf.forks
+
+
+@pytest.fixture
+def small_limit(monkeypatch):
+    monkeypatch.setattr(snapshot, "MAX_SNAPSHOTS", 2)
+
+
+def test_pinned_snapshots_are_not_evicted(tmp_path, small_limit):
+    bf = FakeSession("evict")
+    names = []
+    for i in range(4):
+        name, _, _ = ensure_snapshot(bf, make_zip(tmp_path / f"{i}.zip", {"configs/r.cfg": f"v{i}"}))
+        names.append(name)
+        if i == 0:
+            snapshot.pin_snapshot(bf.network, name)
+    try:
+        assert sorted(bf.list_snapshots()) == sorted([names[0], names[3]])
+    finally:
+        snapshot.unpin_snapshot(bf.network, names[0])
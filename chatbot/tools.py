@@ -18,23 +18,19 @@
 # Batfish using LLMs.
 
 
-from langchain_openai import ChatOpenAI
-from langchain_openai import OpenAIEmbeddings
-from langchain_community.vectorstores import Neo4jVector
-from langchain.chains.qa_with_sources import load_qa_with_sources_chain
-from langchain.chains import RetrievalQAWithSourcesChain
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnablePassthrough
+from langchain_core.runnables import RunnableLambda, RunnablePassthrough
 from langchain.prompts.chat import ChatPromptTemplate
-from langchain.chains import GraphCypherQAChain
-from langchain_community.graphs import Neo4jGraph
-from langchain_core.example_selectors import SemanticSimilarityExampleSelector
 from langchain_core.prompts import FewShotPromptTemplate, PromptTemplate
 
-import json
 import os
+import threading
 from dotenv import load_dotenv
 
+from docs_index import docs_context
+from example_index import get_example_selector
+from gateway import chat_model
+
 
 load_dotenv(".env")
 
@@ -56,30 +52,9 @@ def remove_python_code_fence(input_string):
 
 
 def create_ask_chain(model):
-    graph = Neo4jGraph (
-        url=neo4j_url, 
-        username=neo4j_username, 
-        password=neo4j_password
-    )
-
-    llm = ChatOpenAI(model_name=model, temperature=0)
+    llm = chat_model(model)
     
-    examples = []
-    try:
-        with open("bf_questions.json", 'r') as file:
-            text = file.read()
-            examples = json.loads(text)
-
-    except FileNotFoundError:
-        print(f"File not found: {file_path}")
-        
-    example_selector = SemanticSimilarityExampleSelector.from_examples(
-            examples,
-            OpenAIEmbeddings(),
-            Neo4jVector,
-            k=3,
-            input_keys=["question"],
-    )
+    example_selector = get_example_selector(k=3)
     
     example_prompt = PromptTemplate.from_template("Question: {question}\nInvocation: {invocation}")
 
@@ -108,31 +83,9 @@ Examples:""",
 
 
 def create_text_to_code_chain(model):
-    graph = Neo4jGraph (
-        url=neo4j_url, 
-        username=neo4j_username, 
-        password=neo4j_password
-    )
-    graph.refresh_schema()
-
-    llm = ChatOpenAI(model_name=model, temperature=0)
+    llm = chat_model(model)
     
-    examples = []
-    try:
-        with open("bf_questions.json", 'r') as file:
-            text = file.read()
-            examples = json.loads(text)
-
-    except FileNotFoundError:
-        print(f"File not found: {file_path}")
-        
-    example_selector = SemanticSimilarityExampleSelector.from_examples(
-            examples,
-            OpenAIEmbeddings(),
-            Neo4jVector,
-            k=3,
-            input_keys=["question"],
-    )
+    example_selector = get_example_selector(k=3)
     
     example_prompt = PromptTemplate.from_template("Question: {question}\nInvocation: {invocation}")
     prompt = FewShotPromptTemplate(
@@ -142,34 +95,82 @@ def create_text_to_code_chain(model):
 Function template:
 ```
 def run():
-    try:
-        # call bf.q. and get answer object
-        if hasattr(answer, 'frame') and callable(getattr(answer, 'frame')):
-            return answer.frame()
-        else:
-            return pd.DataFrame()
-    except Exception as e:
-        return pd.DataFrame()
+    # call bf.q. and get answer object
+    return answer.frame()
 ``` 
 
+Do not catch exceptions in run(): a failing invocation must raise.
+
+If the task compares the network with its previous version, pass reference_snapshot=REFERENCE_SNAPSHOT to answer().
+
 Rely on the examples below to generate the correct pybatfish invocation:""",
         example_prompt=example_prompt,
-        suffix="""\nInput task: {question}
+        suffix="""\nRelevant pybatfish documentation:
+
+{docs}
+
+Input task: {question}
 
 Answer only with the completed function, --no initialization, no explanation, and no code fences.""",
-        input_variables=["question"],
+        input_variables=["question", "docs"],
     )
     
     output_parser = StrOutputParser()
 
     text_to_code_chain = (
-        prompt | llm | output_parser
+        {"question": RunnablePassthrough(), "docs": RunnableLambda(docs_context)}
+        | prompt | llm | output_parser
     )
 
     # print(prompt.format(task="get routing tables of as1border1"))
     return text_to_code_chain
 
 
+def create_plan_chain(model):
+    llm = chat_model(model)
+    
+    example_selector = get_example_selector(k=3)
+    
+    example_prompt = PromptTemplate.from_template("Question: {question}\nInvocation: {invocation}")
+    prompt = FewShotPromptTemplate(
+        example_selector=example_selector,
+        prefix="""You are the co-pilote of a network engineer. The input task may need several pybatfish invocations, for instance to compare the BGP sessions and the OSPF areas of some routers.
+Split the task into the fewest independent questions that are each answered by one pybatfish invocation; a task that needs a single invocation is a single question.
+For each question, complete the Python function template with the correct pybatfish invocation and return a dataframe.
+        
+Function template:
+```
+def run():
+    # call bf.q. and get answer object
+    return answer.frame()
+``` 
+
+Do not catch exceptions in run(): a failing invocation must raise.
+
+If the task compares the network with its previous version, pass reference_snapshot=REFERENCE_SNAPSHOT to answer().
+
+Rely on the examples below to generate the correct pybatfish invocations:""",
+        example_prompt=example_prompt,
+        suffix="""\nRelevant pybatfish documentation:
+
+{docs}
+
+Input task: {question}
+
+For each question, answer with a line 'Question: ' followed by the question, then its completed function on the next lines. No initialization, no explanation, and no code fences.""",
+        input_variables=["question", "docs"],
+    )
+    
+    output_parser = StrOutputParser()
+
+    plan_chain = (
+        {"question": RunnablePassthrough(), "docs": RunnableLambda(docs_context)}
+        | prompt | llm | output_parser
+    )
+
+    return plan_chain
+
+
 def create_data_to_text_chain(model):
     template = """You are a network engineer. You received a query from a network operator regarding the network status.
 They executed a verification query and provided the results in Markdown table format.
@@ -184,7 +185,7 @@ Markdown Table:
 Short and concise analysis:
 """
 
-    llm = ChatOpenAI(model_name=model, temperature=0)
+    llm = chat_model(model)
     prompt = ChatPromptTemplate.from_template(template)
     output_parser = StrOutputParser()
     data_to_text_chain = (
@@ -220,7 +221,7 @@ Example questions:
 12- What is the compatibility of configured BGP sessions?
 """
 
-    llm = ChatOpenAI(model_name="gpt-4o", temperature=0)
+    llm = chat_model("gpt-4o")
     prompt = ChatPromptTemplate.from_template(template)
     output_parser = StrOutputParser()
     data_to_text_chain = (
@@ -243,11 +244,57 @@ Markdown Tables:
 {data}
 """
 
-    llm = ChatOpenAI(model_name="gpt-4o", temperature=0)
+    llm = chat_model("gpt-4o")
     prompt = ChatPromptTemplate.from_template(template)
     output_parser = StrOutputParser()
     parsing_status_chain = (
         {"data": RunnablePassthrough()} 
         | prompt | llm | output_parser
     )
-    return parsing_status_chain
\ No newline at end of file
+    return parsing_status_chain
+
+def create_summary_chain(model):
+    template = """You are the co-pilot of a network engineer. Update the summary of your conversation with the engineer using the new turns below.
+Keep the facts needed to continue the conversation: devices, addresses, questions asked, findings and result handles. Leave out table contents.
+Answer only with the updated summary, in at most {max_words} words.
+
+Current summary:
+{summary}
+
+New turns:
+{turns}
+"""
+
+    llm = chat_model(model)
+    prompt = ChatPromptTemplate.from_template(template)
+    output_parser = StrOutputParser()
+    summary_chain = (
+        prompt | llm | output_parser
+    )
+    return summary_chain
+
+
+_chain_builders = {
+    "ask": create_ask_chain,
+    "text_to_code": create_text_to_code_chain,
+    "plan": create_plan_chain,
+    "data_to_text": create_data_to_text_chain,
+    "summary": create_summary_chain,
+    "generate_tasks": lambda model: create_generate_tasks_chain(),
+    "parsing_status": lambda model: create_parsing_status_chain(),
+}
+_chains = {}
+_chains_lock = threading.Lock()
+
+
+def get_chain(kind, model="gpt-4o"):
+    """Return the `kind` chain for `model`, built once per process.
+
+    Chains hold no conversation state, so all chat sessions share them.
+    """
+    key = (kind, model)
+    with _chains_lock:
+        chain = _chains.get(key)
+        if chain is None:
+            chain = _chains[key] = _chain_builders[kind](model)
+    return chain
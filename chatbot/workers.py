@@ -0,0 +1,280 @@
+# workers.py
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# 2024 Amar Abane
+
+# Description: This file is part of the AskBatfish project which interacts with
+# Batfish using LLMs.
+
+
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+import asyncio
+import multiprocessing
+import os
+import pickle
+import queue
+import resource
+import threading
+import time
+import weakref
+from dotenv import load_dotenv
+
+
+load_dotenv(".env")
+
+# Worker processes running the generated code; 0 runs it in the server.
+QUERY_PROCESSES = int(os.getenv("QUERY_PROCESSES", "2"))
+QUERY_TIMEOUT = float(os.getenv("QUERY_TIMEOUT", "120"))
+QUERY_MEMORY_MB = int(os.getenv("QUERY_MEMORY_MB", "2048"))
+
+_CODE_CACHE_SIZE = 64
+
+
+class QueryError(Exception):
+    """The generated code failed, timed out or exceeded its memory cap."""
+
+
+def _limit_memory(memory_mb):
+    if memory_mb:
+        limit = memory_mb << 20
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def batfish_session(host):
+    """Default session factory of the workers."""
+    from pybatfish.client.session import Session
+
+    return Session(host=host)
+
+
+class _ServerCache:
+    """The server's answer cache, reached through the worker's pipe.
+
+    Answers computed by any worker, by the server itself or by the question
+    prefetch at chat start are then shared by all of them.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def get(self, key):
+        self.conn.send(("get", key))
+        return self.conn.recv()
+
+    def put(self, key, value):
+        self.conn.send(("put", key, value))
+
+
+def _worker_main(conn, host, memory_mb, session_factory):
+    """Loop of a worker process: run jobs received on `conn` one at a time.
+
+    pandas and pybatfish are imported and the Batfish session is created
+    before the first job. A job is (source, network, snapshot, reference,
+    hashes). While it runs, the worker asks the server for cached answers
+    with ("get", key) and hands new ones over with ("put", key, answer).
+    The reply is ("ok", pickled frame, spans) or ("error", message, spans),
+    where spans are the stages timed during the job.
+    """
+    import pandas as pd
+
+    from answer_cache import CachingSession
+    from code_cache import validate_run
+    from metrics import span
+    from query import compile_run
+
+    _limit_memory(memory_mb)
+    codes = OrderedDict()
+    cache = _ServerCache(conn)
+    bf = None
+    try:
+        bf = session_factory(host)
+    except Exception as e:
+        print(f"Worker {os.getpid()} unable to connect to Batfish: {e}")
+
+    while True:
+        try:
+            source, network, snapshot, reference, hashes = conn.recv()
+        except (EOFError, OSError):
+            return
+        with span("worker") as job:
+            try:
+                if bf is None:
+                    bf = session_factory(host)
+                bf.network = network
+                bf.snapshot = snapshot
+                code = codes.get(source)
+                if code is None:
+                    code = codes[source] = validate_run(source)
+                    if len(codes) > _CODE_CACHE_SIZE:
+                        codes.popitem(last=False)
+                run = compile_run(code, CachingSession(bf, cache=cache, hashes=dict(hashes)), reference)
+                result = run()
+                if not isinstance(result, pd.DataFrame):
+                    raise TypeError(f"run() returned {type(result).__name__}")
+                reply = ("ok", pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+            except MemoryError:
+                reply = ("error", f"Query exceeded the memory limit of {memory_mb} MB")
+            except Exception as e:
+                reply = ("error", f"{type(e).__name__}: {e}")
+        spans = [child.to_dict() for child in job.children]
+        try:
+            conn.send(reply + (spans,))
+        except MemoryError:
+            conn.send(("error", f"Result exceeded the memory limit of {memory_mb} MB", spans))
+
+
+class _Worker:
+    def __init__(self, ctx, host, memory_mb, session_factory):
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(
+            target=_worker_main, args=(child, host, memory_mb, session_factory),
+            daemon=True, name="query-worker",
+        )
+        self.process.start()
+        child.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class WorkerPool:
+    """Pre-started processes that run generated run() functions.
+
+    Each worker keeps its own Batfish session and compiled code, and runs
+    one query at a time under an address-space limit of `memory_mb`. A
+    query that does not finish within `timeout` seconds, or whose worker
+    dies, raises QueryError and its worker is replaced; the timeout includes
+    the wait for a free worker. Async callers hold a `slot` while they run a
+    query, so that executor threads never wait for a worker. Workers look answers
+    up in the server's answer cache and add theirs to it, and the stages
+    they time are recorded under the server's current span.
+    `session_factory(host)`, a picklable callable, creates the Batfish
+    session of a worker.
+    """
+
+    def __init__(self, size=QUERY_PROCESSES, host=None, timeout=QUERY_TIMEOUT,
+                 memory_mb=QUERY_MEMORY_MB, session_factory=batfish_session):
+        from sessions import BATFISH_HOST
+
+        self.size = size
+        self.host = host or BATFISH_HOST
+        self.timeout = timeout
+        self.memory_mb = memory_mb
+        self.session_factory = session_factory
+        # Spawned workers do not inherit the server's threads and sockets.
+        self._ctx = multiprocessing.get_context("spawn")
+        self._idle = queue.Queue()
+        for _ in range(size):
+            self._idle.put(self._spawn())
+        # One semaphore per event loop: asyncio primitives are bound to one.
+        self._slots = weakref.WeakKeyDictionary()
+        self._slots_lock = threading.Lock()
+
+    def _spawn(self):
+        return _Worker(self._ctx, self.host, self.memory_mb, self.session_factory)
+
+    @asynccontextmanager
+    async def slot(self, deadline=None):
+        """Wait on the event loop until a worker is free for the caller.
+
+        Raises QueryError if none is free by `deadline` (a time.monotonic()
+        value), `timeout` seconds from now by default.
+        """
+        if deadline is None:
+            deadline = time.monotonic() + self.timeout
+        loop = asyncio.get_running_loop()
+        with self._slots_lock:
+            slots = self._slots.get(loop)
+            if slots is None:
+                slots = self._slots[loop] = asyncio.Semaphore(self.size)
+        try:
+            await asyncio.wait_for(slots.acquire(), max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            raise QueryError(f"No query worker was free within {self.timeout:g} s")
+        try:
+            yield
+        finally:
+            slots.release()
+
+    def run(self, source, network, snapshot, reference=None, hashes=None, cache=None,
+            deadline=None):
+        """Run generated `source` on a snapshot; returns (frame, payload size).
+
+        `cache` is the answer cache shared with the worker, the server's by
+        default. `deadline` (a time.monotonic() value) bounds the wait for a
+        worker and the run, `timeout` seconds from now by default.
+        """
+        from answer_cache import answer_cache
+        from metrics import adopt
+
+        cache = cache or answer_cache
+        if deadline is None:
+            deadline = time.monotonic() + self.timeout
+        try:
+            worker = self._idle.get(timeout=max(0.0, deadline - time.monotonic()))
+        except queue.Empty:
+            raise QueryError(f"No query worker was free within {self.timeout:g} s")
+        try:
+            if not worker.process.is_alive():
+                worker.kill()
+                worker = self._spawn()
+            worker.conn.send((source, network, snapshot, reference, hashes or {}))
+            while True:
+                if not worker.conn.poll(max(0.0, deadline - time.monotonic())):
+                    worker.kill()
+                    worker = self._spawn()
+                    raise QueryError(f"Query timed out after {self.timeout:g} s")
+                message = worker.conn.recv()
+                if message[0] == "get":
+                    worker.conn.send(cache.get(message[1]))
+                elif message[0] == "put":
+                    cache.put(message[1], message[2])
+                else:
+                    break
+        except (EOFError, OSError) as e:
+            # Killed, most likely by the kernel for memory.
+            worker.kill()
+            worker = self._spawn()
+            raise QueryError(f"Query worker died: {e}")
+        finally:
+            self._idle.put(worker)
+        status, payload, spans = message
+        adopt(spans)
+        if status != "ok":
+            raise QueryError(payload)
+        return pickle.loads(payload), len(payload)
+
+    def close(self):
+        for _ in range(self.size):
+            self._idle.get().kill()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+# Session factory of the shared pool; the benchmark replaces it.
+session_factory = batfish_session
+
+
+def get_worker_pool():
+    """The shared worker pool, started on first use; None if disabled."""
+    global _pool
+    if QUERY_PROCESSES <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = WorkerPool(session_factory=session_factory)
+        return _pool